@@ -14,23 +14,27 @@ import logging
 import os
 import pwd
 import datetime
+import email.utils
 import hashlib
 import subprocess
 import stat
 import shutil
 import fileinput
+import fnmatch
+import functools
 import json
 import re
 import sqlite3
+import threading
 import time
 
 from uuid import uuid4
 from sys import argv
+from urllib.parse import urlencode
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 import yaml
-import magic
-import tornado.queues
 import libnacl.sealed
 import libnacl.public
 
@@ -39,22 +43,45 @@ from pandas import DataFrame
 from termcolor import colored
 from tornado.escape import json_decode, url_unescape, url_escape
 from tornado import gen
-from tornado.httpclient import AsyncHTTPClient
+from tornado.http1connection import HTTP1Connection
+from tornado.concurrent import Future
+from tornado.httpclient import HTTPClientError
+from tornado.httpserver import HTTPServer
+from tornado.iostream import SSLIOStream
+from tornado.netutil import bind_unix_socket
 from tornado.ioloop import IOLoop
+from tornado.locks import Semaphore
 from tornado.options import parse_command_line, define, options
 from tornado.web import (Application, RequestHandler, stream_request_body,
                          HTTPError, MissingArgumentError)
 
 from auth import process_access_token
-from utils import (call_request_hook, sns_dir,
+from utils import (sns_dir,
                    check_filename, _IS_VALID_UUID,
                    md5sum, tenant_from_url,
                    create_cluster_dir_if_not_exists,
-                   move_data_to_folder, set_mtime)
+                   move_data_to_folder, set_mtime, sendfile_nonblocking,
+                   parse_byte_ranges, negotiate_encoding,
+                   IllegalFilenameException)
 from db import sqlite_init, SqliteBackend, postgres_init, PostgresBackend
 from resumables import SerialResumable, ResumableNotFoundError
 from pgp import _import_keys
 from rmq import PikaClient
+from proxy import InProcessRequest, ByteBudgetQueue, InternalHTTPClient
+from metrics import metrics
+from metadata import FileMetadataCache, extension_mime_type, sniff_mime_type
+from privileged import PrivilegedHelperClient, PrivilegedHelperError, SudoPrivileges
+from hooks import RequestHookExecutor
+from naclstream import NaclStreamDecryptor, decrypt_nacl_payload
+from gzstream import GzipStreamWriter, GzipStreamError
+from tarstream import TarStreamExtractor, TarStreamError
+from checksums import ContentDigests, UploadHashes, BackgroundHasher
+from listing import (ListingSnapshots, ListingCursorError, DirectoryIndex, scan_names,
+                     page_entries, entry_batches, resume_offset, order_names,
+                     encode_cursor, decode_cursor,
+                     MANIFEST_HASHES, write_manifest)
+from archives import (ARCHIVE_FORMATS, COMPRESSION_ENCODINGS, ArchiveWriter,
+                      write_archive, write_compressed, CompressionCache)
 
 
 _RW______ = stat.S_IREAD | stat.S_IWRITE
@@ -118,6 +145,45 @@ def set_config():
     )
     define('rabbitmq', _config.get('rabbitmq', {}))
     define('maintenance_mode_enabled', False)
+    define('proxy_in_process', _config.get('proxy_in_process', False))
+    define('proxy_queue_max_bytes', _config.get('proxy_queue_max_bytes', 4194304))
+    define('proxy_queue_max_write', _config.get('proxy_queue_max_write', 1048576))
+    define('proxy_request_timeout', _config.get('proxy_request_timeout', 12000.0))
+    define('internal_socket', _config.get('internal_socket'))
+    define('proxy_client', _config.get('proxy_client', 'simple'))
+    define('proxy_max_clients', _config.get('proxy_max_clients', 100))
+    define('export_sendfile', _config.get('export_sendfile', False))
+    define('export_io_workers', _config.get('export_io_workers', 16))
+    define('export_producer_workers', _config.get('export_producer_workers', 8))
+    define('export_max_ranges', _config.get('export_max_ranges', 64))
+    define('export_compression_cache', _config.get('export_compression_cache'))
+    define('export_compression_cache_max_bytes',
+           _config.get('export_compression_cache_max_bytes', 10737418240))
+    define('metadata_cache_size', _config.get('metadata_cache_size', 100000))
+    define('metadata_cache_dir', _config.get('metadata_cache_dir'))
+    define('listing_snapshot_ttl', _config.get('listing_snapshot_ttl', 300))
+    define('listing_snapshot_max', _config.get('listing_snapshot_max', 100))
+    define('listing_snapshot_max_names', _config.get('listing_snapshot_max_names', 2000000))
+    define('listing_concurrency', _config.get('listing_concurrency', 8))
+    define('listing_index_max_dirs', _config.get('listing_index_max_dirs', 100))
+    define('listing_index_max_age', _config.get('listing_index_max_age', 300))
+    define('export_info_max_files', _config.get('export_info_max_files', 1000))
+    define('mime_type_extensions', _config.get('mime_type_extensions', {}) or {})
+    define('mime_type_header_bytes', _config.get('mime_type_header_bytes', 65536))
+    define('mime_type_sniffing', _config.get('mime_type_sniffing', 'always'))
+    define('privileged_helper_socket', _config.get('privileged_helper_socket'))
+    define('request_hook_workers', _config.get('request_hook_workers', 4))
+    define('request_hook_max_attempts', _config.get('request_hook_max_attempts', 3))
+    define('request_hook_retry_delay', _config.get('request_hook_retry_delay', 5))
+    define('request_hook_journal', _config.get('request_hook_journal'))
+    define('content_etags', _config.get('content_etags', False))
+    define('content_etag_hash', _config.get('content_etag_hash', 'sha256'))
+    define('content_etag_background', _config.get('content_etag_background', False))
+    define('content_etag_db', _config.get('content_etag_db'))
+    define('nacl_off_loop_min_bytes', _config.get('nacl_off_loop_min_bytes', 1048576))
+    define('gz_max_queued_chunks', _config.get('gz_max_queued_chunks', 16))
+    define('tar_max_queued_chunks', _config.get('tar_max_queued_chunks', 16))
+    define('tar_write_workers', _config.get('tar_write_workers', 4))
     options.logging = _config.get('log_level', 'info')
 
 set_config()
@@ -296,6 +362,168 @@ class AuthRequestHandler(RequestHandler):
            logging.error('user not member of group')
            raise e
 
+    def run_request_hook(self, params, on_done=None, digest=None):
+        """
+        Queue a call to the request hook of the backend, with the
+        arguments for one file, and call on_done once it has run,
+        successfully or not. The request does not wait for it.
+
+        Hooks may move the file, and change its ownership and mode,
+        and with them its ctime, so if the hash of its content is
+        given, the file is kept open until the hook has run, and the
+        hash is stored for the file as it is then, see store_content_digest.
+
+        """
+        kept = self.keep_for_digest(params[0]) if digest else None
+        future = self.application.settings['request_hooks'].submit(self.request_hook, params)
+        if on_done:
+            IOLoop.current().add_future(future, lambda f: on_done())
+        if kept:
+            IOLoop.current().add_future(
+                future, lambda f: self.store_content_digest(params[0], digest, kept)
+            )
+        return future
+
+
+    def keep_for_digest(self, path):
+        """
+        Open a file which is about to be given to the request hook,
+        if content ETags are enabled, and not too many files are
+        kept open already - the rest are hashed in the background.
+
+        Returns
+        -------
+        (int, os.stat_result), file descriptor, and stat, or None
+
+        """
+        if not options.content_etags:
+            return None
+        slots = self.application.settings['digest_slots']
+        if not slots.acquire(blocking=False):
+            return None
+        try:
+            fd = os.open(path, os.O_RDONLY | os.O_NOFOLLOW)
+        except OSError as e:
+            slots.release()
+            logging.error(e)
+            return None
+        return fd, os.fstat(fd)
+
+
+    @gen.coroutine
+    def change_privileged(self, op, path, **kwargs):
+        """
+        Change the mode (op=chmod), or ownership (op=chown), of a path
+        which the API user does not own, with the privileged helper if
+        it is configured, and with sudo otherwise.
+
+        Failures are logged, and reported by returning False.
+
+        """
+        try:
+            yield self.application.settings['privileges'].call(op, path, **kwargs)
+            return True
+        except PrivilegedHelperError as e:
+            logging.error(e)
+            return False
+
+
+    def change_privileged_blocking(self, op, path, **kwargs):
+        """Like change_privileged, but for use on worker threads."""
+        try:
+            self.application.settings['privileges'].call_blocking(op, path, **kwargs)
+            return True
+        except PrivilegedHelperError as e:
+            logging.error(e)
+            return False
+
+
+    def run_io(self, func, *args):
+        """
+        Run blocking calls, to the file system, or CPU-bound ones
+        which release the GIL, on the export thread pool, so that
+        they only hold up the requests which make them.
+
+        Returns
+        -------
+        Future
+
+        """
+        return IOLoop.current().run_in_executor(
+            self.application.settings.get('export_executor'), func, *args
+        )
+
+
+    def run_producer(self, func, *args):
+        """
+        Run a function which produces a response body, through an
+        ArchiveWriter, on the producer thread pool. Producers wait while
+        clients are not keeping up, so they have threads of their own,
+        instead of holding up the export thread pool. If all of them
+        are busy, the request is refused, with 503.
+
+        Returns
+        -------
+        Future
+
+        """
+        slots = self.application.settings['producer_slots']
+        if not slots.acquire(blocking=False):
+            metrics.incr('export_producers_busy')
+            self.set_status(503)
+            self.set_header('Retry-After', 10)
+            self.message = 'Too many downloads in progress, please try again later'
+            raise Exception(self.message)
+        def produce():
+            try:
+                return func(*args)
+            finally:
+                slots.release()
+        return IOLoop.current().run_in_executor(
+            self.application.settings['producer_executor'], produce
+        )
+
+
+    def new_content_hash(self):
+        """Get a hash object for the content of an upload, if content_etags is enabled."""
+        return hashlib.new(options.content_etag_hash) if options.content_etags else None
+
+
+    @gen.coroutine
+    def store_content_digest(self, path, digest, kept=None):
+        """
+        Store the hash of the content of an uploaded file, on the
+        export thread pool, once its mtime has been set, or, if it
+        was not hashed during the upload, queue it for the background
+        hasher, if enabled.
+
+        If the file was kept open while the request hook ran, see
+        keep_for_digest, the hash is stored for the file as it is now,
+        wherever the hook has moved it, unless its size or mtime
+        have changed, and the file is closed.
+
+        """
+        if not options.content_etags:
+            return
+        digests = self.application.settings['content_digests']
+        if kept:
+            fd, before = kept
+            try:
+                info = yield self.run_io(os.fstat, fd)
+            finally:
+                os.close(fd)
+                self.application.settings['digest_slots'].release()
+            if (info.st_size, info.st_mtime_ns) == (before.st_size, before.st_mtime_ns):
+                yield self.run_io(digests.put, path, options.content_etag_hash, digest, info)
+            return
+        if digest:
+            yield self.run_io(digests.put, path, options.content_etag_hash, digest)
+            return
+        hasher = self.application.settings.get('content_hasher')
+        if hasher:
+            hasher.submit(path)
+
+
     def is_reserved_resource(self, work_dir, resource):
         """
         Prevent access to API-owned resources.
@@ -538,13 +766,20 @@ class GenericFormDataHandler(AuthRequestHandler):
                 f.write(filebody)
                 os.rename(self.path, self.path_part)
                 os.chmod(self.path_part, _RW_RW___)
-            self.new_paths.append(self.path_part)
+            # appending to an existing file leaves its content unknown
+            content_hash = self.new_content_hash() if 'a' not in filemode else None
+            if content_hash:
+                content_hash.update(filebody)
+                content_digest = content_hash.hexdigest()
+            else:
+                content_digest = None
+            self.new_paths.append((self.path_part, content_digest))
             if self.backend == 'sns':
                 subfolder_path = os.path.normpath(tsd_hidden_folder + '/' + filename)
                 try:
                     shutil.copy(self.path_part, subfolder_path)
                     os.chmod(subfolder_path, _RW_RW___)
-                    self.new_paths.append(subfolder_path)
+                    self.new_paths.append((subfolder_path, content_digest))
                 except Exception as e:
                     logging.error(e)
                     logging.error('Could not copy file %s to .tsd folder', self.path_part)
@@ -558,11 +793,14 @@ class GenericFormDataHandler(AuthRequestHandler):
     def on_finish(self):
         if self.request.method in ('PUT','POST', 'PATCH'):
             try:
-                if self.request_hook['enabled']:
-                    for path in self.new_paths:
-                        call_request_hook(self.request_hook['path'],
-                                          [path, self.requestor, options.api_user, self.group_name],
-                                          as_sudo=self.request_hook['sudo'])
+                for path, digest in self.new_paths:
+                    if self.request_hook['enabled']:
+                        self.run_request_hook(
+                            [path, self.requestor, options.api_user, self.group_name],
+                            digest=digest
+                        )
+                    else:
+                        self.store_content_digest(path, digest)
             except Exception as e:
                 logging.error(e)
 
@@ -854,51 +1092,62 @@ class StreamHandler(AuthRequestHandler):
         self.proc = self.start_openssl_proc(output_file=self.path, base64=False)
 
 
-    def handle_tar(self, content_type, tenant_dir):
-        if 'gz' in content_type:
-            tarflags = '-xzf'
-        else:
-            tarflags = '-xf'
+    def start_tar_extractor(self, content_type, target_dir, source=None):
+        return TarStreamExtractor(
+            target_dir,
+            compression='gz' if 'gz' in content_type else '',
+            source=source,
+            hash_name=options.content_etag_hash,
+            digests=self.application.settings.get('content_digests'),
+            max_queued=options.tar_max_queued_chunks,
+            workers=options.tar_write_workers
+        )
+
+
+    def handle_tar(self, content_type, target_dir):
         self.custom_content_type = content_type
-        self.proc = subprocess.Popen(['tar', '-C', tenant_dir, tarflags, '-'],
-                                      stdin=subprocess.PIPE)
+        self.tar_extractor = self.start_tar_extractor(content_type, target_dir)
 
 
-    def handle_tar_aes(self, content_type, tenant_dir):
-        if 'gz' in content_type:
-            tarflags = '-xzf'
-        else:
-            tarflags = '-xf'
+    def handle_tar_aes(self, content_type, target_dir):
         self.custom_content_type = content_type
         self.openssl_proc = self.start_openssl_proc()
-        self.tar_proc = subprocess.Popen(['tar', '-C', tenant_dir, tarflags, '-'],
-                                 stdin=self.openssl_proc.stdout)
+        self.tar_extractor = self.start_tar_extractor(
+            content_type, target_dir, source=self.openssl_proc.stdout
+        )
 
 
     def handle_gz(self, content_type, filemode):
         self.custom_content_type = content_type
         self.target_file = open(self.path, filemode)
-        self.gunzip_proc = subprocess.Popen(['gunzip', '-c', '-'],
-                                             stdin=subprocess.PIPE,
-                                             stdout=self.target_file)
+        if self.request.method != 'PATCH':
+            self.content_hash = self.new_content_hash()
+        self.gz_writer = GzipStreamWriter(
+            self.target_file,
+            content_hash=self.content_hash,
+            max_queued=options.gz_max_queued_chunks
+        )
 
 
     def handle_gz_aes(self, content_type, filemode):
         self.custom_content_type = content_type
         self.target_file = open(self.path, filemode)
+        if self.request.method != 'PATCH':
+            self.content_hash = self.new_content_hash()
         self.openssl_proc = self.start_openssl_proc()
-        self.gunzip_proc = subprocess.Popen(['gunzip', '-c', '-'],
-                                             stdin=self.openssl_proc.stdout,
-                                             stdout=self.target_file)
+        self.gz_writer = GzipStreamWriter(
+            self.target_file,
+            source=self.openssl_proc.stdout,
+            content_hash=self.content_hash
+        )
 
     def handle_nacl_stream(self, headers):
         self.custom_content_type = headers['Content-Type']
-        self.nacl_stream_buffer = b''
         try:
-            self.nacl_nonce = options.sealed_box.decrypt(
+            nacl_nonce = options.sealed_box.decrypt(
                 base64.b64decode(headers['Nacl-Nonce'])
             )
-            self.nacl_key = options.sealed_box.decrypt(
+            nacl_key = options.sealed_box.decrypt(
                 base64.b64decode(headers['Nacl-Key'])
             )
         except Exception as e:
@@ -906,10 +1155,15 @@ class StreamHandler(AuthRequestHandler):
             logging.error('Could not decrypt Nacl headers')
             raise Exception
         try:
-            self.nacl_chunksize = int(headers['Nacl-Chunksize'])
+            nacl_chunksize = int(headers['Nacl-Chunksize'])
         except KeyError:
             logging.error('Missing Nacl-Chunksize header - cannot decrypt data')
             raise Exception
+        try:
+            self.nacl_decryptor = NaclStreamDecryptor(nacl_nonce, nacl_key, nacl_chunksize)
+        except ValueError as e:
+            logging.error(e)
+            raise Exception
 
 
     def initialize(self, backend):
@@ -955,6 +1209,10 @@ class StreamHandler(AuthRequestHandler):
             self.chunk_order_correct = True
             self.chunk_num = None
             self.on_finish_called = False
+            self.content_hash = None
+            self.content_digest = None
+            self.gz_writer = None
+            self.tar_extractor = None
             filemodes = {'PUT': 'wb+', 'PATCH': 'wb+'}
             try:
                 self.authnz = self.process_token_and_extract_claims(
@@ -1004,9 +1262,11 @@ class StreamHandler(AuthRequestHandler):
                                 target += f'/{_dir}'
                                 try:
                                     if self.group_config['enabled']:
-                                        subprocess.call(['chmod', '2770', target])
+                                        os.chmod(target, 0o2770)
                                         owner = options.api_user # so it can move the file into the dir
-                                        subprocess.call(['sudo', 'chown', f'{owner}:{self.group_name}', target])
+                                        yield self.change_privileged(
+                                            'chown', target, owner=owner, group=self.group_name
+                                        )
                                 except (Exception, OSError):
                                     logging.error('could not set permissions on upload directories')
                                     raise Exception
@@ -1024,7 +1284,10 @@ class StreamHandler(AuthRequestHandler):
                             self.res_key = None if not self.res_key else self.res_key
                         else:
                             self.res_key = url_dirs
-                        self.res = SerialResumable(self.tenant_dir, self.requestor)
+                        self.res = SerialResumable(
+                            self.tenant_dir, self.requestor,
+                            hashes=self.application.settings.get('upload_hashes')
+                        )
                         url_chunk_num = url_unescape(self.get_query_argument('chunk'))
                         url_upload_id = url_unescape(self.get_query_argument('id'))
                         self.chunk_num, \
@@ -1067,9 +1330,11 @@ class StreamHandler(AuthRequestHandler):
                     elif content_type == 'application/aes-octet-stream':
                         self.handle_aes_octet_stream(content_type)
                     elif content_type in ['application/tar', 'application/tar.gz']:
-                        self.handle_tar(content_type, self.tenant_dir)
+                        # into the destination (group) dir, where other
+                        # uploads are moved, so members stay inside it
+                        self.handle_tar(content_type, self.resource_dir)
                     elif content_type in ['application/tar.aes', 'application/tar.gz.aes']:
-                        self.handle_tar_aes(content_type, self.tenant_dir)
+                        self.handle_tar_aes(content_type, self.resource_dir)
                     elif content_type == 'application/gz':
                         self.handle_gz(content_type, filemode)
                     elif content_type == 'application/gz.aes':
@@ -1078,11 +1343,14 @@ class StreamHandler(AuthRequestHandler):
                         self.handle_nacl_stream(self.request.headers)
                         self.target_file = open(self.path, filemode)
                         os.chmod(self.path, _RW______)
+                        if self.request.method != 'PATCH':
+                            self.content_hash = self.new_content_hash()
                     else: # 3.8 no custom content type
                         if self.request.method != 'PATCH':
                             self.custom_content_type = None
                             self.target_file = open(self.path, filemode)
                             os.chmod(self.path, _RW______)
+                            self.content_hash = self.new_content_hash()
                         elif self.request.method == 'PATCH':
                             self.custom_content_type = None
                             if not self.completed_resumable_file:
@@ -1116,76 +1384,102 @@ class StreamHandler(AuthRequestHandler):
                     self.res.add_chunk(self.target_file, chunk)
                 else:
                     self.target_file.write(chunk)
+                    if self.content_hash:
+                        self.content_hash.update(chunk)
             elif self.custom_content_type == 'application/octet-stream+nacl':
-                for byte in chunk:
-                    self.nacl_stream_buffer += bytes([byte])
-                    if len(self.nacl_stream_buffer) % self.nacl_chunksize == 0:
-                        decrypted = libnacl.crypto_stream_xor(
-                            self.nacl_stream_buffer,
-                            self.nacl_nonce,
-                            self.nacl_key
-                        )
-                        self.target_file.write(decrypted)
-                        self.nacl_stream_buffer = b''
-            elif self.custom_content_type in ['application/tar', 'application/tar.gz',
-                                              'application/aes']:
-                self.proc.stdin.write(chunk)
-                if not chunk:
-                    self.proc.stdin.flush()
+                if len(chunk) >= options.nacl_off_loop_min_bytes:
+                    decrypted = yield self.run_io(self.nacl_decryptor.update, chunk)
+                else:
+                    decrypted = self.nacl_decryptor.update(chunk)
+                if decrypted:
+                    self.target_file.write(decrypted)
+                    if self.content_hash:
+                        self.content_hash.update(decrypted)
+            elif self.custom_content_type in ['application/tar', 'application/tar.gz']:
+                if chunk and not self.tar_extractor.put_nowait(chunk):
+                    yield self.run_io(self.tar_extractor.put, chunk)
+            elif self.custom_content_type == 'application/aes':
+                # writes to openssl block while its pipe is full, so they
+                # run off the loop, which also stops reading from the client
+                yield self.run_io(self.proc.stdin.write, chunk)
             elif self.custom_content_type in ['application/tar.aes', 'application/tar.gz.aes']:
-                self.openssl_proc.stdin.write(chunk)
-                if not chunk:
-                    self.openssl_proc.stdin.flush()
-                    self.tar_proc.stdin.flush()
+                yield self.run_io(self.openssl_proc.stdin.write, chunk)
             elif self.custom_content_type == 'application/gz':
-                self.gunzip_proc.stdin.write(chunk)
-                if not chunk:
-                    self.gunzip_proc.stdin.flush()
+                # wait for room in the queue off the loop, which
+                # also stops reading from the client until there is
+                if chunk and not self.gz_writer.put_nowait(chunk):
+                    yield self.run_io(self.gz_writer.put, chunk)
             elif self.custom_content_type == 'application/gz.aes':
-                self.openssl_proc.stdin.write(chunk)
-                if not chunk:
-                    self.openssl_proc.stdin.flush()
-                    self.gunzip_proc.stdin.flush()
+                yield self.run_io(self.openssl_proc.stdin.write, chunk)
         except Exception as e:
+            if any(worker and worker.aborted for worker in [self.gz_writer, self.tar_extractor]):
+                return # the client has gone, see on_connection_close
             logging.error(e)
             logging.error("something went wrong with stream processing have to close file")
+            if self.gz_writer:
+                self.gz_writer.abort()
+            if self.tar_extractor:
+                self.tar_extractor.abort()
             if self.target_file:
                 self.target_file.close()
             os.rename(self.path, self.path_part)
             self.send_error("something went wrong")
 
+    @gen.coroutine
     def put(self, tenant, uri_filename=None):
         if not self.custom_content_type:
             self.target_file.close()
             os.rename(self.path, self.path_part)
+            if self.content_hash:
+                self.content_digest = self.content_hash.hexdigest()
         elif self.custom_content_type == 'application/octet-stream+nacl':
-            if self.nacl_stream_buffer:
-                decrypted = libnacl.crypto_stream_xor(
-                            self.nacl_stream_buffer,
-                            self.nacl_nonce,
-                            self.nacl_key
-                        )
-                self.nacl_stream_buffer = b''
+            decrypted = self.nacl_decryptor.finalize()
+            if decrypted:
                 self.target_file.write(decrypted)
+                if self.content_hash:
+                    self.content_hash.update(decrypted)
             self.target_file.close()
             os.rename(self.path, self.path_part)
-        elif self.custom_content_type in ['application/tar', 'application/tar.gz',
-                                          'application/aes']:
-            out, err = self.proc.communicate()
-            if self.custom_content_type == 'application/aes':
-                os.rename(self.path, self.path_part)
-        elif self.custom_content_type in ['application/tar.aes', 'application/tar.gz.aes']:
-            out, err = self.openssl_proc.communicate()
-            out, err = self.tar_proc.communicate()
-        elif self.custom_content_type == 'application/gz':
-            out, err = self.gunzip_proc.communicate()
-            self.target_file.close()
+            if self.content_hash:
+                self.content_digest = self.content_hash.hexdigest()
+        elif self.custom_content_type == 'application/aes':
+            out, err = yield self.run_io(self.proc.communicate)
             os.rename(self.path, self.path_part)
-        elif self.custom_content_type == 'application/gz.aes':
-            out, err = self.openssl_proc.communicate()
-            out, err = self.gunzip_proc.communicate()
+        elif self.custom_content_type in ['application/tar', 'application/tar.gz',
+                                          'application/tar.aes', 'application/tar.gz.aes']:
+            try:
+                if self.custom_content_type.endswith('.aes'):
+                    # the extractor reads the decrypted data from openssl
+                    yield self.run_io(self.openssl_proc.stdin.close)
+                    yield self.run_io(self.openssl_proc.wait)
+                yield self.run_io(self.tar_extractor.close)
+            except TarStreamError as e:
+                # what was extracted is not hooked, or published, see on_finish
+                yield self.run_io(self.tar_extractor.discard)
+                self.set_status(400)
+                self.write({'message': e.message})
+                return
+            self.set_status(201)
+            self.write({'message': 'data streamed', 'files': self.tar_extractor.manifest})
+            return
+        elif self.custom_content_type in ['application/gz', 'application/gz.aes']:
+            try:
+                if self.custom_content_type == 'application/gz.aes':
+                    # the writer reads the decrypted data from openssl
+                    yield self.run_io(self.openssl_proc.stdin.close)
+                    yield self.run_io(self.openssl_proc.wait)
+                yield self.run_io(self.gz_writer.close)
+            except GzipStreamError as e:
+                # drop the partial output, see on_finish
+                self.target_file.close()
+                os.remove(self.path)
+                self.set_status(400)
+                self.write({'message': e.message})
+                return
             self.target_file.close()
             os.rename(self.path, self.path_part)
+            if self.content_hash:
+                self.content_digest = self.content_hash.hexdigest()
         self.set_status(201)
         self.write({'message': 'data streamed'})
 
@@ -1214,6 +1508,7 @@ class StreamHandler(AuthRequestHandler):
                 self.upload_id,
                 self.requestor
             )
+            self.content_digest = self.res.content_digest
             filename = os.path.basename(self.completed_resumable_filename)
         self.set_status(201)
         self.write({
@@ -1237,6 +1532,12 @@ class StreamHandler(AuthRequestHandler):
         2. Call the request hook, if configured
         3. Publish message to rabbitmq, if configured
 
+        Only resources which were created (status 201) are moved
+        to their destination, hooked, and published.
+
+        Archives are extracted in place, so the request hook
+        is called for each extracted file, instead.
+
         """
         try:
             if not self.target_file.closed:
@@ -1250,7 +1551,14 @@ class StreamHandler(AuthRequestHandler):
                 self.chunk_num == 'end'
             )
         )
-        if resource_created:
+        if resource_created and self.tar_extractor:
+            if self.get_status() == 201:
+                try:
+                    self.handle_extracted_files()
+                except Exception as e:
+                    logging.error(e)
+            self.on_finish_called = True
+        elif resource_created and self.get_status() == 201:
             try:
                 # switch path variables back
                 if not self.completed_resumable_file:
@@ -1261,34 +1569,71 @@ class StreamHandler(AuthRequestHandler):
                 client_mtime = self.request.headers.get('Modified-Time')
                 if client_mtime:
                     set_mtime(resource_path, float(client_mtime))
+                if not self.request_hook['enabled']:
+                    self.store_content_digest(resource_path, self.content_digest)
             except Exception as e:
                 logging.info('could not move data to destination folder')
                 logging.info(e)
-            try:
-                if self.request_hook['enabled']:
-                    call_request_hook(
-                        self.request_hook['path'],
-                        [resource_path, self.requestor, options.api_user, self.group_name],
-                        as_sudo=self.request_hook['sudo']
-                    )
-            except Exception as e:
-                logging.info('problem calling request hook')
-                logging.info(e)
             try:
                 message_data = {
                     'path': resource_path,
                     'requestor': self.requestor,
                     'group': self.group_name
                 }
-                self.handle_mq_publication(
+                publish = functools.partial(
+                    self.handle_mq_publication,
                     mq_config=self.mq_config,
                     data=message_data
                 )
+                # publish once the hook has run, as before
+                if self.request_hook['enabled']:
+                    self.run_request_hook(
+                        [resource_path, self.requestor, options.api_user, self.group_name],
+                        on_done=publish,
+                        digest=self.content_digest
+                    )
+                else:
+                    publish()
             except Exception as e:
                 logging.error(e)
             self.on_finish_called = True
 
 
+    def handle_extracted_files(self):
+        """
+        Call the request hook for each file extracted from an archive,
+        and publish one message, with the manifest of the archive,
+        once they have run.
+
+        """
+        target_dir = self.tar_extractor.target_dir
+        manifest = self.tar_extractor.manifest
+        message_data = {
+            'path': target_dir,
+            'requestor': self.requestor,
+            'group': self.group_name,
+            'files': manifest
+        }
+        publish = functools.partial(
+            self.handle_mq_publication,
+            mq_config=self.mq_config,
+            data=message_data
+        )
+        if self.request_hook['enabled'] and manifest:
+            hooks = [
+                self.run_request_hook([
+                    os.path.join(target_dir, entry['path']),
+                    self.requestor,
+                    options.api_user,
+                    self.group_name
+                ], digest=entry['digest'])
+                for entry in manifest
+            ]
+            IOLoop.current().add_future(gen.multi(hooks), lambda f: publish())
+        else:
+            publish()
+
+
     def on_connection_close(self):
         """
         Called when clients close the connection.
@@ -1298,6 +1643,10 @@ class StreamHandler(AuthRequestHandler):
 
         """
         try:
+            if self.gz_writer:
+                self.gz_writer.abort()
+            if self.tar_extractor:
+                self.tar_extractor.abort()
             if not self.target_file.closed:
                 self.target_file.close()
                 path = self.path
@@ -1312,22 +1661,25 @@ class StreamHandler(AuthRequestHandler):
                     client_mtime = self.request.headers.get('Modified-Time')
                     if client_mtime:
                         set_mtime(resource_path, float(client_mtime))
-                    if self.request_hook['enabled']:
-                        call_request_hook(
-                            self.request_hook['path'],
-                            [resource_path, self.requestor, options.api_user, self.group_name],
-                            as_sudo=self.request_hook['sudo']
-                        )
+                    publish = None
                     if not self.on_finish_called:
                         message_data = {
                             'path': resource_path,
                             'requestor': self.requestor,
                             'group': self.group_name
                         }
-                        self.handle_mq_publication(
+                        publish = functools.partial(
+                            self.handle_mq_publication,
                             mq_config=self.mq_config,
                             data=message_data
                         )
+                    if self.request_hook['enabled']:
+                        self.run_request_hook(
+                            [resource_path, self.requestor, options.api_user, self.group_name],
+                            on_done=publish
+                        )
+                    elif publish:
+                        publish()
                 # otherwise leave the partial upload in place, as is
                 # most likely a client that closed the connection
                 # while uploading a chunk, that was never finished
@@ -1366,6 +1718,7 @@ class ProxyHandler(AuthRequestHandler):
             self.CHUNK_SIZE = options.export_chunk_size
             tenant = tenant_from_url(self.request.uri)
             assert options.valid_tenant.match(tenant)
+            self.tenant = tenant
             self.backend_paths = options.config['backends']['disk'][backend]
             self.export_path_pattern = self.backend_paths['export_path']
             self.export_dir = self.export_path_pattern.replace(options.tenant_string_pattern, tenant)
@@ -1381,6 +1734,7 @@ class ProxyHandler(AuthRequestHandler):
         """Initiate internal async HTTP request to handle body.
         """
         self.error = None
+        self.internal_request = None
         try:
             # 0. If in maintenance mode, stop
             if options.maintenance_mode_enabled:
@@ -1389,7 +1743,10 @@ class ProxyHandler(AuthRequestHandler):
                 raise Exception(self.error)
             # 1. Set up internal variables, check method supported
             try:
-                self.chunks = tornado.queues.Queue(1)
+                self.chunks = ByteBudgetQueue(
+                    options.proxy_queue_max_bytes,
+                    options.proxy_queue_max_write
+                )
                 if self.request.method in ['HEAD', 'GET', 'DELETE']:
                     body = None
                 elif self.request.method == 'POST':
@@ -1398,7 +1755,13 @@ class ProxyHandler(AuthRequestHandler):
                     logging.error(self.error)
                     raise Exception
                 else:
-                    body = self.body_producer
+                    body = self.chunks
+                if self.endpoint in ('sync', 'info') and self.request.method not in ['HEAD', 'GET']:
+                    self.error = f'{self.request.method} not supported for {self.endpoint}'
+                    logging.error(self.error)
+                    self.set_status(405)
+                    self.finish()
+                    return
             except Exception as e:
                 logging.error('Could not set up internal async variables')
                 raise e
@@ -1454,7 +1817,9 @@ class ProxyHandler(AuthRequestHandler):
             try:
                 delimiter = self.endpoint if self.endpoint else self.namespace
                 resource = uri.split(f'/{delimiter}/')[-1]
-                if self.request.method in ('GET', 'HEAD', 'DELETE'):
+                if self.endpoint == 'sync':
+                    work_dir = self.import_dir
+                elif self.request.method in ('GET', 'HEAD', 'DELETE'):
                     work_dir = self.export_dir
                 elif self.request.method in ('PUT', 'PATCH'):
                     work_dir = self.import_dir
@@ -1471,6 +1836,7 @@ class ProxyHandler(AuthRequestHandler):
             try:
                 group_name, group_memberships = self.get_group_info(tenant, self.group_config, self.authnz)
                 self.enforce_group_logic(group_name, group_memberships, tenant, self.group_config)
+                self.group_name = group_name
             except Exception as e:
                 self.error = 'failed group check'
                 logging.error(e)
@@ -1536,18 +1902,29 @@ class ProxyHandler(AuthRequestHandler):
             # 8.3 build internal url
             self.resource = resource
             params = '?group=%s&chunk=%s&id=%s' % (group_name, chunk_num, upload_id)
-            internal_url = f'http://localhost:{options.port}/v1/{tenant}/{self.namespace}/upload_stream/{resource}{params}'
+            internal_uri = f'/v1/{tenant}/{self.namespace}/upload_stream/{resource}{params}'
+            internal_url = f'http://localhost:{options.port}{internal_uri}'
             # 9. Do async request to handle incoming data
             try:
                 if self.request.method in ('PUT', 'PATCH'):
                     # otherwise we are serving something
                     # so no need to pass data on
-                    self.fetch_future = AsyncHTTPClient().fetch(
-                        internal_url,
-                        method=self.request.method,
-                        body_producer=body,
-                        request_timeout=12000.0, # 3 hours max
-                        headers=headers)
+                    if options.proxy_in_process:
+                        self.internal_request = InProcessRequest(
+                            self.application.settings.get('internal_application', self.application),
+                            self.request.method,
+                            internal_uri,
+                            headers,
+                            context=self.request.connection.context
+                        )
+                        yield self.internal_request.start()
+                    else:
+                        self.fetch_future = self.application.settings['internal_http_client'].fetch(
+                            internal_url,
+                            method=self.request.method,
+                            body_queue=body,
+                            request_timeout=options.proxy_request_timeout,
+                            headers=headers)
             except Exception as e:
                 logging.error('Problem in async client')
                 logging.error(e)
@@ -1560,32 +1937,48 @@ class ProxyHandler(AuthRequestHandler):
             self.finish()
 
     @gen.coroutine
-    def body_producer(self, write):
-        while True:
-            chunk = yield self.chunks.get()
-            if chunk is None:
-                return
-            yield write(chunk)
+    def data_received(self, chunk):
+        if self.internal_request:
+            yield self.internal_request.data_received(chunk)
+        else:
+            yield self.chunks.put(chunk)
 
     @gen.coroutine
-    def data_received(self, chunk):
-        yield self.chunks.put(chunk)
+    def internal_response(self):
+        """Signal the end of the body, and wait for the internal request to finish."""
+        if self.internal_request:
+            response = yield self.internal_request.finish()
+        else:
+            yield self.chunks.put(None)
+            try:
+                response = yield self.fetch_future
+            except HTTPClientError as e:
+                # pass on errors from the upload handler, e.g. invalid gzip data
+                if e.response is None:
+                    raise
+                response = e.response
+        return response
+
+    def on_connection_close(self):
+        super(ProxyHandler, self).on_connection_close()
+        if self.internal_request:
+            self.internal_request.close()
+        elif hasattr(self, 'fetch_future'):
+            # end the internal request without completing its body
+            self.chunks.discard()
+            self.fetch_future.add_done_callback(lambda f: f.exception())
 
     @gen.coroutine
     def put(self, tenant, filename=None):
         """Called after entire body has been read."""
-        yield self.chunks.put(None)
-        # wait for request to finish.
-        response = yield self.fetch_future
+        response = yield self.internal_response()
         self.set_status(response.code)
         self.write(response.body)
 
     @gen.coroutine
     def patch(self, tenant, filename=None):
         """Called after entire body has been read."""
-        yield self.chunks.put(None)
-        # wait for request to finish.
-        response = yield self.fetch_future
+        response = yield self.internal_response()
         code = response.code
         body = response.body
         try:
@@ -1615,263 +2008,1163 @@ class ProxyHandler(AuthRequestHandler):
         (bool, <str,None>, <int,None>),
         (is_conformant, mime-type, size)
 
+        """
+        status, reason = self.check_export_policy(policy_config, filename, tenant, size, mime_type)
+        if not status:
+            self.message = reason
+        return status
+
+
+    def check_export_policy(self, policy_config, filename, tenant, size, mime_type):
+        """
+        Like enforce_export_policy, but without setting self.message,
+        so it can be used for many files concurrently.
+
+        Returns
+        -------
+        (bool, <str,None>), (is_conformant, reason if not)
+
         """
         status = False # until proven otherwise
+        reason = None
         try:
             file = os.path.basename(filename)
             check_filename(file, disallowed_start_chars=options.start_chars)
         except Exception as e:
-            self.message = 'Illegal export filename: %s' % file
-            logging.error(self.message)
-            return status
+            reason = 'Illegal export filename: %s' % file
+            logging.error(reason)
+            return status, reason
         if tenant in policy_config.keys():
             policy = policy_config[tenant]
         else:
             policy = policy_config['default']
         if not policy['enabled']:
             status = True
-            return status
+            return status, reason
         if '*' in policy['allowed_mime_types']:
             status = True
         else:
             status = True if mime_type in policy['allowed_mime_types'] else False
             if not status:
-                self.message = 'not allowed to export file with MIME type: %s' % mime_type
-                logging.error(self.message)
+                reason = 'not allowed to export file with MIME type: %s' % mime_type
+                logging.error(reason)
         if policy['max_size'] and size > policy['max_size']:
             logging.error('%s tried to export a file exceeding the maximum size limit', self.requestor)
-            self.message = 'File size exceeds maximum allowed for %s' % tenant
+            reason = 'File size exceeds maximum allowed for %s' % tenant
             status = False
-        return status
+        return status, reason
+
+
+    def get_file_metadata(self, filename, info=None):
+        """
+        Get the size, MIME type and mtime of a file.
+
+        The MIME type is found in tiers, from cheapest to most expensive:
+
+        1. by extension, if mapped in mime_type_extensions, and the
+           export policy does not depend on MIME types, since names
+           are chosen by users, and the policy must not trust them
+        2. from the metadata cache
+        3. with libmagic, from the first mime_type_header_bytes of the file
+
+        If mime_type_sniffing is policy, the last tier is skipped when
+        the export policy does not depend on MIME types, and files other
+        than directories are reported as application/octet-stream instead.
+
+        Parameters
+        ----------
+        filename: str
+        info: os.stat_result, optional, if the file has been stat-ed already
 
+        Returns
+        -------
+        (int, str, float)
 
-    def get_file_metadata(self, filename):
-        filename_raw_utf8 = filename.encode('utf-8')
+        """
+        if info is None:
+            info = os.stat(filename)
+        mime_type_needed = self.mime_type_needed()
+        if not mime_type_needed:
+            mime_type = extension_mime_type(filename, options.mime_type_extensions)
+            if mime_type:
+                metrics.incr('mime_type_by_extension')
+                return info.st_size, mime_type, info.st_mtime
+        cache = self.application.settings.get('metadata_cache')
+        if cache:
+            mime_type = cache.get(self.tenant, info)
+            if mime_type:
+                return info.st_size, mime_type, info.st_mtime
+        if options.mime_type_sniffing == 'policy' and not mime_type_needed:
+            metrics.incr('mime_type_sniffing_skipped')
+            mime_type = 'directory' if stat.S_ISDIR(info.st_mode) else 'application/octet-stream'
+            return info.st_size, mime_type, info.st_mtime
         mime_type = 'unknown'
         try:
-            mime_type = magic.from_file(filename_raw_utf8, mime=True)
-        except IsADirectoryError:
-            mime_type = 'directory'
+            mime_type = sniff_mime_type(filename, info, options.mime_type_header_bytes)
         except PermissionError:
             # so the API user can read, and delete files owned by others
             if os.path.isdir(filename):
-                subprocess.call(['sudo', 'chmod', '-R', 'g+r,o+rx', filename])
+                self.change_privileged_blocking('chmod', filename, add=0o045, recursive=True)
                 mime_type = 'directory'
             else:
-                subprocess.call(['sudo', 'chmod', 'g+r,o+rx', filename])
-                mime_type = magic.from_file(filename_raw_utf8, mime=True)
-        size = os.stat(filename).st_size
-        mtime = os.stat(filename).st_mtime
-        return size, mime_type, mtime
+                self.change_privileged_blocking('chmod', filename, add=0o045)
+                mime_type = sniff_mime_type(filename, info, options.mime_type_header_bytes)
+        if cache and mime_type != 'unknown':
+            cache.put(self.tenant, info, mime_type)
+        return info.st_size, mime_type, info.st_mtime
 
 
-    def list_files(self, path, tenant, root):
+    def mime_type_needed(self):
         """
-        List a directory.
+        Whether the export policy of the tenant depends on MIME
+        types, either to decide what can be exported, or to
+        decide what can be compressed.
 
-        Listing the export directory requires changing folder
-        and file modes in order to stat inodes.
+        """
+        policy = self.export_policy.get(self.tenant, self.export_policy['default'])
+        if policy['enabled'] and '*' not in policy.get('allowed_mime_types', ['*']):
+            return True
+        compression = policy.get('compression') or {}
+        if compression.get('enabled') and '*' not in compression.get('mime_types', ['text/*']):
+            return True
+        return False
 
-        Listing the import directory has its own special semantics.
-        The requestor is only allowed to list those group folders
-        which intersect with their group memberships. At the top
-        level folder, only folders are allowed.
 
-        When the backend does not have has_posix_ownership and/or
-        group logic, the API owns everything, and listing is simple.
+    def list_page(self, path, current_page, pagination_value, baseuri):
+        """
+        Get a page of directory entries, by page number.
+
+        Pages are found by listing the directory from the start,
+        in arbitrary order, so prefer cursors, see list_cursor_page.
+        Blocking, so run it on the export thread pool.
 
         Returns
         -------
-        dict
+        (list, str), entries, and the URI of the next page, if any
 
         """
-        current_page = 0
-        pagination_value = 100
-        disable_metadata = self.get_query_argument('disable_metadata', None)
-        try:
-            current_page = int(self.get_query_argument('page'))
-            pagination_value = int(self.get_query_argument('per_page'))
-        except HTTPError as e:
-            pass # use default value
-        except ValueError:
-            self.set_status(400)
-            self.message = 'next values must be integers'
-            raise Exception
-        if current_page < 0:
-            self.set_status(400)
-            self.message = 'next values are natural numbers'
-            raise Exception
-        if pagination_value > 1000:
-            self.set_status(400)
-            self.message = 'per_page cannot exceed 1000'
-            raise Exception
-        # arbitrary order
-        # if not returning what you want
-        # then try next page
-        dir_map = os.scandir(path)
         paginate = False
         files = []
         start_at = (current_page * pagination_value) - 1
         stop_at = start_at + pagination_value
         # only materialise the necessary entries
-        for num, entry in enumerate(dir_map):
-            if num <= start_at:
-                continue
-            elif num <= stop_at and num >= start_at:
-                files.append(entry)
-            elif num == stop_at + 1:
-                paginate = True
-                break # there is more
-        if len(files) == 0:
-            self.write({'files': [], 'page': None})
+        with os.scandir(path) as dir_map:
+            for num, entry in enumerate(dir_map):
+                if num <= start_at:
+                    continue
+                elif num <= stop_at and num >= start_at:
+                    files.append(entry)
+                elif num == stop_at + 1:
+                    paginate = True
+                    break # there is more
+        if paginate and not current_page:
+            next_page = 1
+        elif paginate:
+            next_page = int(current_page) + 1
         else:
-            if paginate and not current_page:
-                next_page = 1
-            elif paginate:
-                next_page = int(current_page) + 1
-            else:
-                next_page = None
-            baseuri = self.request.uri.split('?')[0]
-            nextref = f'{baseuri}?page={next_page}' if next_page else None
-            if self.export_max and len(files) > self.export_max:
-                self.set_status(400)
-                self.message = 'too many files, create a zip archive'
-                raise Exception
-            names = []
-            times = []
-            exportable = []
-            reasons = []
-            sizes = []
-            mimes = []
-            owners = []
-            etags = []
-            mtimes = []
-            if not self.group_config['enabled']:
-                default_owner = options.default_file_owner.replace(options.tenant_string_pattern, tenant)
-                for file in files:
-                    filepath = file.path
-                    try:
-                        size, mime_type, latest = self.get_file_metadata(filepath)
-                        status = self.enforce_export_policy(self.export_policy, filepath, tenant, size, mime_type)
-                        if status:
-                            reason = None
-                        else:
-                            reason = self.message
-                    except Exception as e:
-                        logging.error(e)
-                        logging.error('could not enforce export policy when listing dir')
-                        raise Exception
-                    path_stat = file.stat()
-                    etag = self.mtime_to_digest(latest)
-                    date_time = str(datetime.datetime.fromtimestamp(latest).isoformat())
-                    if self.has_posix_ownership:
-                        try:
-                            owner = pwd.getpwuid(path_stat.st_uid).pw_name
-                        except KeyError:
-                            try:
-                                default_owner_id = pwd.getpwnam(default_owner).pw_uid
-                                group_id = path_stat.st_gid
-                                os.chown(group_folder, file_api_user_id, group_id)
-                                owner = default_owner
-                            except (KeyError, Exception) as e:
-                                logging.error(e)
-                                logging.error(f'could not reset owner of {filepath} to default')
-                                owner = 'nobody'
-                    else:
-                        owner = options.api_user
-                    names.append(os.path.basename(filepath))
-                    times.append(date_time)
-                    exportable.append(status)
-                    reasons.append(reason)
-                    sizes.append(size)
-                    mimes.append(mime_type)
-                    owners.append(owner)
-                    etags.append(etag)
-                    mtimes.append(latest)
-            else: # then it is the TSD import dir
-                group_memberships = self.claims.get('groups')
-                if root:
-                    for file in files:
-                        if file.name in group_memberships:
-                            names.append(os.path.basename(file.path))
-                            times.append(None)
-                            exportable.append(False)
-                            reasons.append(None)
-                            sizes.append(None)
-                            mimes.append(None)
-                            owners.append(None)
-                else:
-                    for file in files:
-                        if not disable_metadata:
-                            path_stat = file.stat()
-                            latest = path_stat.st_mtime
-                            etag = self.mtime_to_digest(latest)
-                            date_time = str(datetime.datetime.fromtimestamp(latest).isoformat())
-                            size, mime_type, mtime = self.get_file_metadata(file.path)
-                        else:
-                            date_time = None
-                            etag = None
-                            size, mime_type, mtime = None, None, None
-                        names.append(file.name)
-                        times.append(date_time)
-                        exportable.append(False)
-                        reasons.append(None)
-                        sizes.append(size)
-                        mimes.append(mime_type)
-                        owners.append(None)
-                        etags.append(etag)
-                        mtimes.append(mtime)
-            file_info = []
-            for f, t, e, r, s, m, o, g, d in zip(
-                names, times, exportable, reasons, sizes, mimes, owners, etags, mtimes
-            ):
-                href = '%s/%s' % (baseuri, url_escape(f))
-                file_info.append(
-                    {
-                        'filename': f,
-                        'size': s,
-                        'modified_date': t,
-                        'href': href,
-                        'exportable': e,
-                        'reason': r,
-                        'mime-type': m,
-                        'owner': o,
-                        'etag': g,
-                        'mtime': d
-                    }
-                )
-            logging.info('%s listed %s', self.requestor, path)
-            self.write({'files': file_info, 'page': nextref})
+            next_page = None
+        nextref = f'{baseuri}?page={next_page}' if next_page else None
+        return files, nextref
 
-    def mtime_to_digest(self, mtime):
-        return hashlib.md5(str(mtime).encode('utf-8')).hexdigest()
 
-
-    def compute_etag(self):
+    def listing_ordering(self):
         """
-        If there is a file resource, compute the Etag header.
-        Custom values: md5sum of string value of last modified
-        time of file. Client can get this value before staring
-        a download, and then if they need to resume for some
-        reason, check that the resource has not changed in
-        the meantime. It is also cheap to compute.
+        Get the sort, order, name (a glob pattern), mtime_from and
+        mtime_to query arguments of a listing request, if any.
 
-        Note, since this is a strong validator/Etag, nginx will
-        strip it from the headers if it has been configured with
-        gzip compression for HTTP responses.
+        Returns
+        -------
+        dict, or None
 
         """
-        try:
-            if self.filepath:
-                mtime = os.stat(self.filepath).st_mtime
-                etag = self.mtime_to_digest(mtime)
-                return etag
-        except (Exception, AttributeError) as e:
+        ordering = {}
+        for arg in ['sort', 'order', 'name', 'mtime_from', 'mtime_to']:
+            value = self.get_query_argument(arg, None)
+            if value is not None:
+                ordering[arg] = value
+        if not ordering:
             return None
-        else:
-            return None
-
-
+        if ordering.get('sort', 'name') not in ['name', 'size', 'mtime']:
+            self.set_status(400)
+            self.message = 'sort must be one of: name, size, mtime'
+            raise Exception
+        if ordering.get('order', 'asc') not in ['asc', 'desc']:
+            self.set_status(400)
+            self.message = 'order must be one of: asc, desc'
+            raise Exception
+        try:
+            for arg in ['mtime_from', 'mtime_to']:
+                if arg in ordering:
+                    float(ordering[arg])
+        except ValueError:
+            self.set_status(400)
+            self.message = 'mtime_from and mtime_to must be numbers'
+            raise Exception
+        return ordering
+
+
+    def ordered_names(self, path, ordering):
+        """
+        Get the names in a directory, sorted and filtered, from
+        the directory index. Blocking, so run it on the export thread pool.
+
+        """
+        entries = self.application.settings['directory_index'].entries(path)
+        return order_names(
+            entries,
+            sort=ordering.get('sort', 'name'),
+            reverse=ordering.get('order') == 'desc',
+            name_glob=ordering.get('name'),
+            mtime_from=float(ordering['mtime_from']) if 'mtime_from' in ordering else None,
+            mtime_to=float(ordering['mtime_to']) if 'mtime_to' in ordering else None,
+        )
+
+
+    @gen.coroutine
+    def list_ordered_page(self, path, current_page, pagination_value, baseuri, ordering):
+        """
+        Get a page of sorted and filtered directory entries, by page number.
+
+        Returns
+        -------
+        (list, str), entries, and the URI of the next page, if any
+
+        """
+        names = yield self.run_io(self.ordered_names, path, ordering)
+        offset = current_page * pagination_value
+        page_names = names[offset:offset + pagination_value]
+        nextref = None
+        if offset + len(page_names) < len(names):
+            query = urlencode({'page': current_page + 1, 'per_page': pagination_value, **ordering})
+            nextref = f'{baseuri}?{query}'
+        files = yield self.run_io(page_entries, path, page_names)
+        return files, nextref
+
+
+    @gen.coroutine
+    def list_cursor_page(self, path, cursor, pagination_value, baseuri, ordering=None):
+        """
+        Get a page of directory entries, sorted by name, or as
+        specified by ordering, starting at the position encoded
+        in the cursor, or at the start.
+
+        When there are more pages, a snapshot of the names in the
+        directory is kept, so that the next pages can be sliced from it,
+        and so that the first page can be sliced from it too, as long
+        as the directory is unchanged, see ListingSnapshots. A new
+        snapshot is returned, rather than kept, so that it is only
+        kept if the page is sent, and not for 304 Not Modified.
+
+        Returns
+        -------
+        (list, str, tuple), entries, the URI of the next page, if any,
+        and the arguments of ListingSnapshots.create, for a new snapshot
+
+        """
+        snapshots = self.application.settings['listing_snapshots']
+        snapshot_key = f'{path}?{urlencode(sorted(ordering.items()))}' if ordering else path
+        if ordering:
+            list_names = functools.partial(self.ordered_names, path, ordering)
+            by_name = ordering.get('sort', 'name') == 'name' and ordering.get('order') != 'desc'
+        else:
+            list_names = functools.partial(scan_names, path)
+            by_name = True
+        snapshot_id, offset, names, new_snapshot = None, 0, None, None
+        # before listing, so that changes made meanwhile are seen next time
+        dir_mtime = (yield self.run_io(os.stat, path)).st_mtime_ns
+        if cursor:
+            try:
+                snapshot_id, offset, last_name = decode_cursor(cursor)
+            except ListingCursorError as e:
+                self.set_status(400)
+                self.message = e.message
+                raise Exception
+            names = snapshots.get(snapshot_id, snapshot_key)
+            if names is None:
+                metrics.incr('listing_snapshot_misses')
+                names = yield self.run_io(list_names)
+                offset = resume_offset(names, last_name, offset, by_name)
+                snapshot_id = None
+        else:
+            snapshot_id, names = snapshots.find(snapshot_key, dir_mtime)
+            if names is None:
+                names = yield self.run_io(list_names)
+        page_names = names[offset:offset + pagination_value]
+        next_offset = offset + len(page_names)
+        nextref = None
+        if next_offset < len(names):
+            if not snapshot_id:
+                snapshot_id = uuid4().hex
+                new_snapshot = (snapshot_key, names, dir_mtime, snapshot_id)
+            next_cursor = encode_cursor(snapshot_id, next_offset, page_names[-1])
+            query = urlencode({'cursor': next_cursor, 'per_page': pagination_value, **(ordering or {})})
+            nextref = f'{baseuri}?{query}'
+        files = yield self.run_io(page_entries, path, page_names)
+        return files, nextref, new_snapshot
+
+
+    @gen.coroutine
+    def map_io(self, func, items):
+        """
+        Call func for each item, on the export thread pool, at most
+        listing_concurrency at a time, and return the results in order.
+
+        """
+        semaphore = Semaphore(options.listing_concurrency)
+        @gen.coroutine
+        def call(item):
+            with (yield semaphore.acquire()):
+                result = yield self.run_io(func, item)
+            return result
+        results = yield [call(item) for item in items]
+        return results
+
+
+    def export_entry_info(self, file, tenant, default_owner):
+        """
+        Get the metadata of an entry in an export directory, and check
+        it against the export policy. Called concurrently by list_files.
+
+        Returns
+        -------
+        tuple
+
+        """
+        filepath = file.path
+        try:
+            path_stat = file.stat()
+            size, mime_type, latest = self.get_file_metadata(filepath, path_stat)
+            status, reason = self.check_export_policy(self.export_policy, filepath, tenant, size, mime_type)
+        except Exception as e:
+            logging.error(e)
+            logging.error('could not enforce export policy when listing dir')
+            raise Exception
+        etag = self.file_etag(filepath, path_stat)
+        date_time = str(datetime.datetime.fromtimestamp(latest).isoformat())
+        if self.has_posix_ownership:
+            try:
+                owner = pwd.getpwuid(path_stat.st_uid).pw_name
+            except KeyError:
+                try:
+                    default_owner_id = pwd.getpwnam(default_owner).pw_uid
+                    group_id = path_stat.st_gid
+                    os.chown(filepath, default_owner_id, group_id, follow_symlinks=False)
+                    owner = default_owner
+                except (KeyError, Exception) as e:
+                    logging.error(e)
+                    logging.error(f'could not reset owner of {filepath} to default')
+                    owner = 'nobody'
+        else:
+            owner = options.api_user
+        return (
+            os.path.basename(filepath), date_time, status, reason,
+            size, mime_type, owner, etag, latest
+        )
+
+
+    def export_file_info(self, name, tenant):
+        """
+        Get the metadata of a file in the export directory, by name,
+        and check it against the export policy. Called concurrently
+        by write_file_info.
+
+        Returns
+        -------
+        dict
+
+        """
+        info = {'filename': name}
+        try:
+            check_filename(name, disallowed_start_chars=options.start_chars)
+            filepath = os.path.normpath(f'{self.export_dir}/{name}')
+            assert filepath.startswith(os.path.normpath(self.export_dir) + '/')
+            assert self.is_reserved_resource(self.export_dir, name)
+        except (IllegalFilenameException, AssertionError):
+            info['error'] = 'Illegal filename'
+            return info
+        try:
+            path_stat = os.stat(filepath)
+            size, mime_type, mtime = self.get_file_metadata(filepath, path_stat)
+        except FileNotFoundError:
+            info['error'] = 'File does not exist'
+            return info
+        status, reason = self.check_export_policy(self.export_policy, filepath, tenant, size, mime_type)
+        info.update({
+            'size': size,
+            'modified_date': datetime.datetime.fromtimestamp(mtime).isoformat(),
+            'exportable': status,
+            'reason': reason,
+            'mime-type': mime_type,
+            'etag': self.file_etag(filepath, path_stat),
+            'mtime': mtime,
+        })
+        return info
+
+
+    @gen.coroutine
+    def write_file_info(self):
+        """
+        Return information about many files in the export directory,
+        named with repeated name query arguments, in one response:
+        the same as HEAD, and listings, report for single files.
+
+        Metadata is collected concurrently, on the export thread pool.
+        Files which do not exist, or which have illegal names, are
+        reported with an error, instead of failing the whole request.
+
+        """
+        if not self.allow_info:
+            self.message = 'Method not allowed'
+            self.set_status(403)
+            raise Exception
+        names = self.get_query_arguments('name')
+        if not names:
+            self.message = 'No files named, use the name query argument'
+            self.set_status(400)
+            raise Exception
+        if len(names) > options.export_info_max_files:
+            self.message = f'Too many files named, max: {options.export_info_max_files}'
+            self.set_status(400)
+            raise Exception
+        file_info = yield self.map_io(
+            functools.partial(self.export_file_info, tenant=self.tenant), names
+        )
+        logging.info('%s checked %d files in %s', self.requestor, len(names), self.export_dir)
+        self.write({'files': file_info})
+
+
+    def import_entry_info(self, file):
+        """
+        Get the metadata of an entry in the import directory.
+        Called concurrently by list_files.
+
+        Returns
+        -------
+        tuple
+
+        """
+        path_stat = file.stat()
+        latest = path_stat.st_mtime
+        etag = self.file_etag(file.path, path_stat)
+        date_time = str(datetime.datetime.fromtimestamp(latest).isoformat())
+        size, mime_type, mtime = self.get_file_metadata(file.path, path_stat)
+        return date_time, etag, size, mime_type, mtime
+
+
+    @gen.coroutine
+    def listing_entries(self, files, tenant, root, baseuri, disable_metadata=None):
+        """
+        Get the listing entries of some directory entries,
+        collecting their metadata concurrently.
+
+        Returns
+        -------
+        list of dict
+
+        """
+        names = []
+        times = []
+        exportable = []
+        reasons = []
+        sizes = []
+        mimes = []
+        owners = []
+        etags = []
+        mtimes = []
+        if not self.group_config['enabled']:
+            default_owner = options.default_file_owner.replace(options.tenant_string_pattern, tenant)
+            entries = yield self.map_io(
+                functools.partial(
+                    self.export_entry_info, tenant=tenant, default_owner=default_owner
+                ),
+                files
+            )
+            for name, date_time, status, reason, size, mime_type, owner, etag, latest in entries:
+                names.append(name)
+                times.append(date_time)
+                exportable.append(status)
+                reasons.append(reason)
+                sizes.append(size)
+                mimes.append(mime_type)
+                owners.append(owner)
+                etags.append(etag)
+                mtimes.append(latest)
+        else: # then it is the TSD import dir
+            group_memberships = self.claims.get('groups')
+            if root:
+                for file in files:
+                    if file.name in group_memberships:
+                        names.append(os.path.basename(file.path))
+                        times.append(None)
+                        exportable.append(False)
+                        reasons.append(None)
+                        sizes.append(None)
+                        mimes.append(None)
+                        owners.append(None)
+                        etags.append(None)
+                        mtimes.append(None)
+            else:
+                if not disable_metadata:
+                    entries = yield self.map_io(self.import_entry_info, files)
+                else:
+                    entries = [(None, None, None, None, None)] * len(files)
+                for file, (date_time, etag, size, mime_type, mtime) in zip(files, entries):
+                    names.append(file.name)
+                    times.append(date_time)
+                    exportable.append(False)
+                    reasons.append(None)
+                    sizes.append(size)
+                    mimes.append(mime_type)
+                    owners.append(None)
+                    etags.append(etag)
+                    mtimes.append(mtime)
+        file_info = []
+        for f, t, e, r, s, m, o, g, d in zip(
+            names, times, exportable, reasons, sizes, mimes, owners, etags, mtimes
+        ):
+            href = '%s/%s' % (baseuri, url_escape(f))
+            file_info.append(
+                {
+                    'filename': f,
+                    'size': s,
+                    'modified_date': t,
+                    'href': href,
+                    'exportable': e,
+                    'reason': r,
+                    'mime-type': m,
+                    'owner': o,
+                    'etag': g,
+                    'mtime': d
+                }
+            )
+        return file_info
+
+
+    @gen.coroutine
+    def stream_listing(self, path, tenant, root, baseuri, ordering=None,
+                       batch_size=100, disable_metadata=None):
+        """
+        List a whole directory as NDJSON, one entry per line.
+
+        Entries are read from the directory in batches of batch_size,
+        (the per_page query argument), and each batch is written, and
+        flushed, as soon as its metadata has been collected, so memory
+        use does not depend on the size of the directory. Entries are
+        in directory order, unless ordering is given, in which case
+        the names are sorted and filtered with the directory index first.
+
+        The export_max_num_list limit of the backend applies to the
+        whole listing: the batches are read until it is exceeded, or
+        the directory is exhausted, before anything is written, so the
+        client gets a 400, instead of a truncated listing.
+
+        """
+        names = None
+        if ordering:
+            names = yield self.run_io(self.ordered_names, path, ordering)
+        batches = entry_batches(path, batch_size, names)
+        self.set_header('Content-Type', 'application/x-ndjson')
+        num_entries, started = 0, False
+        pending = []
+        try:
+            if self.export_max:
+                num_names = 0
+                while num_names <= self.export_max:
+                    files = yield self.run_io(next, batches, None)
+                    if files is None:
+                        break
+                    pending.append(files)
+                    num_names += len(files)
+                if num_names > self.export_max:
+                    self.set_status(400)
+                    self.message = 'too many files, export the directory with ?archive=tar, tar.gz or zip'
+                    raise Exception
+            while True:
+                if pending:
+                    files = pending.pop(0)
+                else:
+                    files = yield self.run_io(next, batches, None)
+                if files is None:
+                    break
+                file_info = yield self.listing_entries(files, tenant, root, baseuri, disable_metadata)
+                self.write(''.join(json.dumps(entry) + '\n' for entry in file_info))
+                started = True
+                yield self.flush()
+                num_entries += len(file_info)
+        except Exception as e:
+            if started:
+                # the client cannot tell a truncated listing from a complete one
+                self.request.connection.close()
+            raise e
+        finally:
+            yield self.run_io(batches.close)
+        logging.info('%s listed %s, %d entries', self.requestor, path, num_entries)
+
+
+    @gen.coroutine
+    def list_files(self, path, tenant, root):
+        """
+        List a directory.
+
+        Listing the export directory requires changing folder
+        and file modes in order to stat inodes.
+
+        Listing the import directory has its own special semantics.
+        The requestor is only allowed to list those group folders
+        which intersect with their group memberships. At the top
+        level folder, only folders are allowed.
+
+        When the backend does not have has_posix_ownership and/or
+        group logic, the API owns everything, and listing is simple.
+
+        Listings are paginated with opaque cursors, included in the
+        page URI of the response, or with the page query parameter.
+        They can be sorted with sort=name|size|mtime, and order=asc|desc,
+        and filtered with name=<glob>, mtime_from=<time> and mtime_to=<time>.
+
+        Each page has a weak ETag, see listing_etag, so clients can
+        revalidate it with If-None-Match, and get 304 Not Modified,
+        without the metadata of the entries being collected.
+
+        With format=ndjson, the whole directory is streamed instead,
+        one entry per line, see stream_listing.
+
+        Returns
+        -------
+        dict
+
+        """
+        disable_metadata = self.get_query_argument('disable_metadata', None)
+        cursor = self.get_query_argument('cursor', None)
+        listing_format = self.get_query_argument('format', 'json')
+        if listing_format not in ['json', 'ndjson']:
+            self.set_status(400)
+            self.message = 'format must be one of: json, ndjson'
+            raise Exception
+        try:
+            current_page = self.get_query_argument('page', None)
+            current_page = int(current_page) if current_page is not None else None
+            pagination_value = int(self.get_query_argument('per_page', 100))
+        except ValueError:
+            self.set_status(400)
+            self.message = 'next values must be integers'
+            raise Exception
+        if (current_page is not None and current_page < 0) or pagination_value < 1:
+            self.set_status(400)
+            self.message = 'next values are natural numbers'
+            raise Exception
+        if pagination_value > 1000:
+            self.set_status(400)
+            self.message = 'per_page cannot exceed 1000'
+            raise Exception
+        ordering = self.listing_ordering()
+        baseuri = self.request.uri.split('?')[0]
+        new_snapshot = None
+        if listing_format == 'ndjson':
+            yield self.stream_listing(
+                path, tenant, root, baseuri, ordering, pagination_value, disable_metadata
+            )
+            return
+        if current_page is not None and ordering:
+            files, nextref = yield self.list_ordered_page(
+                path, current_page, pagination_value, baseuri, ordering
+            )
+        elif current_page is not None:
+            files, nextref = yield self.run_io(
+                self.list_page, path, current_page, pagination_value, baseuri
+            )
+        else:
+            files, nextref, new_snapshot = yield self.list_cursor_page(
+                path, cursor, pagination_value, baseuri, ordering
+            )
+        etag = yield self.run_io(self.listing_etag, path, files)
+        if self.check_not_modified(etag, weak=True):
+            metrics.incr('listing_not_modified')
+            self.set_status(304)
+            return
+        if new_snapshot:
+            self.application.settings['listing_snapshots'].create(*new_snapshot)
+        if len(files) == 0:
+            self.write({'files': [], 'page': None})
+        else:
+            if self.export_max and len(files) > self.export_max:
+                self.set_status(400)
+                self.message = 'too many files, export the directory with ?archive=tar, tar.gz or zip'
+                raise Exception
+            file_info = yield self.listing_entries(files, tenant, root, baseuri, disable_metadata)
+            logging.info('%s listed %s', self.requestor, path)
+            self.write({'files': file_info, 'page': nextref})
+
+    def can_sendfile(self):
+        """
+        Whether the response body can be copied from the file
+        to the client socket in the kernel - not possible for TLS.
+
+        """
+        connection = self.request.connection
+        return (
+            options.export_sendfile
+            and hasattr(os, 'sendfile')
+            and isinstance(connection, HTTP1Connection)
+            and not isinstance(connection.stream, SSLIOStream)
+        )
+
+
+    @gen.coroutine
+    def write_chunks(self, fd, offset, count):
+        """
+        Send count bytes from the open file, starting at offset,
+        in chunks. The next chunk is read on the export thread pool
+        while the current one is being written to the client.
+
+        """
+        yield self.run_io(fd.seek, offset)
+        remaining = count
+        pending = self.run_io(fd.read, min(self.CHUNK_SIZE, remaining))
+        try:
+            while remaining > 0:
+                data = yield pending
+                pending = None
+                if not data:
+                    raise Exception(f'{self.filepath} shorter than expected')
+                remaining -= len(data)
+                if remaining > 0:
+                    pending = self.run_io(fd.read, min(self.CHUNK_SIZE, remaining))
+                self.write(data)
+                yield self.flush()
+        finally:
+            # the file is closed after the last read has completed
+            if pending:
+                yield pending
+
+
+    def archive_member_exportable(self, tenant, filepath):
+        """Apply the export policy to a file which is to be archived."""
+        try:
+            size, mime_type, mtime = self.get_file_metadata(filepath)
+            status, reason = self.check_export_policy(self.export_policy, filepath, tenant, size, mime_type)
+            return status
+        except Exception as e:
+            logging.error(e)
+            return False
+
+
+    @gen.coroutine
+    def write_archive(self, path, archive_format, tenant):
+        """
+        Stream an archive of a directory, as it is generated,
+        without a temporary file. Files which do not conform
+        to the export policy are left out, and symlinks are ignored.
+
+        The archive is written by a thread of the producer thread pool,
+        which is paused while the client is not keeping up, see run_producer.
+
+        """
+        content_type, extension = ARCHIVE_FORMATS[archive_format]
+        name = url_escape(os.path.basename(path), plus=False)
+        writer = ArchiveWriter(IOLoop.current(), self.CHUNK_SIZE)
+        done = self.run_producer(
+            write_archive, writer, path, archive_format,
+            functools.partial(self.archive_member_exportable, tenant)
+        )
+        self.set_header('Content-Type', content_type)
+        self.set_header('Content-Disposition', f"attachment; filename*=UTF-8''{name}.{extension}")
+        self.message = 'Could not create archive'
+        num_members = yield self.write_from(writer, done)
+        logging.info(
+            'user: %s, exported %s as %s archive, with %d files',
+            self.requestor, path, archive_format, num_members
+        )
+
+
+    @gen.coroutine
+    def write_manifest(self, filename=None):
+        """
+        Stream a recursive manifest of a directory tree in the import
+        directory, as NDJSON, so that sync clients can find out which
+        files differ from their local copies in one request.
+
+        Each line describes one file: path (relative to the requested
+        directory), size, mtime, etag, and, if requested with the hash
+        query argument, a hash of the content. It is written on the
+        producer thread pool, see run_producer.
+
+        """
+        if not self.allow_list:
+            self.message = 'Method not allowed'
+            self.set_status(403)
+            raise Exception
+        hash_name = self.get_query_argument('hash', None)
+        if hash_name and hash_name not in MANIFEST_HASHES:
+            self.message = f'hash must be one of: {", ".join(MANIFEST_HASHES)}'
+            self.set_status(400)
+            raise Exception
+        resource = url_unescape(self.resource) if filename else ''
+        if self.group_config['enabled'] and resource.split('/')[0] != self.group_name:
+            self.message = 'Only group folders can be synced'
+            self.set_status(403)
+            raise Exception
+        base = os.path.normpath(self.import_dir)
+        path = os.path.normpath(f'{base}/{resource}')
+        is_dir = yield self.run_io(os.path.isdir, path)
+        if not is_dir or os.path.commonpath([base, path]) != base:
+            self.message = 'Directory not found'
+            self.set_status(404)
+            raise Exception
+        writer = ArchiveWriter(IOLoop.current(), 65536)
+        done = self.run_producer(
+            write_manifest, writer, path, self.file_etag, hash_name, options.start_chars,
+            self.application.settings.get('content_digests')
+        )
+        self.set_header('Content-Type', 'application/x-ndjson')
+        self.message = 'Could not create manifest'
+        num_files = yield self.write_from(writer, done)
+        logging.info('%s got a manifest of %s, with %d files', self.requestor, path, num_files)
+
+
+    @gen.coroutine
+    def write_from(self, writer, done):
+        """
+        Send the chunks produced by a worker thread, through an
+        ArchiveWriter, and return the result of the worker.
+
+        """
+        started = False
+        try:
+            while True:
+                chunk = yield writer.get()
+                if chunk is None:
+                    break
+                self.write(chunk)
+                started = True
+                yield self.flush()
+        except Exception as e:
+            writer.abort()
+            IOLoop.current().add_future(done, lambda f: f.exception())
+            if started:
+                # the client cannot tell a truncated body from a complete one
+                self.request.connection.close()
+            raise e
+        result = yield done
+        return result
+
+
+    def negotiate_compression(self, tenant, mime_type, size):
+        """
+        Choose a content encoding for a file, if the export policy
+        enables compression for its MIME type, and the client accepts it.
+
+        Range requests are always served from the uncompressed file.
+
+        Returns
+        -------
+        str or None
+
+        """
+        policy = self.export_policy.get(tenant, self.export_policy['default'])
+        compression = policy.get('compression') or {}
+        if not compression.get('enabled'):
+            return None
+        mime_types = compression.get('mime_types', ['text/*'])
+        if not any(fnmatch.fnmatch(mime_type, pattern) for pattern in mime_types):
+            return None
+        self.set_header('Vary', 'Accept-Encoding')
+        if 'Range' in self.request.headers or size < compression.get('min_size', 1024):
+            return None
+        return negotiate_encoding(
+            self.request.headers.get('Accept-Encoding', ''), COMPRESSION_ENCODINGS
+        )
+
+
+    @gen.coroutine
+    def write_compressed(self, tenant, encoding, mtime):
+        """
+        Send the file, compressed on the producer thread pool, see
+        run_producer. If a cache directory is configured, a previously
+        compressed copy is sent if there is one, and otherwise one is
+        created for next time.
+
+        The ETag is specific to the encoding, as required for
+        caches to keep different representations apart.
+
+        """
+        validator = self.compute_etag()
+        cache = self.application.settings.get('compression_cache')
+        cache_path = None
+        if cache:
+            cache_path = yield self.run_io(cache.path, tenant, self.filepath, validator, encoding)
+            try:
+                fd = yield self.run_io(open, cache_path, 'rb')
+            except FileNotFoundError:
+                fd = None
+            if fd:
+                metrics.incr('export_compression_cache_hits')
+                cache.touch(cache_path)
+                self.set_header('Content-Encoding', encoding)
+                self.set_header('Etag', f'"{validator}-{encoding}"')
+                try:
+                    info = yield self.run_io(os.fstat, fd.fileno())
+                    self.set_header('Content-Length', info.st_size)
+                    if self.can_sendfile():
+                        yield self.start_sendfile_body()
+                        yield self.sendfile(fd, 0, info.st_size)
+                    else:
+                        yield self.flush()
+                        yield self.write_chunks(fd, 0, info.st_size)
+                finally:
+                    yield self.run_io(fd.close)
+                return
+            metrics.incr('export_compression_cache_misses')
+        writer = ArchiveWriter(IOLoop.current(), self.CHUNK_SIZE)
+        done = self.run_producer(write_compressed, writer, self.filepath, encoding, cache, cache_path)
+        self.set_header('Content-Encoding', encoding)
+        self.set_header('Etag', f'"{validator}-{encoding}"')
+        yield self.write_from(writer, done)
+
+
+    @gen.coroutine
+    def write_byte_ranges(self, fd, ranges, size, mime_type):
+        """
+        Send a multipart/byteranges response, with one part per range,
+        seeking to the start of each range in the open file in turn.
+
+        """
+        boundary = uuid4().hex
+        part_headers = [
+            (
+                f'\r\n--{boundary}\r\n'
+                f'Content-Type: {mime_type}\r\n'
+                f'Content-Range: bytes {start}-{end}/{size}\r\n\r\n'
+            ).encode('utf-8')
+            for start, end in ranges
+        ]
+        closing = f'\r\n--{boundary}--\r\n'.encode('utf-8')
+        content_length = len(closing) + sum(
+            len(part_header) + end - start + 1
+            for part_header, (start, end) in zip(part_headers, ranges)
+        )
+        self.set_status(206)
+        self.set_header('Content-Type', f'multipart/byteranges; boundary={boundary}')
+        self.set_header('Content-Length', content_length)
+        use_sendfile = self.can_sendfile()
+        if use_sendfile:
+            yield self.start_sendfile_body()
+        for part_header, (start, end) in zip(part_headers, ranges):
+            self.write(part_header)
+            yield self.flush()
+            if use_sendfile:
+                yield self.sendfile(fd, start, end - start + 1)
+            else:
+                yield self.write_chunks(fd, start, end - start + 1)
+        self.write(closing)
+
+
+    def start_sendfile_body(self):
+        """
+        Flush the response headers, before the body is sent with sendfile.
+
+        Bytes copied to the socket in the kernel are not seen by tornado,
+        so the body cannot be framed by a Content-Length, and is sent with
+        chunked transfer encoding instead (see sendfile). HTTP/1.0 clients
+        get a body which ends when the connection is closed.
+
+        Returns
+        -------
+        Future
+
+        """
+        self.clear_header('Content-Length')
+        return self.flush()
+
+
+    @gen.coroutine
+    def wait_writable(self, fd, timeout=60):
+        """Wait, on the event loop, for a socket to become writable."""
+        io_loop = IOLoop.current()
+        ready = Future()
+        def on_writable(fd, events):
+            if not ready.done():
+                ready.set_result(None)
+        io_loop.add_handler(fd, on_writable, IOLoop.WRITE)
+        try:
+            yield gen.with_timeout(datetime.timedelta(seconds=timeout), ready)
+        finally:
+            io_loop.remove_handler(fd)
+
+
+    @gen.coroutine
+    def sendfile(self, fd, offset, count):
+        """
+        Send count bytes from the open file, starting at offset, as one
+        chunk of the response body, using os.sendfile.
+
+        Only the sendfile calls run on the export thread pool, and they
+        return as soon as the socket buffer is full. Waiting for the
+        client to read is done on the event loop, so slow clients
+        do not hold on to worker threads.
+
+        The response headers must have been flushed with start_sendfile_body.
+
+        """
+        stream = self.request.connection.stream
+        chunked = self.request.version == 'HTTP/1.1'
+        if chunked:
+            yield stream.write(f'{count:x}\r\n'.encode('ascii'))
+        # the event loop watches the socket for tornado already,
+        # so we watch a duplicate of its file descriptor
+        sock_fd = os.dup(stream.socket.fileno())
+        remaining = count
+        slice_size = max(self.CHUNK_SIZE, 8388608)
+        try:
+            while remaining > 0:
+                sent, eof = yield self.run_io(
+                    sendfile_nonblocking, sock_fd, fd.fileno(),
+                    offset, min(remaining, slice_size)
+                )
+                offset += sent
+                remaining -= sent
+                if eof:
+                    raise Exception(f'{self.filepath} shorter than expected')
+                if remaining > 0 and sent < min(remaining + sent, slice_size):
+                    yield self.wait_writable(sock_fd)
+        except Exception as e:
+            # the client cannot make sense of the rest of the response
+            stream.close()
+            raise e
+        finally:
+            os.close(sock_fd)
+        if chunked:
+            yield stream.write(b'\r\n')
+
+
+    def mtime_to_digest(self, mtime):
+        return hashlib.md5(str(mtime).encode('utf-8')).hexdigest()
+
+
+    def file_etag(self, filepath, info):
+        """
+        Get the ETag of a file: the hash of its content, if it has
+        been stored (see content_etags), and otherwise the
+        digest of its mtime, in which case the file is queued for the
+        background hasher, if enabled. Blocking.
+
+        """
+        if options.content_etags:
+            digest = self.application.settings['content_digests'].get(info, options.content_etag_hash)
+            if digest:
+                return digest
+            hasher = self.application.settings.get('content_hasher')
+            if hasher:
+                hasher.submit(filepath)
+        return self.mtime_to_digest(info.st_mtime)
+
+
+    def export_file_metadata(self, filepath):
+        """
+        Get the size, MIME type, mtime, and ETag, of a file
+        which is being exported, or inspected. Blocking.
+
+        Returns
+        -------
+        (int, str, float, str)
+
+        """
+        info = os.stat(filepath)
+        size, mime_type, mtime = self.get_file_metadata(filepath, info)
+        return size, mime_type, mtime, self.file_etag(filepath, info)
+
+
+    def listing_etag(self, path, files):
+        """
+        Compute the ETag of a page of a directory listing, from the
+        mtime of the directory, the query arguments (cursor, or page,
+        page size, ordering, and filters), the group memberships of the
+        requestor, and the name, size, mtime and ctime of each entry on
+        the page - the ctime also changes when the ownership, or stored
+        hash, of a file changes. Entries are stat-ed once, so collecting
+        their metadata afterwards costs no more. Blocking.
+
+        It is a weak ETag, since the cursor to the next page refers to
+        a new snapshot when a listing is started in a changed directory.
+        It is computed before a new snapshot is kept, and, for an unchanged
+        directory, from the existing snapshot, so revalidating the first
+        page costs no more than stat-ing the entries on it.
+
+        """
+        arguments = sorted(
+            (name, value.decode('utf-8', 'replace'))
+            for name, values in self.request.query_arguments.items()
+            for value in values
+        )
+        groups = sorted(self.claims.get('groups') or [])
+        _hash = hashlib.md5()
+        _hash.update(json.dumps([os.stat(path).st_mtime_ns, arguments, groups]).encode('utf-8'))
+        for entry in files:
+            try:
+                info = entry.stat()
+                _hash.update(
+                    f'{entry.name}/{info.st_size}/{info.st_mtime_ns}/{info.st_ctime_ns}\n'.encode('utf-8')
+                )
+            except FileNotFoundError:
+                _hash.update(f'{entry.name}\n'.encode('utf-8'))
+        return _hash.hexdigest()
+
+
+    def check_not_modified(self, etag, mtime=None, weak=False):
+        """
+        Set the validators of a response - the Etag, and Last-Modified,
+        if mtime is given - and evaluate the preconditions of a
+        conditional GET, or HEAD: If-None-Match, or, only if that is
+        absent, If-Modified-Since (RFC 7232, section 6).
+
+        Returns
+        -------
+        bool, whether to respond with 304 Not Modified
+
+        """
+        self.set_header('Etag', f'W/"{etag}"' if weak else f'"{etag}"')
+        if mtime is not None:
+            self.set_header('Last-Modified', datetime.datetime.utcfromtimestamp(mtime))
+        if 'If-None-Match' in self.request.headers:
+            return self.check_etag_header()
+        since = self.request.headers.get('If-Modified-Since')
+        if mtime is None or not since:
+            return False
+        try:
+            return int(mtime) <= email.utils.mktime_tz(email.utils.parsedate_tz(since))
+        except (TypeError, ValueError, OverflowError):
+            return False
+
+
+    def compute_etag(self):
+        """
+        If there is a file resource, compute the Etag header.
+        Custom values: the hash of the content of the file, if it
+        is stored with the file (see file_etag), otherwise md5sum of
+        string value of last modified time of file, which is
+        cheap to compute. Client can get this value before staring
+        a download, and then if they need to resume for some
+        reason, check that the resource has not changed in
+        the meantime.
+
+        Note, since this is a strong validator/Etag, nginx will
+        strip it from the headers if it has been configured with
+        gzip compression for HTTP responses.
+
+        """
+        try:
+            if self.filepath:
+                # use the etag found when serving the file, if any
+                etag = getattr(self, 'etag', None)
+                if etag is None:
+                    etag = self.file_etag(self.filepath, os.stat(self.filepath))
+                return etag
+        except (Exception, AttributeError) as e:
+            return None
+        else:
+            return None
+
+
     @gen.coroutine
     def get(self, tenant, filename=None):
         """
@@ -1884,6 +3177,18 @@ class ProxyHandler(AuthRequestHandler):
 
         3. run the list_files method
 
+        If exporting a dir as an archive (?archive=tar, tar.gz, zip):
+
+        3. stream the archive with the write_archive method
+
+        If getting a manifest of an import dir (sync endpoint):
+
+        3. stream the manifest with the write_manifest method
+
+        If getting information about many files (info endpoint):
+
+        3. run the write_file_info method
+
         If serving a file:
 
         3. check the filename
@@ -1891,25 +3196,61 @@ class ProxyHandler(AuthRequestHandler):
         5. enforce the export policy
         6. check if a byte range is being requested
         6. set the mime type
-        7. serve the bytes requested (explicitly, or implicitly), chunked
+        7. respond with 304 Not Modified, if the client has a current copy
+           (If-None-Match, or If-Modified-Since)
+        8. serve the bytes requested (explicitly, or implicitly), chunked,
+           with multiple ranges as a multipart/byteranges response
+           or compressed, if negotiated with the client
+
+        File system access runs on the export thread pool.
 
         """
         self.message = 'Unknown error, please contact TSD'
+        fd = None
         try:
             assert options.valid_tenant.match(tenant)
+            if self.endpoint == 'sync':
+                yield self.write_manifest(filename)
+                return
+            if self.endpoint == 'info':
+                yield self.write_file_info()
+                return
             self.path = self.export_dir
             resource = url_unescape(self.resource)
-            if not filename or os.path.isdir(f'{self.path}/{resource}'):
+            is_dir = yield self.run_io(os.path.isdir, f'{self.path}/{resource}')
+            archive_format = self.get_query_argument('archive', None)
+            if archive_format:
+                if not self.allow_export:
+                    self.message = 'Method not allowed'
+                    self.set_status(403)
+                    raise Exception
+                if archive_format not in ARCHIVE_FORMATS:
+                    self.message = f'archive must be one of: {", ".join(ARCHIVE_FORMATS)}'
+                    self.set_status(400)
+                    raise Exception
+                base = os.path.normpath(self.path)
+                if filename:
+                    archive_path = os.path.normpath(f'{base}/{resource}')
+                else:
+                    archive_path, is_dir = base, True
+                if not is_dir or os.path.commonpath([base, archive_path]) != base:
+                    self.message = 'Only directories can be exported as archives'
+                    self.set_status(400)
+                    raise Exception
+                yield self.write_archive(archive_path, archive_format, tenant)
+                return
+            if not filename or is_dir:
                 if not self.allow_list:
                     self.message = 'Method not allowed'
                     self.set_status(403)
                     raise Exception
-                if filename and os.path.isdir(f'{self.path}/{resource}'):
+                if filename and is_dir:
                     self.path += f'/{resource}'
                 root = True if self.resource == self.path else False
-                self.list_files(self.path, tenant, root)
+                yield self.list_files(self.path, tenant, root)
                 return
-            if not os.path.lexists(f'{self.path}/{resource}'):
+            exists = yield self.run_io(os.path.lexists, f'{self.path}/{resource}')
+            if not exists:
                     self.set_status(404)
                     self.message = 'Resource not found'
                     raise Exception
@@ -1924,13 +3265,15 @@ class ProxyHandler(AuthRequestHandler):
                 self.set_status(403)
                 raise Exception
             self.filepath = '%s/%s' % (self.path, secured_filename)
-            if not os.path.lexists(self.filepath):
+            exists = yield self.run_io(os.path.lexists, self.filepath)
+            if not exists:
                 logging.error('%s tried to access a file that does not exist', self.requestor)
                 self.set_status(404)
                 self.message = 'File does not exist'
                 raise Exception
             try:
-                size, mime_type, mtime = self.get_file_metadata(self.filepath)
+                size, mime_type, mtime, etag = yield self.run_io(self.export_file_metadata, self.filepath)
+                self.mtime, self.etag = mtime, etag
                 status = self.enforce_export_policy(self.export_policy, self.filepath, tenant, size, mime_type)
                 assert status
             except (Exception, AssertionError) as e:
@@ -1939,74 +3282,74 @@ class ProxyHandler(AuthRequestHandler):
                 raise Exception
             self.set_header('Content-Type', mime_type)
             self.set_header('Modified-Time', str(mtime))
-            if 'Range' not in self.request.headers:
+            encoding = self.negotiate_compression(tenant, mime_type, size)
+            if self.check_not_modified(f'{etag}-{encoding}' if encoding else etag, mtime):
+                metrics.incr('export_not_modified')
+                self.set_status(304)
+                return
+            if encoding:
+                yield self.write_compressed(tenant, encoding, mtime)
+            elif 'Range' not in self.request.headers:
                 self.set_header('Content-Length', size)
-                self.flush()
-                fd = open(self.filepath, "rb")
-                data = fd.read(self.CHUNK_SIZE)
-                while data:
-                    self.write(data)
+                fd = yield self.run_io(open, self.filepath, 'rb')
+                if self.can_sendfile():
+                    yield self.start_sendfile_body()
+                    yield self.sendfile(fd, 0, size)
+                else:
                     yield self.flush()
-                    data = fd.read(self.CHUNK_SIZE)
-                fd.close()
+                    yield self.write_chunks(fd, 0, size)
             elif 'Range' in self.request.headers:
                 if 'If-Range' in self.request.headers:
-                    provided_etag = self.request.headers['If-Range']
-                    computed_etag = self.compute_etag()
-                    if provided_etag != computed_etag:
+                    # a strong comparison, so weak etags never match, and
+                    # unquoted etags are accepted, as they used to be
+                    provided_etag = self.request.headers['If-Range'].strip()
+                    provided_etag = provided_etag[1:-1] if provided_etag.startswith('"') else provided_etag
+                    # the mtime digest was the etag until the content was hashed
+                    computed_etags = [etag, self.mtime_to_digest(mtime)]
+                    if provided_etag not in computed_etags:
                         self.message = 'The resource has changed, get everything from the start again'
                         self.set_status(400)
                         raise Exception(self.message)
-                # clients specify the range in terms of 0-based index numbers
-                # with an inclusive interval: [start, end]
-                client_byte_index_range = self.request.headers['Range']
-                full_file_size = os.stat(self.filepath).st_size
-                start_and_end = client_byte_index_range.split('=')[-1].split('-')
-                if ',' in start_and_end:
-                    self.set_status(405)
-                    self.message = 'Multipart byte range requests not supported'
-                    raise Exception(self.message)
-                client_start = int(start_and_end[0])
-                cursor_start = client_start
                 try:
-                    client_end = int(start_and_end[1])
-                except Exception as e:
-                    client_end = full_file_size - 1
-                if client_end > full_file_size:
+                    ranges = parse_byte_ranges(self.request.headers['Range'], size)
+                    assert len(ranges) <= options.export_max_ranges, \
+                        f'Too many byte ranges requested, max: {options.export_max_ranges}'
+                except (ValueError, AssertionError) as e:
                     self.set_status(416)
-                    raise Exception('Range request exceeds byte range of resource')
-                # because clients provide 0-based byte indices
-                # we must add 1 to calculate the desired amount to read
-                bytes_to_read = client_end - client_start + 1
-                self.set_header('Content-Length', bytes_to_read)
-                self.flush()
-                fd = open(self.filepath, "rb")
-                fd.seek(cursor_start)
-                sent = 0
-                if self.CHUNK_SIZE > bytes_to_read:
-                    self.CHUNK_SIZE = bytes_to_read
-                data = fd.read(self.CHUNK_SIZE)
-                sent = sent + self.CHUNK_SIZE
-                while data and sent <= bytes_to_read:
-                    self.write(data)
-                    yield self.flush()
-                    data = fd.read(self.CHUNK_SIZE)
-                    sent = sent + self.CHUNK_SIZE
-                fd.close()
+                    self.set_header('Content-Range', f'bytes */{size}')
+                    self.message = str(e)
+                    raise Exception(self.message)
+                fd = yield self.run_io(open, self.filepath, 'rb')
+                if len(ranges) == 1:
+                    cursor_start, client_end = ranges[0]
+                    # because clients provide 0-based byte indices
+                    # we must add 1 to calculate the desired amount to read
+                    bytes_to_read = client_end - cursor_start + 1
+                    self.set_header('Content-Length', bytes_to_read)
+                    if self.can_sendfile():
+                        yield self.start_sendfile_body()
+                        yield self.sendfile(fd, cursor_start, bytes_to_read)
+                    else:
+                        yield self.flush()
+                        yield self.write_chunks(fd, cursor_start, bytes_to_read)
+                else:
+                    yield self.write_byte_ranges(fd, ranges, size, mime_type)
             logging.info('user: %s, exported file: %s , with MIME type: %s', self.requestor, self.filepath, mime_type)
         except Exception as e:
             logging.error(e)
             logging.error(self.message)
             self.write({'message': self.message})
         finally:
-            try:
-                fd.close()
-            except (OSError, UnboundLocalError) as e:
-                pass
+            if fd:
+                try:
+                    yield self.run_io(fd.close)
+                except OSError as e:
+                    pass
             self.finish()
 
 
-    def head(self, tenant, filename):
+    @gen.coroutine
+    def head(self, tenant, filename=None):
         """
         Return information about a specific file.
 
@@ -2018,6 +3361,10 @@ class ProxyHandler(AuthRequestHandler):
                 self.set_status(403)
                 raise Exception
             assert options.valid_tenant.match(tenant)
+            if self.endpoint in ('sync', 'info'):
+                self.message = 'Method not allowed'
+                self.set_status(405)
+                raise Exception
             self.path = self.export_dir
             if not filename:
                 raise Exception('No info to report')
@@ -2028,13 +3375,15 @@ class ProxyHandler(AuthRequestHandler):
             except Exception as e:
                 raise Exception
             self.filepath = '%s/%s' % (self.path, secured_filename)
-            if not os.path.lexists(self.filepath):
+            exists = yield self.run_io(os.path.lexists, self.filepath)
+            if not exists:
                 logging.error(self.filepath)
                 logging.error('%s tried to access a file that does not exist', self.requestor)
                 self.set_status(404)
                 self.message = 'File does not exist'
                 raise Exception
-            size, mime_type, mtime = self.get_file_metadata(self.filepath)
+            size, mime_type, mtime, etag = yield self.run_io(self.export_file_metadata, self.filepath)
+            self.mtime, self.etag = mtime, etag
             status = self.enforce_export_policy(self.export_policy, self.filepath, tenant, size, mime_type)
             self.message = 'export policy violation'
             assert status, self.message
@@ -2043,7 +3392,11 @@ class ProxyHandler(AuthRequestHandler):
             self.set_header('Accept-Ranges', 'bytes')
             self.set_header('Content-Type', mime_type)
             self.set_header('Modified-Time', str(mtime))
-            self.set_status(200)
+            if self.check_not_modified(etag, mtime):
+                metrics.incr('export_not_modified')
+                self.set_status(304)
+            else:
+                self.set_status(200)
         except Exception as e:
             logging.error(e)
             logging.error(self.message)
@@ -2052,6 +3405,7 @@ class ProxyHandler(AuthRequestHandler):
             self.finish()
 
 
+    @gen.coroutine
     def delete(self, tenant, filename=''):
         self.message = 'Unknown error, please contact TSD'
         try:
@@ -2097,11 +3451,11 @@ class ProxyHandler(AuthRequestHandler):
             try:
                 # Allow the file to be deleted by changing the rights temporary of the parent directory
                 if self.has_posix_ownership:
-                    subprocess.call(['sudo', 'chmod', 'o+w',  os.path.dirname(self.filepath)])
+                    yield self.change_privileged('chmod', os.path.dirname(self.filepath), add=0o002)
                 os.remove(self.filepath)
                 # Restoring the rights of the parent directory
                 if self.has_posix_ownership:
-                    subprocess.call(['sudo', 'chmod', 'o-w',  os.path.dirname(self.filepath)])
+                    yield self.change_privileged('chmod', os.path.dirname(self.filepath), remove=0o002)
                 self.message = 'Deleted %s' % self.filepath
             except OSError as e:
                 self.set_status(500)
@@ -2192,9 +3546,18 @@ class GenericTableHandler(AuthRequestHandler):
             self.finish()
 
 
+    @gen.coroutine
     def decrypt_nacl_data(self, data, headers):
-        out = b''
-        nacl_stream_buffer = b''
+        """
+        Decrypt a nacl encrypted request body, in frames of Nacl-Chunksize
+        bytes, on the export thread pool, if it has at least
+        nacl_off_loop_min_bytes, and on the event loop otherwise.
+
+        Returns
+        -------
+        str
+
+        """
         try:
             nacl_nonce = options.sealed_box.decrypt(
                 base64.b64decode(headers['Nacl-Nonce'])
@@ -2216,23 +3579,15 @@ class GenericTableHandler(AuthRequestHandler):
         if nacl_chunksize > options.max_nacl_chunksize:
             self.error = f'Nacl-Chunksize larger than max allowed: {options.max_nacl_chunksize}'
             raise Exception(self.error)
-        for byte in data:
-            nacl_stream_buffer += bytes([byte])
-            if len(nacl_stream_buffer) % nacl_chunksize == 0:
-                decrypted = libnacl.crypto_stream_xor(
-                    nacl_stream_buffer,
-                    nacl_nonce,
-                    nacl_key
-                )
-                out += decrypted
-                nacl_stream_buffer = b''
-        if nacl_stream_buffer:
-            decrypted = libnacl.crypto_stream_xor(
-                nacl_stream_buffer,
-                nacl_nonce,
-                nacl_key
-            )
-            out += decrypted
+        try:
+            if len(data) >= options.nacl_off_loop_min_bytes:
+                out = yield self.run_io(decrypt_nacl_payload, data, nacl_nonce, nacl_key, nacl_chunksize)
+            else:
+                out = decrypt_nacl_payload(data, nacl_nonce, nacl_key, nacl_chunksize)
+        except ValueError as e:
+            self.error = 'Could not decrypt data'
+            logging.error(e)
+            raise Exception(self.error)
         return out.decode()
 
 
@@ -2315,10 +3670,11 @@ class GenericTableHandler(AuthRequestHandler):
             self.write({'message': self.error})
 
 
+    @gen.coroutine
     def put(self, tenant, table_name):
         try:
             if self.request.headers.get('Content-Type') == 'application/json+nacl':
-                new_data = self.decrypt_nacl_data(
+                new_data = yield self.decrypt_nacl_data(
                     self.request.body,
                     self.request.headers
                 )
@@ -2346,6 +3702,7 @@ class GenericTableHandler(AuthRequestHandler):
             self.write({'message': self.error})
 
 
+    @gen.coroutine
     def patch(self, tenant, table_name):
         try:
             if self.request.uri.split('?')[0].endswith('metadata'):
@@ -2355,7 +3712,7 @@ class GenericTableHandler(AuthRequestHandler):
                 self.error = 'Not allowed to write to audit tables'
                 raise Exception(self.error)
             if self.request.headers.get('Content-Type') == 'application/json+nacl':
-                new_data = self.decrypt_nacl_data(
+                new_data = yield self.decrypt_nacl_data(
                     self.request.body,
                     self.request.headers
                 )
@@ -2446,6 +3803,12 @@ class NaclKeyHander(RequestHandler):
         }
         self.write(out)
 
+class MetricsHandler(RequestHandler):
+
+    def get(self):
+        self.write(metrics.snapshot())
+
+
 class RunTimeConfigurationHandler(RequestHandler):
 
     def post(self):
@@ -2471,6 +3834,9 @@ class Backends(object):
         'health': [
             ('/v1/(.*)/files/health', HealthCheckHandler),
         ],
+        'metrics': [
+            ('/v1/admin/metrics', MetricsHandler),
+        ],
         'runtime_configuration': [
             ('/v1/admin.*', RunTimeConfigurationHandler),
         ]
@@ -2486,6 +3852,7 @@ class Backends(object):
             ('/v1/(.*)/cluster/resumables/(.*)', ResumablesHandler, dict(backend='cluster')),
             ('/v1/(.*)/cluster/export', ProxyHandler, dict(backend='cluster', namespace='cluster', endpoint='export')),
             ('/v1/(.*)/cluster/export/(.*)', ProxyHandler, dict(backend='cluster', namespace='cluster', endpoint='export')),
+            ('/v1/(.*)/cluster/info', ProxyHandler, dict(backend='cluster', namespace='cluster', endpoint='info')),
         ],
         'files_import': [
             ('/v1/(.*)/files/upload_stream', StreamHandler, dict(backend='files_import')),
@@ -2494,10 +3861,13 @@ class Backends(object):
             ('/v1/(.*)/files/stream/(.*)', ProxyHandler, dict(backend='files_import', namespace='files', endpoint='stream')),
             ('/v1/(.*)/files/resumables', ResumablesHandler, dict(backend='files_import')),
             ('/v1/(.*)/files/resumables/(.*)', ResumablesHandler, dict(backend='files_import')),
+            ('/v1/(.*)/files/sync', ProxyHandler, dict(backend='files_import', namespace='files', endpoint='sync')),
+            ('/v1/(.*)/files/sync/(.*)', ProxyHandler, dict(backend='files_import', namespace='files', endpoint='sync')),
         ],
         'files_export': [
             ('/v1/(.*)/files/export', ProxyHandler, dict(backend='files_export', namespace='files', endpoint='export')),
             ('/v1/(.*)/files/export/(.*)', ProxyHandler, dict(backend='files_export', namespace='files', endpoint='export')),
+            ('/v1/(.*)/files/info', ProxyHandler, dict(backend='files_export', namespace='files', endpoint='info')),
         ],
         'survey': [
             ('/v1/(.*)/survey/crypto/key', NaclKeyHander),
@@ -2524,6 +3894,9 @@ class Backends(object):
             ('/v1/(.*)/store/resumables/(.*)', ResumablesHandler, dict(backend='store')),
             ('/v1/(.*)/store/export', ProxyHandler, dict(backend='store', namespace='store', endpoint='export')),
             ('/v1/(.*)/store/export/(.*)', ProxyHandler, dict(backend='store', namespace='store', endpoint='export')),
+            ('/v1/(.*)/store/info', ProxyHandler, dict(backend='store', namespace='store', endpoint='info')),
+            ('/v1/(.*)/store/sync', ProxyHandler, dict(backend='store', namespace='store', endpoint='sync')),
+            ('/v1/(.*)/store/sync/(.*)', ProxyHandler, dict(backend='store', namespace='store', endpoint='sync')),
         ],
         'apps_files' : [
             ('/v1/(.*)/apps/.+/resumables', ResumablesHandler, dict(backend='apps_files')),
@@ -2547,6 +3920,7 @@ class Backends(object):
 
         self.config = config
         self.routes = []
+        self.internal_routes = []
         self.exchanges = {}
 
         print(colored(f'tsd-file-api, listening on port {options.port}', 'yellow'))
@@ -2563,8 +3937,13 @@ class Backends(object):
                 if backend in self.optional_routes.keys():
                     print(colored(f'Initialising: {backend}', 'cyan'))
                     for route in self.optional_routes[backend]:
-                        print(colored(f'- {route[0]}', 'yellow'))
-                        self.routes.append(route)
+                        if options.internal_socket and '/upload_stream' in route[0]:
+                            # only reachable via the internal socket
+                            print(colored(f'- {route[0]} (internal)', 'yellow'))
+                            self.internal_routes.append(route)
+                        else:
+                            print(colored(f'- {route[0]}', 'yellow'))
+                            self.routes.append(route)
 
         print(colored('Initialising database backends', 'magenta'))
         for name, backend in self.config['backends']['dbs'].items():
@@ -2612,10 +3991,69 @@ def main():
         PikaClient(options.rabbitmq, backends.exchanges) if options.rabbitmq.get('enabled')
         else None
     )
-    app = Application(
-        backends.routes,
-        **{'pika_client': pika_client, 'debug': options.debug}
-    )
+    settings = {
+        'pika_client': pika_client,
+        'debug': options.debug,
+        'internal_http_client': InternalHTTPClient(
+            implementation=options.proxy_client,
+            max_clients=options.proxy_max_clients,
+            socket_path=options.internal_socket
+        ),
+        'compression_cache': CompressionCache(
+            options.export_compression_cache,
+            options.export_compression_cache_max_bytes
+        ) if options.export_compression_cache else None,
+        'metadata_cache': FileMetadataCache(
+            max_entries=options.metadata_cache_size,
+            persist_dir=options.metadata_cache_dir
+        ) if options.metadata_cache_size else None,
+        'listing_snapshots': ListingSnapshots(
+            ttl=options.listing_snapshot_ttl,
+            max_snapshots=options.listing_snapshot_max,
+            max_names=options.listing_snapshot_max_names
+        ),
+        'directory_index': DirectoryIndex(
+            max_dirs=options.listing_index_max_dirs,
+            max_age=options.listing_index_max_age
+        ),
+        'export_executor': ThreadPoolExecutor(
+            max_workers=options.export_io_workers,
+            thread_name_prefix='export-io'
+        ),
+        'producer_executor': ThreadPoolExecutor(
+            max_workers=options.export_producer_workers,
+            thread_name_prefix='export-producer'
+        ),
+        'producer_slots': threading.BoundedSemaphore(options.export_producer_workers),
+        # uploaded files kept open while request hooks run, see keep_for_digest
+        'digest_slots': threading.BoundedSemaphore(256),
+        'privileges': (
+            PrivilegedHelperClient(options.privileged_helper_socket)
+            if options.privileged_helper_socket else SudoPrivileges()
+        ),
+        'request_hooks': RequestHookExecutor(
+            workers=options.request_hook_workers,
+            max_attempts=options.request_hook_max_attempts,
+            retry_delay=options.request_hook_retry_delay,
+            journal=options.request_hook_journal
+        )
+    }
+    settings['request_hooks'].start()
+    if options.content_etags:
+        settings['content_digests'] = ContentDigests(options.content_etag_db)
+        settings['upload_hashes'] = UploadHashes(options.content_etag_hash)
+        if options.content_etag_background:
+            settings['content_hasher'] = BackgroundHasher(
+                settings['content_digests'], options.content_etag_hash
+            )
+            settings['content_hasher'].start()
+    if options.internal_socket:
+        print(colored(f'internal requests via: {options.internal_socket}', 'yellow'))
+        internal_app = Application(backends.internal_routes, **settings)
+        internal_server = HTTPServer(internal_app, max_body_size=options.max_body_size)
+        internal_server.add_socket(bind_unix_socket(options.internal_socket, mode=0o600))
+        settings['internal_application'] = internal_app
+    app = Application(backends.routes, **settings)
     app.listen(options.port, max_body_size=options.max_body_size)
     ioloop = IOLoop.instance()
     if pika_client:
@@ -0,0 +1,371 @@
+"""
+Streaming archives of export directories, and compressed
+representations of export files, generated on worker threads.
+
+"""
+
+import collections
+import glob
+import gzip
+import hashlib
+import io
+import logging
+import os
+import shutil
+import tarfile
+import threading
+import time
+import zipfile
+
+from uuid import uuid4
+
+from tornado import gen
+from tornado.iostream import StreamClosedError
+from tornado.queues import Queue
+
+from metrics import metrics
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+ARCHIVE_FORMATS = {
+    'tar': ('application/x-tar', 'tar'),
+    'tar.gz': ('application/gzip', 'tar.gz'),
+    'zip': ('application/zip', 'zip'),
+}
+
+COMPRESSION_ENCODINGS = ['zstd', 'gzip'] if zstandard else ['gzip']
+
+
+class ArchiveAborted(Exception):
+    message = 'Archive consumer went away'
+
+
+class ArchiveWriter(io.RawIOBase):
+
+    """
+    A write-only, non-seekable file object, which hands what is
+    written to it, in chunks, from a worker thread to the event loop.
+
+    At most max_chunks chunks are in flight at any time: the
+    worker thread blocks when that many have not yet been sent
+    to the client, so memory use is bounded, regardless of the
+    size of the archive.
+
+    Parameters
+    ----------
+    io_loop: tornado.ioloop.IOLoop, of the consumer
+    chunk_size: int, bytes per chunk
+    max_chunks: int, max number of chunks in flight
+
+    """
+
+    def __init__(self, io_loop, chunk_size, max_chunks=8):
+        self.io_loop = io_loop
+        self.chunk_size = chunk_size
+        self.buffer = bytearray()
+        self.chunks = Queue()
+        self.slots = threading.Semaphore(max_chunks)
+        self.aborted = False
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.buffer.extend(data)
+        while len(self.buffer) >= self.chunk_size:
+            self._send(bytes(self.buffer[:self.chunk_size]))
+            del self.buffer[:self.chunk_size]
+        return len(data)
+
+    def _send(self, item):
+        while not self.slots.acquire(timeout=1):
+            if self.aborted:
+                raise ArchiveAborted
+        if self.aborted:
+            raise ArchiveAborted
+        self.io_loop.add_callback(self.chunks.put_nowait, item)
+
+    def finish(self, error=None):
+        """
+        Called on the worker thread, when the archive is complete,
+        or has failed, after which the consumer gets None, or error.
+
+        """
+        if not error and self.buffer:
+            self._send(bytes(self.buffer))
+            self.buffer.clear()
+        self.io_loop.add_callback(self.chunks.put_nowait, error)
+
+    @gen.coroutine
+    def get(self):
+        """
+        Get the next chunk, on the event loop. Returns None
+        at the end of the archive, and raises if generating it failed.
+
+        """
+        item = yield self.chunks.get()
+        if isinstance(item, Exception):
+            raise item
+        if item is not None:
+            self.slots.release()
+        return item
+
+    def abort(self):
+        """Make the worker thread stop, at its next write."""
+        self.aborted = True
+
+
+def export_members(path, include):
+    """
+    Find the files in a directory tree which may be exported.
+
+    Symlinks are never followed, or included, so that
+    nothing outside of the directory can end up in the archive.
+
+    Parameters
+    ----------
+    path: str, directory
+    include: callable, which takes a file path,
+        and returns whether it may be exported
+
+    Yields
+    ------
+    (str, str), path and name in the archive
+
+    """
+    base = os.path.dirname(os.path.normpath(path))
+    for current, dirs, files in os.walk(path):
+        dirs[:] = sorted(d for d in dirs if not os.path.islink(os.path.join(current, d)))
+        for name in sorted(files):
+            filepath = os.path.join(current, name)
+            if os.path.islink(filepath) or not os.path.isfile(filepath):
+                continue
+            if not include(filepath):
+                metrics.incr('export_archive_members_skipped')
+                logging.info('not adding %s to archive: export policy', filepath)
+                continue
+            yield filepath, os.path.relpath(filepath, base)
+
+
+def write_archive(writer, path, archive_format, include):
+    """
+    Write a tar, tar.gz or zip archive of a directory to writer.
+    Runs on a worker thread, so compression and file reads do not
+    block the event loop.
+
+    Parameters
+    ----------
+    writer: ArchiveWriter
+    path: str, directory to archive
+    archive_format: str, one of ARCHIVE_FORMATS
+    include: callable, see export_members
+
+    Returns
+    -------
+    int, number of files in the archive
+
+    """
+    start = time.time()
+    num_members = 0
+    try:
+        members = export_members(path, include)
+        if archive_format == 'zip':
+            with zipfile.ZipFile(writer, mode='w', compression=zipfile.ZIP_DEFLATED) as archive:
+                for filepath, arcname in members:
+                    info = zipfile.ZipInfo.from_file(filepath, arcname)
+                    info.compress_type = zipfile.ZIP_DEFLATED
+                    with open(filepath, 'rb') as src, \
+                        archive.open(info, mode='w', force_zip64=True) as dest:
+                        shutil.copyfileobj(src, dest, writer.chunk_size)
+                    num_members += 1
+        else:
+            mode = 'w|gz' if archive_format == 'tar.gz' else 'w|'
+            with tarfile.open(fileobj=writer, mode=mode, bufsize=writer.chunk_size) as archive:
+                for filepath, arcname in members:
+                    archive.add(filepath, arcname=arcname, recursive=False)
+                    num_members += 1
+        writer.finish()
+    except ArchiveAborted:
+        writer.finish(StreamClosedError())
+    except Exception as e:
+        logging.error(e)
+        writer.finish(e)
+        raise e
+    finally:
+        metrics.observe('export_archive_seconds', time.time() - start)
+    return num_members
+
+
+class _Tee(object):
+
+    def __init__(self, *targets):
+        self.targets = targets
+
+    def write(self, data):
+        for target in self.targets:
+            target.write(data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+
+class CompressionCache(object):
+
+    """
+    A directory of compressed representations of export files, so
+    that repeated downloads are not compressed again, with one
+    subdirectory per tenant, only accessible by the API user.
+
+    The name of an entry depends on the path, and the validator
+    (etag) of the original, so a changed file is never served from
+    a stale entry. The total size of the entries is kept within
+    max_bytes, by removing the least recently used ones first.
+    Entries which exist when the cache is created, e.g. from before
+    a restart, are ordered by their access times.
+
+    Thread-safe, since entries are written and read on worker threads.
+
+    Parameters
+    ----------
+    cache_dir: str
+    max_bytes: int, or None, for no limit
+
+    """
+
+    def __init__(self, cache_dir, max_bytes=None):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        self._lock = threading.Lock()
+        self._make_dir(cache_dir)
+        existing = []
+        for tenant_dir in os.scandir(cache_dir):
+            if not tenant_dir.is_dir(follow_symlinks=False):
+                continue
+            for entry in os.scandir(tenant_dir.path):
+                if entry.name.endswith('.part'):
+                    os.remove(entry.path) # from an interrupted write
+                elif entry.is_file(follow_symlinks=False):
+                    info = entry.stat(follow_symlinks=False)
+                    existing.append((info.st_atime, entry.path, info.st_size))
+        for _, path, size in sorted(existing):
+            self.entries[path] = size
+            self.size += size
+        self._evict()
+
+    def _make_dir(self, path):
+        try:
+            os.mkdir(path, mode=0o700)
+        except FileExistsError:
+            pass
+        os.chmod(path, 0o700)
+
+    def path(self, tenant, filepath, validator, encoding):
+        """
+        Where to cache a compressed representation of a file, in the
+        directory of the tenant, which is created if needed. Blocking.
+
+        """
+        tenant_dir = os.path.join(self.cache_dir, tenant)
+        if not os.path.isdir(tenant_dir):
+            self._make_dir(tenant_dir)
+        key = hashlib.sha256(filepath.encode('utf-8')).hexdigest()
+        return os.path.join(tenant_dir, f'{key}-{validator}.{encoding}')
+
+    def touch(self, path):
+        """Mark an entry as recently used, when it is served."""
+        with self._lock:
+            if path in self.entries:
+                self.entries.move_to_end(path)
+
+    def add(self, path, size):
+        """Account for a new entry, and remove old ones, if over budget."""
+        with self._lock:
+            self.size += size - self.entries.pop(path, 0)
+            self.entries[path] = size
+            self._evict()
+
+    def remove(self, path):
+        with self._lock:
+            self.size -= self.entries.pop(path, 0)
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def _evict(self):
+        while self.max_bytes is not None and self.size > self.max_bytes and self.entries:
+            path, size = self.entries.popitem(last=False)
+            self.size -= size
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            metrics.incr('export_compression_cache_evictions')
+
+
+def write_compressed(writer, filepath, encoding, cache=None, cache_path=None):
+    """
+    Compress a file to writer, with gzip or zstd. Runs
+    on a worker thread, so compression does not block the event loop.
+
+    If cache_path is given, the compressed data is also written
+    to that file, which is only put in place once complete, and
+    previously cached versions of the same file are removed.
+
+    Parameters
+    ----------
+    writer: ArchiveWriter
+    filepath: str, file to compress
+    encoding: str, one of COMPRESSION_ENCODINGS
+    cache: CompressionCache, optional
+    cache_path: str, optional, see CompressionCache.path
+
+    """
+    start = time.time()
+    tmp_path, cache_file = None, None
+    try:
+        out = writer
+        if cache_path:
+            tmp_path = f'{cache_path}.{uuid4().hex}.part'
+            cache_file = open(tmp_path, 'wb')
+            out = _Tee(writer, cache_file)
+        with open(filepath, 'rb') as src:
+            if encoding == 'zstd':
+                zstandard.ZstdCompressor(level=3).copy_stream(
+                    src, out, read_size=writer.chunk_size, write_size=writer.chunk_size
+                )
+            else:
+                with gzip.GzipFile(fileobj=out, mode='wb', compresslevel=6, mtime=0) as dest:
+                    shutil.copyfileobj(src, dest, writer.chunk_size)
+        if cache_file:
+            cache_file.close()
+            os.rename(tmp_path, cache_path)
+            tmp_path = None
+            prefix = cache_path.rsplit('-', 1)[0]
+            for stale in glob.glob(f'{glob.escape(prefix)}-*.{encoding}'):
+                if stale != cache_path:
+                    cache.remove(stale)
+            cache.add(cache_path, os.stat(cache_path).st_size)
+        writer.finish()
+    except ArchiveAborted:
+        writer.finish(StreamClosedError())
+    except Exception as e:
+        logging.error(e)
+        writer.finish(e)
+        raise e
+    finally:
+        if cache_file and not cache_file.closed:
+            cache_file.close()
+        if tmp_path:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+        metrics.observe('export_compression_seconds', time.time() - start)
@@ -0,0 +1,249 @@
+"""
+Hashes of file content, computed while files are uploaded, or
+in the background, and stored by the API, so that they can be
+served as ETags without reading the files again.
+
+"""
+
+import collections
+import hashlib
+import logging
+import os
+import queue
+import sqlite3
+import stat
+import threading
+
+from metrics import metrics
+
+
+class ContentDigests(object):
+
+    """
+    Hashes of the content of files, stored by the API, in a sqlite
+    database, by device and inode, and not with the files, where
+    their owners could change them.
+
+    A hash is only valid for the size, mtime and ctime, which the
+    file had when it was stored. The ctime cannot be set by users,
+    so a file which is rewritten, and has its mtime set back, loses
+    its hash, and so does a file which changes owner or mode, which
+    is why the hash of an upload with a request hook is only stored
+    once the hook has run.
+
+    Thread-safe, since hashes are stored and read on worker threads.
+
+    Parameters
+    ----------
+    path: str, of the database, or None, to keep hashes in memory,
+        until the process exits
+
+    """
+
+    def __init__(self, path=None):
+        self.db = sqlite3.connect(path or ':memory:', check_same_thread=False)
+        self.db.execute('pragma journal_mode=wal')
+        self.db.execute('pragma synchronous=off')
+        self.db.execute(
+            'create table if not exists digests(dev int, ino int, size int, mtime_ns int, '
+            'ctime_ns int, hash_name text, digest text, primary key (dev, ino))'
+        )
+        self._lock = threading.Lock()
+
+    def get(self, info, hash_name):
+        """
+        Get the stored hash of the content of a file, if it is still valid.
+
+        Parameters
+        ----------
+        info: os.stat_result, of the file
+        hash_name: str
+
+        Returns
+        -------
+        str, hex digest, or None
+
+        """
+        try:
+            with self._lock:
+                row = self.db.execute(
+                    'select size, mtime_ns, ctime_ns, hash_name, digest from digests '
+                    'where dev = ? and ino = ?', (info.st_dev, info.st_ino)
+                ).fetchone()
+        except sqlite3.Error as e:
+            logging.error(e)
+            return None
+        if row and row[:4] == (info.st_size, info.st_mtime_ns, info.st_ctime_ns, hash_name):
+            return row[4]
+        return None
+
+    def put(self, path, hash_name, digest, info=None):
+        """
+        Store the hash of the content of a file, valid for its
+        current size, mtime and ctime, or those of the given stat_result.
+
+        Returns
+        -------
+        bool, whether it was stored
+
+        """
+        try:
+            if info is None:
+                info = os.stat(path)
+            with self._lock:
+                # one row per inode, so changed files replace their hashes
+                self.db.execute(
+                    'insert or replace into digests values (?, ?, ?, ?, ?, ?, ?)',
+                    (info.st_dev, info.st_ino, info.st_size, info.st_mtime_ns,
+                     info.st_ctime_ns, hash_name, digest)
+                )
+                self.db.commit()
+            return True
+        except (OSError, sqlite3.Error) as e:
+            logging.error(e)
+            logging.error('could not store content digest of %s', path)
+            return False
+
+
+def compute_content_digest(path, hash_name, blocksize=1048576):
+    _hash = hashlib.new(hash_name)
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b''):
+            _hash.update(block)
+    return _hash.hexdigest()
+
+
+class UploadHashes(object):
+
+    """
+    The hashes of resumable uploads which are in progress, by upload
+    id, each with the number of bytes it covers, so that a hash is
+    only continued when the next chunk is appended at that offset.
+
+    If an upload continues in another process, or after a restart,
+    or is repaired, its hash is dropped, and the file is left to be
+    hashed in the background instead.
+
+    Parameters
+    ----------
+    hash_name: str
+    max_uploads: int, least recently updated are dropped first
+
+    """
+
+    def __init__(self, hash_name='sha256', max_uploads=1000):
+        self.hash_name = hash_name
+        self.max_uploads = max_uploads
+        self.hashes = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def resume(self, upload_id, offset):
+        """
+        Take the hash of an upload, to continue it at offset.
+
+        Returns
+        -------
+        hashlib hash object, or None
+
+        """
+        with self._lock:
+            _hash, covered = self.hashes.pop(upload_id, (None, None))
+        if offset == 0:
+            return hashlib.new(self.hash_name)
+        if covered != offset:
+            return None
+        return _hash
+
+    def save(self, upload_id, _hash, offset):
+        with self._lock:
+            self.hashes[upload_id] = (_hash, offset)
+            while len(self.hashes) > self.max_uploads:
+                self.hashes.popitem(last=False)
+
+    def pop(self, upload_id, size):
+        """
+        Returns
+        -------
+        str, hex digest of the upload, if it covers size bytes, or None
+
+        """
+        with self._lock:
+            _hash, covered = self.hashes.pop(upload_id, (None, None))
+        if _hash is None or covered != size:
+            return None
+        return _hash.hexdigest()
+
+
+class BackgroundHasher(object):
+
+    """
+    Hash files which do not have a stored hash, e.g. because
+    they were written outside of the API, one at a time, on a
+    single thread, and store the hashes.
+
+    Files are hashed in the order in which they are submitted,
+    and submitted files are dropped if max_queued are waiting
+    already. A file which changes while it is being hashed gets
+    no hash, and is hashed again when it is next submitted.
+
+    Metrics: content_hash_background_files,
+    content_hash_background_bytes, and content_hash_background_errors.
+
+    Parameters
+    ----------
+    digests: ContentDigests
+    hash_name: str
+    max_queued: int
+
+    """
+
+    def __init__(self, digests, hash_name='sha256', max_queued=10000):
+        self.digests = digests
+        self.hash_name = hash_name
+        self.queue = queue.Queue(maxsize=max_queued)
+        self.queued = set()
+        self._lock = threading.Lock()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self._work, name='content-hasher', daemon=True)
+        self.thread.start()
+
+    def submit(self, path):
+        """Queue a file to be hashed, without blocking."""
+        with self._lock:
+            if path in self.queued:
+                return
+            try:
+                self.queue.put_nowait(path)
+            except queue.Full:
+                return
+            self.queued.add(path)
+
+    def hash_file(self, path):
+        info = os.stat(path)
+        if not stat.S_ISREG(info.st_mode):
+            return
+        if self.digests.get(info, self.hash_name):
+            return
+        digest = compute_content_digest(path, self.hash_name)
+        after = os.stat(path)
+        if ((after.st_ino, after.st_size, after.st_mtime_ns, after.st_ctime_ns)
+                != (info.st_ino, info.st_size, info.st_mtime_ns, info.st_ctime_ns)):
+            return # changed while hashing
+        if self.digests.put(path, self.hash_name, digest, info):
+            metrics.incr('content_hash_background_files')
+            metrics.incr('content_hash_background_bytes', info.st_size)
+
+    def _work(self):
+        while True:
+            path = self.queue.get()
+            with self._lock:
+                self.queued.discard(path)
+            try:
+                self.hash_file(path)
+            except FileNotFoundError:
+                pass
+            except Exception as e:
+                logging.error(e)
+                metrics.incr('content_hash_background_errors')
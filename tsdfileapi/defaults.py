@@ -14,9 +14,47 @@ _config = {
     'tenant_string_pattern': 'pXX',
     'export_max_num_list': 100 ,
     'export_chunk_size': 512000,
+    'export_sendfile': False,
+    'export_io_workers': 16,
+    'export_producer_workers': 8,
+    'export_max_ranges': 64,
+    'export_compression_cache': None,
+    'export_compression_cache_max_bytes': 10737418240,
+    'metadata_cache_size': 100000,
+    'metadata_cache_dir': None,
+    'listing_snapshot_ttl': 300,
+    'listing_snapshot_max': 100,
+    'listing_snapshot_max_names': 2000000,
+    'listing_concurrency': 8,
+    'listing_index_max_dirs': 100,
+    'listing_index_max_age': 300,
+    'export_info_max_files': 1000,
+    'mime_type_extensions': {},
+    'mime_type_header_bytes': 65536,
+    'mime_type_sniffing': 'always',
+    'privileged_helper_socket': None,
+    'request_hook_workers': 4,
+    'request_hook_max_attempts': 3,
+    'request_hook_retry_delay': 5,
+    'request_hook_journal': None,
+    'content_etags': False,
+    'content_etag_hash': 'sha256',
+    'content_etag_background': False,
+    'content_etag_db': None,
+    'nacl_off_loop_min_bytes': 1048576,
+    'gz_max_queued_chunks': 16,
+    'tar_max_queued_chunks': 16,
+    'tar_write_workers': 4,
     'max_body_size': 5368709120,
     'default_file_owner': 'pXX-nobody',
     'create_tenant_dir': True,
+    'proxy_in_process': False,
+    'proxy_queue_max_bytes': 4194304,
+    'proxy_queue_max_write': 1048576,
+    'proxy_request_timeout': 12000.0,
+    'internal_socket': None,
+    'proxy_client': 'simple',
+    'proxy_max_clients': 100,
     'jwt_test_secret': 'jS25aQbePizfTsetg8LbFsNKl1W6wi4nQaBj705ofWA=',
     'jwt_secret': None,
     'nacl_public': {
@@ -0,0 +1,120 @@
+"""
+Decompression of gzip compressed uploads, in-process, on a worker
+thread, instead of in a gunzip process, which is written to from
+the event loop, and blocks it whenever its pipe is full.
+
+Compressed data is handed to the worker through a bounded queue,
+or read by it from a pipe (see streamworker), and decompressed
+with zlib, which releases the GIL, in pieces of bounded size, so
+that neither slow disks nor highly compressed data use unbounded
+memory.
+
+"""
+
+import logging
+import zlib
+
+from metrics import metrics
+from streamworker import StreamWorker
+
+
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+
+class GzipStreamError(Exception):
+    message = 'Could not decompress data'
+
+
+class GzipStreamWriter(StreamWorker):
+
+    """
+    Decompress a gzip stream into a file, on a worker thread.
+
+    The stream may consist of several gzip members, one after
+    the other, as written by e.g. cat a.gz b.gz, or pigz, and
+    they are decompressed into the same file, like gunzip does.
+
+    Metrics: gz_uploads, gz_compressed_bytes, gz_uncompressed_bytes,
+    and gz_errors.
+
+    Parameters
+    ----------
+    target_file: file object, opened for binary writing
+    source: file object, optional, see StreamWorker
+    content_hash: hashlib hash object, optional, updated with the
+        decompressed data
+    max_queued: int, see StreamWorker
+    max_output: int, bytes to decompress at a time
+
+    """
+
+    error_class = GzipStreamError
+    errors = (zlib.error, GzipStreamError, OSError, ValueError)
+
+    def __init__(self, target_file, source=None, content_hash=None,
+                 max_queued=16, max_output=1048576):
+        super().__init__(source, max_queued, name='gunzip')
+        self.target_file = target_file
+        self.content_hash = content_hash
+        self.max_output = max_output
+        self.decompressor = zlib.decompressobj(GZIP_WBITS)
+        self.in_member = False
+        self.uncompressed_bytes = 0
+        self.start()
+
+    @property
+    def ratio(self):
+        """Uncompressed bytes per compressed byte, so far."""
+        if not self.compressed_bytes:
+            return 0.0
+        return self.uncompressed_bytes / self.compressed_bytes
+
+    def close(self):
+        """
+        Wait for all data to be decompressed and written, off the event loop.
+        The target file is left open.
+
+        Raises
+        ------
+        GzipStreamError, if the data could not be decompressed
+
+        """
+        self.join()
+        metrics.incr('gz_uploads')
+        metrics.incr('gz_compressed_bytes', self.compressed_bytes)
+        metrics.incr('gz_uncompressed_bytes', self.uncompressed_bytes)
+        if self.error:
+            metrics.incr('gz_errors')
+        self._check()
+        logging.info(
+            'decompressed %d bytes to %d bytes, ratio: %.2f',
+            self.compressed_bytes, self.uncompressed_bytes, self.ratio
+        )
+
+    def _write(self, data):
+        if data:
+            self.target_file.write(data)
+            self.uncompressed_bytes += len(data)
+            if self.content_hash:
+                self.content_hash.update(data)
+
+    def decompress(self, data):
+        if data:
+            self.in_member = True
+        while self.in_member and not self.aborted:
+            out = self.decompressor.decompress(data, self.max_output)
+            self._write(out)
+            data = self.decompressor.unconsumed_tail
+            if self.decompressor.eof:
+                # the next gzip member, if any
+                data = self.decompressor.unused_data
+                self.decompressor = zlib.decompressobj(GZIP_WBITS)
+                self.in_member = bool(data)
+            elif not data and len(out) < self.max_output:
+                return # all output for the input so far
+
+    def consume(self, chunks):
+        for chunk in chunks:
+            self.decompress(chunk)
+        if self.in_member and not self.aborted:
+            raise GzipStreamError('truncated gzip stream')
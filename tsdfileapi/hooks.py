@@ -0,0 +1,269 @@
+"""Execution of request hooks, off the event loop."""
+
+import collections
+import json
+import logging
+import sqlite3
+import subprocess
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+from tornado import gen
+from tornado.concurrent import Future
+from tornado.ioloop import IOLoop
+from tornado.locks import Condition
+
+from metrics import metrics
+
+
+def request_hook_command(path, params, as_sudo=True):
+    """
+    Parameters
+    ----------
+    path: str, executable
+    params: list of lists, the arguments for each file,
+        which are passed one after the other
+    as_sudo: bool
+
+    """
+    cmd = ['sudo'] if as_sudo else []
+    cmd.append(path)
+    for file_params in params:
+        cmd.extend(file_params)
+    return cmd
+
+
+def reported_failures(output, count):
+    """
+    Parameters
+    ----------
+    output: bytes, written to stdout by a hook which failed
+    count: int, number of argument groups it was called with
+
+    Returns
+    -------
+    set of int, indexes of the argument groups which the hook
+    reported as failed, one per line, or None, if it did not
+
+    """
+    try:
+        failed = {int(line) for line in output.decode().split()}
+    except (UnicodeDecodeError, ValueError):
+        return None
+    if not failed or not all(0 <= i < count for i in failed):
+        return None
+    return failed
+
+
+class _HookCall(object):
+
+    __slots__ = ('call_id', 'path', 'sudo', 'max_batch', 'params', 'attempts', 'future')
+
+    def __init__(self, call_id, path, sudo, max_batch, params, attempts=0):
+        self.call_id = call_id
+        self.path = path
+        self.sudo = sudo
+        self.max_batch = max_batch
+        self.params = params
+        self.attempts = attempts
+        self.future = Future()
+
+    @property
+    def key(self):
+        return (self.path, self.sudo)
+
+
+class RequestHookExecutor(object):
+
+    """
+    Run request hooks in a bounded pool of worker threads, so that
+    neither the event loop, nor the completion of uploads, waits for them.
+
+    Calls are queued, and consecutive calls to the same hook are
+    coalesced into one invocation, with the arguments for each file
+    one after the other, if the hook is configured with max_batch > 1.
+    Failed invocations (non-zero exit status) are retried, with
+    exponential backoff, up to max_attempts times, one call at a time.
+    A hook which fails for only some of the files in a batch can print
+    the zero-based indexes of their argument groups on stdout, one per
+    line, and then only those are retried, since running a hook again
+    for files which it has already moved would fail.
+
+    If a journal is given, queued calls are stored in it until they
+    have been run, and calls left over from a previous process are
+    queued again by start. The journal is written on a thread of its
+    own, in order, and not on the event loop.
+
+    Metrics: request_hook_calls, request_hook_invocations,
+    request_hook_retries, request_hook_failures, request_hook_queued,
+    and request_hook_seconds.
+
+    Parameters
+    ----------
+    workers: int
+    max_attempts: int
+    retry_delay: float, seconds before the first retry
+    journal: str, optional, path to a sqlite database
+
+    """
+
+    def __init__(self, workers=4, max_attempts=3, retry_delay=5, journal=None):
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='request-hook')
+        self.pending = collections.deque()
+        self.changed = Condition()
+        self.db = None
+        self.journal_executor = None
+        self.next_id = 0
+        if journal:
+            # only used by the journal thread, once started
+            self.db = sqlite3.connect(journal, check_same_thread=False)
+            self.db.execute('pragma journal_mode=wal')
+            self.db.execute(
+                'create table if not exists hooks(id integer primary key, path text, '
+                'sudo int, max_batch int, params text, attempts int)'
+            )
+            self.db.commit()
+            self.next_id = self.db.execute('select coalesce(max(id), 0) from hooks').fetchone()[0]
+            self.journal_executor = ThreadPoolExecutor(
+                max_workers=1, thread_name_prefix='request-hook-journal'
+            )
+
+    def start(self):
+        """Start the workers, and queue calls left over in the journal."""
+        if self.db:
+            rows = self.db.execute(
+                'select id, path, sudo, max_batch, params, attempts from hooks order by id'
+            ).fetchall()
+            for call_id, path, sudo, max_batch, params, attempts in rows:
+                self._enqueue(_HookCall(call_id, path, bool(sudo), max_batch, json.loads(params), attempts))
+            if rows:
+                logging.info('resuming %d request hook calls', len(rows))
+        for _ in range(self.workers):
+            IOLoop.current().spawn_callback(self._work)
+
+    def _enqueue(self, call):
+        self.pending.append(call)
+        metrics.set('request_hook_queued', len(self.pending))
+        self.changed.notify()
+
+    def submit(self, hook_config, params):
+        """
+        Queue a call to a request hook.
+
+        Parameters
+        ----------
+        hook_config: dict, with path, sudo, and optionally max_batch
+        params: list of str, arguments for one file
+
+        Returns
+        -------
+        tornado.concurrent.Future, resolving to True when
+        the hook has run, or False if it failed
+
+        """
+        path, sudo = hook_config['path'], bool(hook_config.get('sudo'))
+        max_batch = hook_config.get('max_batch', 1)
+        self.next_id += 1
+        call = _HookCall(self.next_id, path, sudo, max_batch, params)
+        self._journal_many(
+            'insert into hooks(id, path, sudo, max_batch, params, attempts) values (?, ?, ?, ?, ?, 0)',
+            [(call.call_id, path, int(sudo), max_batch, json.dumps(params))]
+        )
+        self._enqueue(call)
+        return call.future
+
+    @gen.coroutine
+    def _work(self):
+        while True:
+            while not self.pending:
+                yield self.changed.wait()
+            batch = [self.pending.popleft()]
+            while (len(batch) < batch[0].max_batch and self.pending
+                   and self.pending[0].key == batch[0].key):
+                batch.append(self.pending.popleft())
+            metrics.set('request_hook_queued', len(self.pending))
+            try:
+                yield self._run(batch)
+            except Exception as e:
+                logging.error(e)
+
+    @gen.coroutine
+    def _run(self, batch):
+        first = batch[0]
+        cmd = request_hook_command(first.path, [call.params for call in batch], first.sudo)
+        start = time.time()
+        output = b''
+        try:
+            result = yield IOLoop.current().run_in_executor(
+                self.executor, lambda: subprocess.run(cmd, stdout=subprocess.PIPE)
+            )
+            returncode, output = result.returncode, result.stdout
+        except Exception as e:
+            logging.error(e)
+            returncode = None
+        metrics.observe('request_hook_seconds', time.time() - start)
+        metrics.incr('request_hook_invocations')
+        if returncode == 0:
+            self._succeeded(batch)
+            return
+        reported = reported_failures(output, len(batch)) if len(batch) > 1 else None
+        if reported is not None:
+            self._succeeded([call for i, call in enumerate(batch) if i not in reported])
+            batch = [call for i, call in enumerate(batch) if i in reported]
+        retry, failed = [], []
+        for call in batch:
+            call.attempts += 1
+            # retry alone, so that one bad call cannot fail the others again
+            call.max_batch = 1
+            (retry if call.attempts < self.max_attempts else failed).append(call)
+        if retry:
+            delay = self.retry_delay * 2 ** (retry[0].attempts - 1)
+            logging.warning(
+                'request hook %s failed (%s), retrying %d calls in %ss',
+                first.path, returncode, len(retry), delay
+            )
+            metrics.incr('request_hook_retries', len(retry))
+            self._journal_many(
+                'update hooks set attempts = attempts + 1 where id = ?',
+                [(call.call_id,) for call in retry]
+            )
+            IOLoop.current().call_later(delay, self._retry, retry)
+        if failed:
+            logging.error(
+                'request hook %s failed %d times, giving up on: %s',
+                first.path, self.max_attempts, [call.params for call in failed]
+            )
+            metrics.incr('request_hook_failures', len(failed))
+            self._journal_done([(call.call_id,) for call in failed])
+            for call in failed:
+                call.future.set_result(False)
+
+    def _succeeded(self, calls):
+        if not calls:
+            return
+        metrics.incr('request_hook_calls', len(calls))
+        self._journal_done([(call.call_id,) for call in calls])
+        for call in calls:
+            call.future.set_result(True)
+
+    def _journal_many(self, statement, rows):
+        if self.db:
+            self.journal_executor.submit(self._write_journal, statement, rows)
+
+    def _write_journal(self, statement, rows):
+        try:
+            with self.db:
+                self.db.executemany(statement, rows)
+        except sqlite3.Error as e:
+            logging.error(e)
+
+    def _journal_done(self, ids):
+        self._journal_many('delete from hooks where id = ?', ids)
+
+    def _retry(self, batch):
+        for call in batch:
+            self._enqueue(call)
@@ -0,0 +1,428 @@
+"""
+Snapshots of directory listings, for cursor-based pagination,
+indexes of directories, for sorted and filtered listings, and
+recursive manifests of directory trees, for sync clients.
+
+"""
+
+import base64
+import binascii
+import bisect
+import collections
+import fnmatch
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+from uuid import uuid4
+
+from tornado.iostream import StreamClosedError
+
+from archives import ArchiveAborted
+
+
+MANIFEST_HASHES = ['md5', 'sha256']
+
+
+class ListingCursorError(Exception):
+    message = 'Invalid listing cursor'
+
+
+class ListingEntry(object):
+
+    """
+    An entry of a directory listing, with the same
+    name, path and stat() interface as os.DirEntry.
+
+    """
+
+    __slots__ = ('name', 'path', '_stat')
+
+    def __init__(self, name, path, stat_result):
+        self.name = name
+        self.path = path
+        self._stat = stat_result
+
+    def stat(self):
+        return self._stat
+
+
+class ListingSnapshots(object):
+
+    """
+    The sorted entry names of directories being paged through,
+    kept for ttl seconds, so that every page after the first only
+    costs as much as the entries on it, and so that the order
+    does not change while a client is paging.
+
+    There is at most one snapshot per directory (and ordering),
+    which is reused by new listings for as long as the mtime of the
+    directory is unchanged, so clients which keep listing the first
+    page neither list the directory again, nor take up more space.
+    At most max_snapshots snapshots, with max_names names in total,
+    are kept - the oldest are dropped first, and directories with
+    more than max_names entries are not kept at all.
+
+    If a snapshot has expired, was dropped, or was made by another
+    process, the directory is listed again, and the listing continues
+    after the last name on the previous page, in the same order.
+
+    Parameters
+    ----------
+    ttl: int, seconds
+    max_snapshots: int
+    max_names: int
+
+    """
+
+    def __init__(self, ttl=300, max_snapshots=100, max_names=2000000):
+        self.ttl = ttl
+        self.max_snapshots = max_snapshots
+        self.max_names = max_names
+        self.snapshots = collections.OrderedDict()
+        self.by_path = {}
+        self.num_names = 0
+        self._lock = threading.Lock()
+
+    def _drop(self, snapshot_id):
+        path, names, expires, dir_mtime = self.snapshots.pop(snapshot_id)
+        self.num_names -= len(names)
+        if self.by_path.get(path) == snapshot_id:
+            del self.by_path[path]
+
+    def _expire(self):
+        now = time.time()
+        while self.snapshots:
+            snapshot_id, (path, names, expires, dir_mtime) = next(iter(self.snapshots.items()))
+            if (
+                expires > now
+                and len(self.snapshots) <= self.max_snapshots
+                and self.num_names <= self.max_names
+            ):
+                break
+            self._drop(snapshot_id)
+
+    def create(self, path, names, dir_mtime=None, snapshot_id=None):
+        """
+        Keep the names in a directory, replacing an earlier
+        snapshot of it, if any, and return the snapshot id.
+
+        """
+        snapshot_id = snapshot_id or uuid4().hex
+        if len(names) > self.max_names:
+            return snapshot_id
+        with self._lock:
+            earlier = self.by_path.get(path)
+            if earlier:
+                self._drop(earlier)
+            self.snapshots[snapshot_id] = (path, names, time.time() + self.ttl, dir_mtime)
+            self.by_path[path] = snapshot_id
+            self.num_names += len(names)
+            self._expire()
+        return snapshot_id
+
+    def get(self, snapshot_id, path):
+        """Return the names in the snapshot, or None."""
+        with self._lock:
+            self._expire()
+            snapshot = self.snapshots.get(snapshot_id)
+        if not snapshot or snapshot[0] != path:
+            return None
+        return snapshot[1]
+
+    def find(self, path, dir_mtime):
+        """
+        Find the snapshot of a directory, if it was made
+        while the directory had the given mtime.
+
+        Returns
+        -------
+        (str, list), snapshot id and names, or (None, None)
+
+        """
+        with self._lock:
+            self._expire()
+            snapshot_id = self.by_path.get(path)
+            if snapshot_id:
+                snapshot = self.snapshots[snapshot_id]
+                if dir_mtime is not None and snapshot[3] == dir_mtime:
+                    return snapshot_id, snapshot[1]
+        return None, None
+
+
+def scan_names(path):
+    """Return the names in a directory, sorted."""
+    with os.scandir(path) as entries:
+        return sorted(entry.name for entry in entries)
+
+
+def page_entries(path, names):
+    """
+    Stat the named entries of a directory, leaving
+    out those which have been removed in the meantime.
+
+    Returns
+    -------
+    list of ListingEntry
+
+    """
+    entries = []
+    for name in names:
+        entry_path = os.path.join(path, name)
+        try:
+            entries.append(ListingEntry(name, entry_path, os.stat(entry_path)))
+        except FileNotFoundError:
+            continue
+    return entries
+
+
+def entry_batches(path, batch_size, names=None):
+    """
+    Get the entries of a directory in batches, without listing all
+    of it first: in directory order, or, if names are given, those
+    entries, in that order. Blocking, so iterate on a worker thread.
+
+    Yields
+    ------
+    list of os.DirEntry, or ListingEntry
+
+    """
+    if names is not None:
+        for start in range(0, len(names), batch_size):
+            yield page_entries(path, names[start:start + batch_size])
+        return
+    with os.scandir(path) as entries:
+        batch = []
+        for entry in entries:
+            batch.append(entry)
+            if len(batch) == batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+
+def resume_offset(names, last_name, offset=0, by_name=True):
+    """
+    Where to continue in a list of names, after last_name.
+
+    If the names are sorted by name, the position is found even if
+    last_name has been removed, otherwise, offset is used in that case.
+
+    """
+    if by_name:
+        return bisect.bisect_right(names, last_name)
+    try:
+        return names.index(last_name) + 1
+    except ValueError:
+        return min(offset, len(names))
+
+
+class DirectoryIndex(object):
+
+    """
+    The name, size and mtime of every entry in recently listed
+    directories, so that sorting and filtering does not require
+    a full scan of a directory for every request.
+
+    An index is built when a directory is first needed, and
+    rebuilt when the mtime of the directory changes - which happens
+    when entries are added, removed or renamed - or when it is
+    older than max_age seconds, since changes to the content of
+    files do not change the mtime of the directory.
+
+    Parameters
+    ----------
+    max_dirs: int, least recently used indexes are dropped first
+    max_age: int, seconds
+
+    """
+
+    def __init__(self, max_dirs=100, max_age=300):
+        self.max_dirs = max_dirs
+        self.max_age = max_age
+        self.indexes = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def entries(self, path):
+        """
+        Get the indexed entries of a directory, blocking.
+
+        Returns
+        -------
+        list of (str, int, float), name, size and mtime
+
+        """
+        dir_mtime = os.stat(path).st_mtime_ns
+        with self._lock:
+            index = self.indexes.get(path)
+            if index and index[0] == dir_mtime and index[1] > time.time():
+                self.indexes.move_to_end(path)
+                return index[2]
+        entries = []
+        with os.scandir(path) as dir_entries:
+            for entry in dir_entries:
+                try:
+                    info = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((entry.name, info.st_size, info.st_mtime))
+        with self._lock:
+            self.indexes[path] = (dir_mtime, time.time() + self.max_age, entries)
+            self.indexes.move_to_end(path)
+            while len(self.indexes) > self.max_dirs:
+                self.indexes.popitem(last=False)
+        return entries
+
+
+_SORT_KEYS = {
+    'name': lambda entry: entry[0],
+    'size': lambda entry: (entry[1], entry[0]),
+    'mtime': lambda entry: (entry[2], entry[0]),
+}
+
+
+def order_names(entries, sort='name', reverse=False, name_glob=None,
+                mtime_from=None, mtime_to=None):
+    """
+    Filter and sort indexed directory entries.
+
+    Parameters
+    ----------
+    entries: list, see DirectoryIndex.entries
+    sort: str, name, size, or mtime
+    reverse: bool, sort in descending order
+    name_glob: str, shell-style pattern which names must match
+    mtime_from: float, minimum mtime, inclusive
+    mtime_to: float, maximum mtime, inclusive
+
+    Returns
+    -------
+    list of str, names
+
+    """
+    selected = [
+        entry for entry in entries
+        if (name_glob is None or fnmatch.fnmatchcase(entry[0], name_glob))
+        and (mtime_from is None or entry[2] >= mtime_from)
+        and (mtime_to is None or entry[2] <= mtime_to)
+    ]
+    selected.sort(key=_SORT_KEYS[sort], reverse=reverse)
+    return [entry[0] for entry in selected]
+
+
+def encode_cursor(snapshot_id, offset, last_name):
+    data = json.dumps({'s': snapshot_id, 'o': offset, 'n': last_name})
+    return base64.urlsafe_b64encode(data.encode('utf-8')).decode('utf-8').rstrip('=')
+
+
+def decode_cursor(cursor):
+    """
+    Returns
+    -------
+    (str, int, str), snapshot id, offset, and last name on the previous page
+
+    """
+    try:
+        data = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        snapshot_id, offset, last_name = data['s'], int(data['o']), data['n']
+        assert isinstance(snapshot_id, str) and isinstance(last_name, str) and offset >= 0
+        return snapshot_id, offset, last_name
+    except (ValueError, KeyError, TypeError, AssertionError, binascii.Error) as e:
+        raise ListingCursorError from e
+
+
+def manifest_entries(path, skip_start_chars=''):
+    """
+    Find the files in a directory tree, recursively, with os.scandir.
+    Symlinks are not followed, and names starting with any of
+    skip_start_chars are left out, along with their subtrees.
+
+    Yields
+    ------
+    (str, str, os.stat_result), path, path relative to the root, stat
+
+    """
+    stack = ['']
+    while stack:
+        relative_dir = stack.pop()
+        current = os.path.join(path, relative_dir) if relative_dir else path
+        try:
+            with os.scandir(current) as entries:
+                entries = sorted(entries, key=lambda entry: entry.name)
+        except (FileNotFoundError, NotADirectoryError):
+            continue
+        subdirs = []
+        for entry in entries:
+            if skip_start_chars and entry.name[0] in skip_start_chars:
+                continue
+            relative_path = os.path.join(relative_dir, entry.name) if relative_dir else entry.name
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(relative_path)
+                elif entry.is_file(follow_symlinks=False):
+                    yield entry.path, relative_path, entry.stat(follow_symlinks=False)
+            except FileNotFoundError:
+                continue
+        stack.extend(reversed(subdirs))
+
+
+def file_digest(filepath, hash_name, blocksize=1048576):
+    _hash = hashlib.new(hash_name)
+    with open(filepath, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b''):
+            _hash.update(block)
+    return _hash.hexdigest()
+
+
+def write_manifest(writer, path, etag, hash_name=None, skip_start_chars='', digests=None):
+    """
+    Write a manifest of a directory tree to writer, as NDJSON: one
+    object per file, with its relative path, size, mtime, and etag,
+    and optionally a hash of its content. Runs on a worker thread.
+
+    Parameters
+    ----------
+    writer: archives.ArchiveWriter
+    path: str, root of the tree
+    etag: callable, which takes a path and stat_result, and returns an etag
+    hash_name: str, optional, one of MANIFEST_HASHES
+    skip_start_chars: str, see manifest_entries
+    digests: checksums.ContentDigests, optional - hashes which are
+        stored there are not computed again
+
+    Returns
+    -------
+    int, number of files in the manifest
+
+    """
+    num_files = 0
+    try:
+        for filepath, relative_path, info in manifest_entries(path, skip_start_chars):
+            entry = {
+                'path': relative_path,
+                'size': info.st_size,
+                'mtime': info.st_mtime,
+                'etag': etag(filepath, info),
+            }
+            if hash_name:
+                try:
+                    entry[hash_name] = (
+                        (digests and digests.get(info, hash_name))
+                        or file_digest(filepath, hash_name)
+                    )
+                except FileNotFoundError:
+                    continue
+            writer.write(json.dumps(entry).encode('utf-8') + b'\n')
+            num_files += 1
+        writer.finish()
+    except ArchiveAborted:
+        writer.finish(StreamClosedError())
+    except Exception as e:
+        logging.error(e)
+        writer.finish(e)
+        raise e
+    return num_files
@@ -0,0 +1,195 @@
+"""File MIME type detection, and a cache of its results."""
+
+import collections
+import logging
+import os
+import sqlite3
+import stat
+import threading
+
+import magic
+
+from metrics import metrics
+
+
+def extension_mime_type(filename, extensions):
+    """
+    Look up the MIME type of a file by its extension, without
+    reading it. The longest matching extension wins, so that
+    e.g. tar.gz can be mapped separately from gz.
+
+    Parameters
+    ----------
+    filename: str
+    extensions: dict, extension (without leading .) -> MIME type
+
+    Returns
+    -------
+    str, or None if the extension is not mapped
+
+    """
+    if not extensions:
+        return None
+    parts = os.path.basename(filename).lower().split('.')[1:]
+    for i in range(len(parts)):
+        mime_type = extensions.get('.'.join(parts[i:]))
+        if mime_type:
+            return mime_type
+    return None
+
+
+_SPECIAL_FILE_TYPES = {
+    stat.S_IFIFO: 'inode/fifo',
+    stat.S_IFSOCK: 'inode/socket',
+    stat.S_IFCHR: 'inode/chardevice',
+    stat.S_IFBLK: 'inode/blockdevice',
+}
+
+
+def sniff_mime_type(filename, info, header_bytes=65536):
+    """
+    Detect the MIME type of a file with libmagic, from at most
+    the first header_bytes of its content, read with a single pread,
+    or, if header_bytes is not set, from as much of the file as
+    libmagic reads itself.
+
+    Directories, empty files, and special files, are recognised
+    from the stat_result, without opening them, so a fifo cannot block.
+
+    Parameters
+    ----------
+    filename: str
+    info: os.stat_result
+    header_bytes: int, or None
+
+    Returns
+    -------
+    str
+
+    Raises
+    ------
+    PermissionError, if the file cannot be read
+
+    """
+    if stat.S_ISDIR(info.st_mode):
+        if not os.access(filename, os.R_OK):
+            raise PermissionError(filename)
+        return 'directory'
+    if not stat.S_ISREG(info.st_mode):
+        return _SPECIAL_FILE_TYPES.get(stat.S_IFMT(info.st_mode), 'unknown')
+    if info.st_size == 0:
+        return 'inode/x-empty'
+    if not header_bytes:
+        return magic.from_file(filename, mime=True)
+    fd = os.open(filename, os.O_RDONLY)
+    try:
+        header = os.pread(fd, header_bytes, 0)
+    finally:
+        os.close(fd)
+    return magic.from_buffer(header, mime=True)
+
+
+class FileMetadataCache(object):
+
+    """
+    Cache the MIME types of files, to avoid reading file content
+    every time a file is listed, or inspected.
+
+    Entries are keyed by (device, inode, size, mtime, ctime), taken
+    from a stat_result, so a file which changes, or is replaced, is
+    never served from a stale entry, even if its mtime is reset,
+    e.g. with touch -d, since that updates its ctime. Size, mtime
+    and etags are cheap to get from the same stat_result, so they
+    are not stored.
+
+    The most recently used max_entries entries are kept in memory.
+    If persist_dir is given, entries are also stored in one
+    sqlite database per tenant, so that they survive restarts.
+
+    Thread-safe, since metadata is computed on worker threads.
+
+    Parameters
+    ----------
+    max_entries: int
+    persist_dir: str, optional
+
+    """
+
+    def __init__(self, max_entries=100000, persist_dir=None):
+        self.max_entries = max_entries
+        self.persist_dir = persist_dir
+        self.entries = collections.OrderedDict()
+        self.dbs = {}
+        self._lock = threading.Lock()
+
+    def _key(self, info):
+        return (info.st_dev, info.st_ino, info.st_size, info.st_mtime_ns, info.st_ctime_ns)
+
+    def _db(self, tenant):
+        db = self.dbs.get(tenant)
+        if not db:
+            db = sqlite3.connect(
+                os.path.join(self.persist_dir, f'metadata-{tenant}.db'),
+                check_same_thread=False
+            )
+            db.execute('pragma journal_mode=wal')
+            db.execute('pragma synchronous=off')
+            columns = [row[1] for row in db.execute('pragma table_info(metadata)')]
+            if columns and 'ctime_ns' not in columns:
+                db.execute('drop table metadata') # from an earlier version, only a cache
+            db.execute(
+                'create table if not exists metadata(dev int, ino int, size int, '
+                'mtime_ns int, ctime_ns int, mime_type text, primary key (dev, ino))'
+            )
+            self.dbs[tenant] = db
+        return db
+
+    def _remember(self, key, mime_type):
+        self.entries[key] = mime_type
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def get(self, tenant, info):
+        """
+        Parameters
+        ----------
+        tenant: str
+        info: os.stat_result
+
+        Returns
+        -------
+        str, MIME type, or None if not cached
+
+        """
+        key = self._key(info)
+        with self._lock:
+            mime_type = self.entries.get(key)
+            if mime_type is not None:
+                self.entries.move_to_end(key)
+            elif self.persist_dir:
+                try:
+                    row = self._db(tenant).execute(
+                        'select size, mtime_ns, ctime_ns, mime_type from metadata where dev = ? and ino = ?',
+                        key[:2]
+                    ).fetchone()
+                    if row and tuple(row[:3]) == key[2:]:
+                        mime_type = row[3]
+                        self._remember(key, mime_type)
+                except sqlite3.Error as e:
+                    logging.error(e)
+        metrics.incr('metadata_cache_hits' if mime_type else 'metadata_cache_misses')
+        return mime_type
+
+    def put(self, tenant, info, mime_type):
+        key = self._key(info)
+        with self._lock:
+            self._remember(key, mime_type)
+            if self.persist_dir:
+                try:
+                    db = self._db(tenant)
+                    # one row per inode, so changed files replace their entries
+                    db.execute('insert or replace into metadata values (?, ?, ?, ?, ?, ?)', key + (mime_type,))
+                    db.commit()
+                except sqlite3.Error as e:
+                    logging.error(e)
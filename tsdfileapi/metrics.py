@@ -0,0 +1,51 @@
+"""Process-wide counters, gauges and timings, reported by the admin API."""
+
+import threading
+
+
+class Metrics(object):
+
+    """
+    A minimal, thread-safe, in-memory metrics registry.
+
+    Counters only ever increase, gauges go up and down,
+    and timings keep a count, total and max of observed
+    durations, in seconds.
+
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.timings = {}
+
+    def incr(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def adjust(self, name, delta):
+        with self._lock:
+            self.gauges[name] = self.gauges.get(name, 0) + delta
+
+    def set(self, name, value):
+        with self._lock:
+            self.gauges[name] = value
+
+    def observe(self, name, seconds):
+        with self._lock:
+            timing = self.timings.setdefault(name, {'count': 0, 'total': 0.0, 'max': 0.0})
+            timing['count'] += 1
+            timing['total'] += seconds
+            timing['max'] = max(timing['max'], seconds)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'counters': dict(self.counters),
+                'gauges': dict(self.gauges),
+                'timings': {k: dict(v) for k, v in self.timings.items()},
+            }
+
+
+metrics = Metrics()
@@ -0,0 +1,118 @@
+"""
+Decryption of data encrypted with crypto_stream_xor, by clients,
+in frames of Nacl-Chunksize bytes, each with the same key and nonce.
+
+Frames are decrypted in place, in a bytearray, with one call into
+libsodium per frame, instead of byte by byte, and without holding
+the GIL, so decryption can run on worker threads.
+
+"""
+
+import ctypes
+
+import libnacl
+
+
+_crypto_stream_xor = libnacl.nacl.crypto_stream_xor
+
+
+def xor_frames(buffer, nonce, key, chunksize, end=None):
+    """
+    Decrypt (or encrypt) the frames in buffer[:end], in place.
+    The last frame may be shorter than chunksize.
+
+    Parameters
+    ----------
+    buffer: bytearray
+    nonce: bytes
+    key: bytes
+    chunksize: int
+    end: int, optional, defaults to len(buffer)
+
+    """
+    end = len(buffer) if end is None else end
+    if not end:
+        return
+    # one view for all frames, released before returning,
+    # so that the buffer can be resized again
+    view = (ctypes.c_char * end).from_buffer(buffer)
+    base = ctypes.addressof(view)
+    try:
+        for offset in range(0, end, chunksize):
+            frame = ctypes.c_void_p(base + offset)
+            length = ctypes.c_ulonglong(min(chunksize, end - offset))
+            if _crypto_stream_xor(frame, frame, length, nonce, key):
+                raise ValueError('Failed to decrypt frame')
+    finally:
+        del view
+
+
+class NaclStreamDecryptor(object):
+
+    """
+    Decrypt a stream which arrives in pieces of any size.
+
+    Whole frames are decrypted as soon as they have arrived, and the
+    rest is kept until the next piece, or until finalize is called.
+
+    Parameters
+    ----------
+    nonce: bytes
+    key: bytes
+    chunksize: int, size of the frames
+
+    """
+
+    def __init__(self, nonce, key, chunksize):
+        if len(key) != libnacl.crypto_stream_KEYBYTES:
+            raise ValueError('Invalid secret key')
+        if len(nonce) != libnacl.crypto_stream_NONCEBYTES:
+            raise ValueError('Invalid nonce')
+        if chunksize < 1:
+            raise ValueError('Invalid chunksize')
+        self.nonce = nonce
+        self.key = key
+        self.chunksize = chunksize
+        self.buffer = bytearray()
+
+    def update(self, data):
+        """
+        Returns
+        -------
+        bytearray, the decrypted frames completed by data, possibly empty
+
+        """
+        self.buffer += data
+        end = len(self.buffer) - len(self.buffer) % self.chunksize
+        if not end:
+            return bytearray()
+        out, self.buffer = self.buffer, self.buffer[end:]
+        del out[end:]
+        xor_frames(out, self.nonce, self.key, self.chunksize)
+        return out
+
+    def finalize(self):
+        """
+        Returns
+        -------
+        bytearray, the last, incomplete, frame, decrypted, possibly empty
+
+        """
+        out, self.buffer = self.buffer, bytearray()
+        xor_frames(out, self.nonce, self.key, self.chunksize)
+        return out
+
+
+def decrypt_nacl_payload(data, nonce, key, chunksize):
+    """
+    Decrypt a whole payload, into one preallocated buffer.
+
+    Returns
+    -------
+    bytearray
+
+    """
+    decryptor = NaclStreamDecryptor(nonce, key, chunksize)
+    out = bytearray(data)
+    xor_frames(out, decryptor.nonce, decryptor.key, decryptor.chunksize)
+    return out
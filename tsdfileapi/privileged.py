@@ -0,0 +1,481 @@
+"""
+A privileged helper, which changes the ownership and modes of files
+on behalf of the API, so that the API does not have to start a new
+sudo process every time it needs to do so.
+
+Run it as root, with the same config file as the API:
+
+    python privileged.py /etc/tsd-file-api/config.yaml
+
+It listens on the unix socket configured as privileged_helper_socket,
+which only the api_user can connect to, and accepts requests, one
+JSON object per line, e.g.:
+
+    {"id": 1, "op": "chmod", "path": "/p11/import/d", "add": 37, "recursive": true}
+    {"id": 2, "op": "chmod", "path": "/p11/import/d", "mode": 1528}
+    {"id": 3, "op": "chown", "path": "/p11/import/d", "owner": "nobody", "group": "p11-member-group"}
+
+Replies are sent in the same way: {"id": 1, "ok": true}, or
+{"id": 1, "ok": false, "error": "..."}. All requests which have
+arrived are executed concurrently, and their replies are written
+together, so bursts of requests cost one round trip.
+
+Only paths in the import and export directories of the configured
+disk backends can be changed, and nothing can be given to root,
+or be made setuid. Paths are opened without following symlinks,
+and changed through the open file descriptors, so files cannot be
+swapped for symlinks to other files after they have been checked.
+Symlinks are left unchanged.
+
+"""
+
+import concurrent.futures
+import errno
+import functools
+import grp
+import json
+import logging
+import os
+import pwd
+import re
+import socket
+import stat
+import subprocess
+import sys
+
+from datetime import timedelta
+
+import yaml
+
+from tornado import gen
+from tornado.concurrent import Future, chain_future
+from tornado.ioloop import IOLoop
+from tornado.iostream import IOStream, StreamClosedError
+from tornado.netutil import bind_unix_socket
+from tornado.tcpserver import TCPServer
+
+
+OPERATIONS = ['chmod', 'chown']
+ALLOWED_MODE_BITS = 0o2777 # no setuid, no sticky bit
+
+
+class PrivilegedHelperError(Exception):
+    message = 'Privileged operation failed'
+
+
+def allowed_roots(config):
+    """
+    Get the directories in which the helper may change files:
+    the import and export paths of all disk backends, with the
+    tenant string pattern matching any valid tenant.
+
+    Returns
+    -------
+    list of re.Pattern
+
+    """
+    tenant = config['valid_tenant_regex'].lstrip('^').rstrip('$')
+    pattern = config['tenant_string_pattern']
+    roots = set()
+    for backend in config['backends']['disk'].values():
+        for key in ['import_path', 'export_path']:
+            path = backend.get(key)
+            if path and os.path.isabs(path):
+                roots.add(os.path.normpath(path))
+    return [
+        re.compile('^{}(/|$)'.format(re.escape(root).replace(re.escape(pattern), f'({tenant})')))
+        for root in sorted(roots)
+    ]
+
+
+def check_path(path, roots):
+    """
+    Resolve symlinks in a path, and make sure the result is
+    in one of the allowed roots.
+
+    Returns
+    -------
+    str, resolved path
+
+    """
+    if not isinstance(path, str) or not os.path.isabs(path):
+        raise PrivilegedHelperError(f'not an absolute path: {path}')
+    resolved = os.path.realpath(path)
+    if not any(root.match(resolved) for root in roots):
+        raise PrivilegedHelperError(f'path not allowed: {path}')
+    if not os.path.lexists(resolved):
+        raise PrivilegedHelperError(f'path does not exist: {path}')
+    return resolved
+
+
+def _open_dir(path):
+    """
+    Open a directory, from the root, one component at a time,
+    without following symlinks, so that it cannot be redirected
+    after it has been checked, by replacing one of them with a symlink.
+
+    """
+    fd = os.open('/', os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        for name in path.strip('/').split('/'):
+            if not name:
+                continue
+            try:
+                next_fd = os.open(name, os.O_RDONLY | os.O_DIRECTORY | os.O_NOFOLLOW, dir_fd=fd)
+            except OSError as e:
+                if e.errno in (errno.ELOOP, errno.ENOTDIR):
+                    raise PrivilegedHelperError(f'path changed: {path}') from e
+                raise
+            os.close(fd)
+            fd = next_fd
+    except BaseException:
+        os.close(fd)
+        raise
+    return fd
+
+
+def _open_entry(name, dir_fd):
+    """
+    Open an entry of a directory, without following symlinks, as
+    an O_PATH descriptor, so that special files are not opened
+    for reading, see _fd_path.
+
+    Returns
+    -------
+    int, file descriptor, or None if the entry is a symlink, or is gone
+
+    """
+    try:
+        fd = os.open(name, os.O_PATH | os.O_NOFOLLOW, dir_fd=dir_fd)
+    except FileNotFoundError:
+        return None
+    if stat.S_ISLNK(os.fstat(fd).st_mode):
+        os.close(fd)
+        return None
+    return fd
+
+
+def _fd_path(fd):
+    """
+    The path of an open file, in /proc, which refers to the file
+    itself, even if its name has been given to another file since -
+    fchmod and fchown do not accept O_PATH descriptors.
+
+    """
+    return f'/proc/self/fd/{fd}'
+
+
+def _walk(path, recursive):
+    """
+    Open path, and, if recursive, everything below it, except
+    symlinks, without following symlinks, and yield the file
+    descriptors, which are closed afterwards.
+
+    Changes are made with the descriptors, so they only ever
+    apply to the files which were found in path, even if they
+    are replaced with symlinks in the meantime.
+
+    """
+    parent, name = os.path.split(path)
+    parent_fd = _open_dir(parent)
+    try:
+        fd = _open_entry(name, parent_fd)
+    finally:
+        os.close(parent_fd)
+    if fd is None:
+        raise PrivilegedHelperError(f'path changed: {path}')
+    try:
+        yield fd
+        if not recursive or not stat.S_ISDIR(os.fstat(fd).st_mode):
+            return
+        for current, dirs, files, current_fd in os.fwalk('.', dir_fd=fd):
+            for name in dirs + files:
+                entry_fd = _open_entry(name, current_fd)
+                if entry_fd is None:
+                    continue
+                try:
+                    yield entry_fd
+                finally:
+                    os.close(entry_fd)
+    finally:
+        os.close(fd)
+
+
+def apply_chmod(path, mode=None, add=None, remove=None, recursive=False):
+    for bits in [mode, add, remove]:
+        if bits is not None and (not isinstance(bits, int) or bits & ~ALLOWED_MODE_BITS):
+            raise PrivilegedHelperError(f'mode not allowed: {bits}')
+    if mode is None and add is None and remove is None:
+        raise PrivilegedHelperError('missing mode')
+    for fd in _walk(path, recursive):
+        if mode is not None:
+            new_mode = mode
+        else:
+            new_mode = (os.fstat(fd).st_mode & 0o7777 | (add or 0)) & ~(remove or 0)
+        os.chmod(_fd_path(fd), new_mode)
+
+
+def apply_chown(path, owner, group, recursive=False):
+    try:
+        uid = pwd.getpwnam(owner).pw_uid
+        gid = grp.getgrnam(group).gr_gid
+    except (KeyError, TypeError) as e:
+        raise PrivilegedHelperError(f'unknown owner or group: {owner}:{group}') from e
+    if uid == 0 or gid == 0:
+        raise PrivilegedHelperError('cannot give files to root')
+    for fd in _walk(path, recursive):
+        os.chown(_fd_path(fd), uid, gid)
+
+
+def execute(line, roots):
+    """
+    Execute one request, and return the reply.
+
+    Parameters
+    ----------
+    line: bytes, JSON encoded request
+    roots: list, see allowed_roots
+
+    Returns
+    -------
+    dict
+
+    """
+    request_id = None
+    try:
+        request = json.loads(line)
+        request_id = request.get('id')
+        op = request.get('op')
+        if op not in OPERATIONS:
+            raise PrivilegedHelperError(f'operation not allowed: {op}')
+        path = check_path(request.get('path'), roots)
+        if op == 'chmod':
+            apply_chmod(
+                path, request.get('mode'), request.get('add'),
+                request.get('remove'), bool(request.get('recursive'))
+            )
+        else:
+            apply_chown(
+                path, request.get('owner'), request.get('group'),
+                bool(request.get('recursive'))
+            )
+        logging.info('%s', request)
+        return {'id': request_id, 'ok': True}
+    except Exception as e:
+        logging.error(e)
+        return {'id': request_id, 'ok': False, 'error': str(e)}
+
+
+class PrivilegedHelperServer(TCPServer):
+
+    """
+    Serve requests from the API, on a unix socket.
+
+    Parameters
+    ----------
+    roots: list, see allowed_roots
+    executor: concurrent.futures.Executor, on which requests are executed
+
+    """
+
+    def __init__(self, roots, executor, **kwargs):
+        super().__init__(**kwargs)
+        self.roots = roots
+        self.executor = executor
+
+    @gen.coroutine
+    def handle_stream(self, stream, address):
+        io_loop = IOLoop.current()
+        buffer = b''
+        try:
+            while True:
+                buffer += yield stream.read_bytes(65536, partial=True)
+                *lines, buffer = buffer.split(b'\n')
+                if not lines:
+                    continue
+                replies = yield [
+                    io_loop.run_in_executor(self.executor, execute, line, self.roots)
+                    for line in lines
+                ]
+                yield stream.write(b''.join(json.dumps(reply).encode('utf-8') + b'\n' for reply in replies))
+        except StreamClosedError:
+            pass
+
+
+class PrivilegedHelperClient(object):
+
+    """
+    Send requests to the privileged helper, from the API.
+
+    One connection is kept open, and requests are written to it as
+    soon as they are made, without waiting for earlier replies,
+    so concurrent requests are batched by the socket. The connection
+    is made when it is first needed, and again if it is lost.
+
+    Parameters
+    ----------
+    socket_path: str
+    timeout: int, seconds to wait for a reply
+
+    """
+
+    def __init__(self, socket_path, timeout=30):
+        self.socket_path = socket_path
+        self.timeout = timeout
+        self.io_loop = IOLoop.current()
+        self.stream = None
+        self.connecting = None
+        self.pending = {}
+        self.next_id = 0
+
+    @gen.coroutine
+    def _connect(self):
+        stream = IOStream(socket.socket(socket.AF_UNIX, socket.SOCK_STREAM))
+        yield stream.connect(self.socket_path)
+        self.stream = stream
+        self.io_loop.spawn_callback(self._read_replies, stream)
+
+    @gen.coroutine
+    def _read_replies(self, stream):
+        try:
+            while True:
+                reply = json.loads((yield stream.read_until(b'\n')))
+                future = self.pending.pop(reply.get('id'), None)
+                if future and not future.done():
+                    future.set_result(reply)
+        except Exception as e:
+            if not isinstance(e, StreamClosedError):
+                logging.error(e)
+            stream.close()
+        finally:
+            if self.stream is stream:
+                self.stream = None
+            pending, self.pending = self.pending, {}
+            for future in pending.values():
+                if not future.done():
+                    future.set_exception(PrivilegedHelperError('connection to helper lost'))
+
+    @gen.coroutine
+    def call(self, op, path, **kwargs):
+        """
+        Make a request, on the event loop.
+
+        Parameters
+        ----------
+        op: str, one of OPERATIONS
+        path: str
+        kwargs: mode, add, remove, and recursive, for chmod,
+            owner, group, and recursive, for chown
+
+        """
+        if not self.stream:
+            if not self.connecting:
+                self.connecting = self._connect()
+            try:
+                yield self.connecting
+            except (OSError, StreamClosedError) as e:
+                raise PrivilegedHelperError(f'cannot connect to helper: {e}') from e
+            finally:
+                self.connecting = None
+        self.next_id += 1
+        request_id = self.next_id
+        future = Future()
+        self.pending[request_id] = future
+        request = {'id': request_id, 'op': op, 'path': path, **kwargs}
+        self.stream.write(json.dumps(request).encode('utf-8') + b'\n')
+        try:
+            reply = yield gen.with_timeout(timedelta(seconds=self.timeout), future)
+        except gen.TimeoutError as e:
+            self.pending.pop(request_id, None)
+            raise PrivilegedHelperError(f'{op} {path}: timed out') from e
+        if not reply['ok']:
+            raise PrivilegedHelperError(f"{op} {path}: {reply.get('error')}")
+
+    def call_blocking(self, op, path, **kwargs):
+        """Make a request, from another thread."""
+        future = concurrent.futures.Future()
+        self.io_loop.add_callback(
+            lambda: chain_future(self.call(op, path, **kwargs), future)
+        )
+        return future.result()
+
+
+def symbolic_mode(bits, sign):
+    """Express mode bits as a symbolic chmod mode, e.g. 0o045 -> g+r,o+rx."""
+    parts = []
+    for who, shift in [('u', 6), ('g', 3), ('o', 0)]:
+        perms = ''.join(
+            perm for perm, bit in [('r', 4), ('w', 2), ('x', 1)] if (bits >> shift) & bit
+        )
+        if perms:
+            parts.append(f'{who}{sign}{perms}')
+    if bits & 0o2000:
+        parts.append(f'g{sign}s')
+    return ','.join(parts)
+
+
+class SudoPrivileges(object):
+
+    """
+    The same interface as PrivilegedHelperClient, implemented with
+    sudo chmod and chown, for deployments without the helper.
+
+    """
+
+    def command(self, op, path, mode=None, add=None, remove=None,
+                owner=None, group=None, recursive=False):
+        cmd = ['sudo', op]
+        if recursive:
+            cmd.append('-R')
+        if op == 'chown':
+            cmd.append(f'{owner}:{group}')
+        elif mode is not None:
+            cmd.append(format(mode, 'o'))
+        else:
+            cmd.append(','.join(
+                spec for spec in [symbolic_mode(add or 0, '+'), symbolic_mode(remove or 0, '-')]
+                if spec
+            ))
+        cmd.append(path)
+        return cmd
+
+    def call_blocking(self, op, path, **kwargs):
+        try:
+            returncode = subprocess.call(self.command(op, path, **kwargs))
+        except OSError as e:
+            raise PrivilegedHelperError(f'{op} {path}: {e}') from e
+        if returncode != 0:
+            raise PrivilegedHelperError(f'{op} {path}: sudo failed')
+
+    @gen.coroutine
+    def call(self, op, path, **kwargs):
+        yield IOLoop.current().run_in_executor(
+            None, functools.partial(self.call_blocking, op, path, **kwargs)
+        )
+
+
+def main():
+    from tornado.log import enable_pretty_logging
+    enable_pretty_logging()
+    with open(sys.argv[1]) as f:
+        config = yaml.load(f, Loader=yaml.Loader)
+    socket_path = config.get('privileged_helper_socket')
+    if not socket_path:
+        sys.exit('privileged_helper_socket is not configured')
+    roots = allowed_roots(config)
+    for root in roots:
+        logging.info('allowing changes in: %s', root.pattern)
+    sock = bind_unix_socket(socket_path, mode=0o600)
+    os.chown(socket_path, pwd.getpwnam(config['api_user']).pw_uid, -1)
+    server = PrivilegedHelperServer(
+        roots,
+        concurrent.futures.ThreadPoolExecutor(
+            max_workers=config.get('privileged_helper_workers', 4)
+        )
+    )
+    server.add_socket(sock)
+    IOLoop.current().start()
+
+
+if __name__ == '__main__':
+    main()
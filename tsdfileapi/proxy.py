@@ -0,0 +1,387 @@
+"""Tools for the internal hop from the ProxyHandler to the StreamHandler."""
+
+import collections
+import functools
+import io
+import logging
+import socket
+import time
+
+from tornado import gen
+from tornado.concurrent import Future
+from tornado.httpclient import HTTPRequest, HTTPResponse
+from tornado.httputil import HTTPConnection, HTTPHeaders, RequestStartLine
+from tornado.iostream import StreamClosedError
+from tornado.locks import Condition
+from tornado.netutil import Resolver
+from tornado.simple_httpclient import SimpleAsyncHTTPClient
+
+from metrics import metrics
+
+
+def _done_future():
+    future = Future()
+    future.set_result(None)
+    return future
+
+
+class InProcessConnection(HTTPConnection):
+
+    """
+    A connection which collects the response of a request handler
+    in memory, instead of writing it to a socket.
+
+    """
+
+    def __init__(self, context=None):
+        self.context = context
+        self.start_line = None
+        self.headers = None
+        self.chunks = []
+        self.finished = False
+        self.response = Future()
+        self._close_callback = None
+
+    def set_close_callback(self, callback):
+        self._close_callback = callback
+
+    def write_headers(self, start_line, headers, chunk=None):
+        self.start_line = start_line
+        self.headers = headers
+        if chunk:
+            self.chunks.append(chunk)
+        return _done_future()
+
+    def write(self, chunk):
+        self.chunks.append(chunk)
+        return _done_future()
+
+    def finish(self):
+        self.finished = True
+        if not self.response.done():
+            self.response.set_result(b''.join(self.chunks))
+
+    def close(self):
+        callback, self._close_callback = self._close_callback, None
+        if callback:
+            callback()
+
+
+class InProcessRequest(object):
+
+    """
+    Drive a request handler of the application from within the process.
+
+    The application routes the request exactly as it would have, had
+    it arrived over HTTP, and the handler is taken through the same
+    life cycle: prepare, data_received, the HTTP method, on_finish.
+    Request body chunks are handed over as is, so they are not parsed,
+    queued, or copied through the kernel a second time.
+
+    Parameters
+    ----------
+    application: tornado.web.Application
+    method: str, HTTP method
+    uri: str, path and query of the internal request
+    headers: dict
+    context: connection context of the original request, optional
+
+    """
+
+    def __init__(self, application, method, uri, headers, context=None):
+        self.method = method
+        self.uri = uri
+        self.headers = HTTPHeaders(headers)
+        self.connection = InProcessConnection(context)
+        self.delegate = application.start_request(None, self.connection)
+
+    def start(self):
+        """Call the prepare method of the handler."""
+        start_line = RequestStartLine(self.method, self.uri, 'HTTP/1.1')
+        return self.delegate.headers_received(start_line, self.headers)
+
+    def data_received(self, chunk):
+        # like HTTP1Connection, stop passing on data once
+        # the handler has finished, e.g. after failing in prepare
+        if self.connection.finished:
+            return None
+        return self.delegate.data_received(chunk)
+
+    def finish(self):
+        """
+        Signal the end of the request body, and return a Future
+        which resolves to a tornado.httpclient.HTTPResponse.
+
+        """
+        if not self.connection.finished:
+            self.delegate.finish()
+        future = Future()
+        def on_response(response):
+            body = response.result()
+            start_line = self.connection.start_line
+            future.set_result(
+                HTTPResponse(
+                    HTTPRequest(self.uri, method=self.method),
+                    start_line.code,
+                    reason=start_line.reason,
+                    headers=self.connection.headers,
+                    buffer=io.BytesIO(body)
+                )
+            )
+        self.connection.response.add_done_callback(on_response)
+        return future
+
+    def close(self):
+        """Notify the handler that the client has gone away."""
+        if not self.connection.finished:
+            self.connection.close()
+
+
+class UnixSocketResolver(Resolver):
+
+    """
+    Resolve every host to a Unix domain socket, so that an HTTP
+    client using this resolver talks to the server listening
+    on that socket, regardless of the host in the URL.
+
+    """
+
+    def initialize(self, socket_path):
+        self.socket_path = socket_path
+
+    @gen.coroutine
+    def resolve(self, host, port, family=socket.AF_UNSPEC):
+        return [(socket.AF_UNIX, self.socket_path)]
+
+
+class InternalHTTPClient(object):
+
+    """
+    The HTTP client used for internal requests, created once per process.
+
+    Parameters
+    ----------
+    implementation: str, simple or curl (requires pycurl)
+    max_clients: int, max number of concurrent requests,
+        more requests than this are queued by the client
+    socket_path: str, optional unix domain socket to connect to
+
+    The curl implementation keeps connections alive between requests.
+    The time requests spend waiting in the client queue is recorded
+    in the proxy_client_queue_wait_seconds metric.
+
+    """
+
+    def __init__(self, implementation='simple', max_clients=10, socket_path=None):
+        self.implementation = implementation
+        self.max_clients = max_clients
+        self.socket_path = socket_path
+        self.active = 0
+        if implementation == 'curl':
+            from tornado.curl_httpclient import CurlAsyncHTTPClient
+            self.client = CurlAsyncHTTPClient(force_instance=True, max_clients=max_clients)
+        elif implementation == 'simple':
+            resolver = UnixSocketResolver(socket_path=socket_path) if socket_path else None
+            self.client = SimpleAsyncHTTPClient(
+                force_instance=True, max_clients=max_clients, resolver=resolver
+            )
+        else:
+            raise Exception(f'HTTP client implementation not supported: {implementation}')
+
+    @gen.coroutine
+    def _produce(self, body_queue, write):
+        while True:
+            chunk = yield body_queue.get()
+            if chunk is None:
+                return
+            yield write(chunk)
+
+    def fetch(self, url, body_queue=None, **kwargs):
+        """
+        Make a request, with the body read from body_queue
+        (a ByteBudgetQueue), if given.
+
+        """
+        if self.implementation == 'curl':
+            reader = _CurlBodyReader(body_queue) if body_queue else None
+            def prepare_curl(curl):
+                import pycurl
+                if self.socket_path:
+                    curl.setopt(pycurl.UNIX_SOCKET_PATH, self.socket_path)
+                if reader:
+                    reader.setup(curl)
+            kwargs['prepare_curl_callback'] = prepare_curl
+            # the body is supplied by the reader
+            kwargs['allow_nonstandard_methods'] = True
+        elif body_queue:
+            kwargs['body_producer'] = functools.partial(self._produce, body_queue)
+        self.active += 1
+        metrics.set('proxy_client_active', self.active)
+        if self.active > self.max_clients:
+            metrics.incr('proxy_client_queued')
+            logging.info('internal client busy, %d requests active', self.active)
+        submitted = time.time()
+        future = self.client.fetch(url, **kwargs)
+        def on_done(f):
+            self.active -= 1
+            metrics.set('proxy_client_active', self.active)
+            try:
+                response = f.result()
+            except Exception as e:
+                response = getattr(e, 'response', None)
+            if not response:
+                return
+            if response.time_info.get('queue') is not None:
+                queued = response.time_info['queue']
+            elif response.start_time:
+                queued = max(response.start_time - submitted, 0)
+            else:
+                return
+            metrics.observe('proxy_client_queue_wait_seconds', queued)
+        future.add_done_callback(on_done)
+        return future
+
+
+class _CurlBodyReader(object):
+
+    """
+    Supply a streamed request body to libcurl, which reads it
+    with a blocking callback: when the queue is empty, the transfer
+    is paused, and it is resumed when more data arrives.
+
+    """
+
+    def __init__(self, body_queue):
+        self.body_queue = body_queue
+        self.pending = b''
+        self.paused = False
+        self.curl = None
+
+    def setup(self, curl):
+        import pycurl
+        self.curl = curl
+        curl.setopt(pycurl.READFUNCTION, self.read)
+        curl.setopt(pycurl.INFILESIZE, -1) # chunked transfer encoding
+        self.body_queue.on_put = self.resume
+
+    def read(self, size):
+        import pycurl
+        if not self.pending:
+            if self.body_queue.discarded:
+                return pycurl.READFUNC_ABORT
+            data = self.body_queue.get_nowait()
+            if data is None:
+                if self.body_queue.closed:
+                    return b''
+                self.paused = True
+                return pycurl.READFUNC_PAUSE
+            self.pending = memoryview(data)
+        out, self.pending = self.pending[:size], self.pending[size:]
+        return bytes(out)
+
+    def resume(self):
+        if self.paused:
+            import pycurl
+            self.paused = False
+            self.curl.pause(pycurl.PAUSE_CONT)
+
+
+class ByteBudgetQueue(object):
+
+    """
+    A queue of request body chunks, bounded by the number
+    of bytes it holds, rather than by the number of chunks.
+
+    The producer waits while the byte budget is spent, which
+    propagates backpressure to the client. The consumer gets
+    everything buffered so far, up to max_write bytes, so that
+    many small socket reads are coalesced into fewer, larger writes.
+    A single chunk larger than the budget is always admitted into
+    an empty queue, so that the producer cannot deadlock.
+
+    Putting None marks the end of the body, after which get
+    returns the remaining data, and then None. If the queue is
+    discarded, get raises StreamClosedError instead, so that the
+    consumer does not mistake a truncated body for a complete one.
+
+    Parameters
+    ----------
+    max_bytes: int, the byte budget
+    max_write: int, the maximum size of coalesced chunks
+
+    """
+
+    def __init__(self, max_bytes, max_write):
+        self.max_bytes = max_bytes
+        self.max_write = max_write
+        self.chunks = collections.deque()
+        self.size = 0
+        self.max_depth = 0
+        self.stalled = 0.0
+        self.closed = False
+        self.discarded = False
+        self.on_put = None
+        self._changed = Condition()
+
+    @gen.coroutine
+    def put(self, chunk):
+        if chunk is None:
+            self.closed = True
+            self._notify()
+            return
+        if self.discarded:
+            return
+        if self.size and self.size + len(chunk) > self.max_bytes:
+            start = time.time()
+            while (not self.discarded and self.size
+                   and self.size + len(chunk) > self.max_bytes):
+                yield self._changed.wait()
+            stalled = time.time() - start
+            self.stalled += stalled
+            metrics.incr('proxy_queue_stalls')
+            metrics.observe('proxy_queue_producer_stall_seconds', stalled)
+            if self.discarded:
+                # discarded while waiting, so drop the chunk
+                return
+        self.chunks.append(chunk)
+        self.size += len(chunk)
+        self.max_depth = max(self.max_depth, self.size)
+        metrics.adjust('proxy_queue_bytes', len(chunk))
+        self._notify()
+
+    def _notify(self):
+        self._changed.notify_all()
+        if self.on_put:
+            self.on_put()
+
+    @gen.coroutine
+    def get(self):
+        while not self.chunks and not self.closed:
+            yield self._changed.wait()
+        if self.discarded:
+            raise StreamClosedError()
+        return self.get_nowait()
+
+    def get_nowait(self):
+        """Return buffered data, or None if there is none."""
+        if not self.chunks:
+            return None
+        out = [self.chunks.popleft()]
+        num_bytes = len(out[0])
+        while self.chunks and num_bytes + len(self.chunks[0]) <= self.max_write:
+            chunk = self.chunks.popleft()
+            out.append(chunk)
+            num_bytes += len(chunk)
+        self.size -= num_bytes
+        metrics.adjust('proxy_queue_bytes', -num_bytes)
+        self._changed.notify_all()
+        return out[0] if len(out) == 1 else b''.join(out)
+
+    def discard(self):
+        """Drop buffered data, e.g. when the client has gone away."""
+        metrics.adjust('proxy_queue_bytes', -self.size)
+        self.chunks.clear()
+        self.size = 0
+        self.closed = True
+        self.discarded = True
+        self._notify()
@@ -170,11 +170,13 @@ class SerialResumable(AbstractResumable):
 
     """
 
-    def __init__(self, work_dir=None, owner=None):
+    def __init__(self, work_dir=None, owner=None, hashes=None):
         super(SerialResumable, self).__init__(work_dir, owner)
         self.work_dir = work_dir
         self.owner = owner
         self.engine = self._init_db(owner, work_dir)
+        self.hashes = hashes
+        self.content_digest = None
 
     def _init_db(self, owner, work_dir):
         dbname = '{0}{1}{2}'.format('.resumables-', owner, '.db')
@@ -495,6 +497,8 @@ class SerialResumable(AbstractResumable):
         chunks_dir = work_dir + '/' + upload_id
         if '.chunk.end' in last_chunk_filename:
             logging.info('deleting: %s', chunks_dir)
+            if self.hashes:
+                self.content_digest = self.hashes.pop(upload_id, os.stat(out).st_size)
             os.rename(out, final)
             try:
                 shutil.rmtree(chunks_dir) # do not need to fail upload if this does not work
@@ -517,7 +521,8 @@ class SerialResumable(AbstractResumable):
             - continue to the chowner: move file, set permissions
         3. If new chunk
             - if chunk_num > 1, create a lockfile - link to a unique file (NFS-safe method)
-            - append it to the merge file
+            - append it to the merge file, continuing the hash
+              of its content, if hashes are kept
             - remove chunks older than 5 requests back in the sequence
               to avoid using lots of disk space for very large files
             - update the resumable's info table
@@ -550,9 +555,17 @@ class SerialResumable(AbstractResumable):
             with open(out, 'ab') as fout:
                 with open(chunk, 'rb') as fin:
                     size_before_merge = os.stat(out).st_size
-                    shutil.copyfileobj(fin, fout)
+                    _hash = self.hashes.resume(upload_id, size_before_merge) if self.hashes else None
+                    if _hash:
+                        for block in iter(lambda: fin.read(1048576), b''):
+                            fout.write(block)
+                            _hash.update(block)
+                    else:
+                        shutil.copyfileobj(fin, fout)
             chunk_size = os.stat(chunk).st_size
             assert self._db_update_with_chunk_info(upload_id, chunk_num, chunk_size)
+            if _hash:
+                self.hashes.save(upload_id, _hash, size_before_merge + chunk_size)
         except Exception as e:
             logging.error(e)
             try:
@@ -0,0 +1,142 @@
+"""
+Consumption of streams of chunks, such as the bodies of uploads,
+on worker threads, so that the event loop only hands chunks over,
+and never waits for slow disks, or CPU-bound work, itself.
+
+"""
+
+import abc
+import logging
+import queue
+import threading
+
+
+class StreamWorker(abc.ABC):
+
+    """
+    Consume a stream of chunks on a worker thread.
+
+    Chunks are either put into a bounded queue, by the caller, or
+    read from source, by the worker, until source is exhausted.
+    Subclasses implement consume, which is given an iterator over
+    the chunks, and set error, by raising, if the data is invalid.
+    The rest of the stream is then read and dropped, so that the
+    producer is never left waiting. If the stream is aborted instead,
+    queued chunks are dropped, and producers waiting for room in the
+    queue give up, so that no thread is left waiting either.
+
+    Parameters
+    ----------
+    source: file object, optional, e.g. the stdout of another process
+    max_queued: int, chunks which can wait in the queue
+    name: str, of the thread
+
+    """
+
+    error_class = Exception
+    errors = (OSError, ValueError)
+    # seconds between checks for aborted streams, while waiting for room
+    put_interval = 0.5
+
+    def __init__(self, source=None, max_queued=16, name='stream-worker'):
+        self.source = source
+        self.queue = queue.Queue(maxsize=max_queued)
+        self.compressed_bytes = 0
+        self.error = None
+        self.aborted = False
+        self.finished = False
+        self.thread = threading.Thread(target=self._work, name=name, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def _check(self):
+        if self.error:
+            raise self.error_class(self.error)
+
+    def put_nowait(self, chunk):
+        """
+        Queue a chunk, without blocking.
+
+        Returns
+        -------
+        bool, False if the queue is full
+
+        """
+        self._check()
+        try:
+            self.queue.put_nowait(chunk)
+            return True
+        except queue.Full:
+            return False
+
+    def put(self, chunk):
+        """
+        Queue a chunk, waiting for room in the queue, off the event loop.
+
+        Raises
+        ------
+        error_class, if the data is invalid, or the stream was aborted
+
+        """
+        while True:
+            self._check()
+            if self.aborted:
+                raise self.error_class('stream aborted')
+            try:
+                self.queue.put(chunk, timeout=self.put_interval)
+                return
+            except queue.Full:
+                continue
+
+    def join(self):
+        """Wait for the end of the stream to be consumed, off the event loop."""
+        if self.source is None:
+            self.queue.put(None)
+        self.thread.join()
+
+    def abort(self):
+        """Stop consuming, without waiting, e.g. if the client has gone."""
+        self.aborted = True
+        # make room for producers which are waiting in put
+        while True:
+            try:
+                self.queue.get_nowait()
+            except queue.Empty:
+                break
+        try:
+            self.queue.put_nowait(None)
+        except queue.Full:
+            pass # the worker is busy, and will see the flag
+
+    def chunks(self):
+        if self.source is not None:
+            while not self.aborted:
+                chunk = self.source.read(65536)
+                if not chunk:
+                    self.finished = True
+                    return
+                self.compressed_bytes += len(chunk)
+                yield chunk
+        else:
+            while not self.aborted:
+                chunk = self.queue.get()
+                if chunk is None:
+                    self.finished = True
+                    return
+                self.compressed_bytes += len(chunk)
+                yield chunk
+
+    @abc.abstractmethod
+    def consume(self, chunks):
+        """Consume an iterator over the chunks of the stream."""
+
+    def _work(self):
+        try:
+            self.consume(self.chunks())
+        except self.errors as e:
+            logging.error(e)
+            self.error = str(e)
+            if not self.finished:
+                for _ in self.chunks():
+                    pass
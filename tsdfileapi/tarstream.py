@@ -0,0 +1,361 @@
+"""
+Extraction of tar archives, as they are uploaded, in-process, on a
+worker thread, instead of in a tar process, which is written to from
+the event loop, and blocks it whenever its pipe is full.
+
+Members are read from the stream one after the other, and checked
+before they are written: only regular files and directories, with
+relative paths inside the target directory, are extracted. Paths
+are resolved one component at a time, relative to open directories,
+without following symlinks, so they cannot be redirected out of the
+target directory, not even while the archive is being extracted.
+Small files are written by a pool of threads, while the next members
+are read, and larger ones directly, as they arrive. Each file is
+hashed while it is written, and described in a manifest.
+
+"""
+
+import collections
+import concurrent.futures
+import errno
+import hashlib
+import logging
+import os
+import tarfile
+import threading
+import zlib
+
+from metrics import metrics
+from streamworker import StreamWorker
+
+
+class TarStreamError(Exception):
+    message = 'Could not extract archive'
+
+
+class _ChunkReader(object):
+
+    """A file object over an iterator of chunks, for tarfile's stream mode."""
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.buffer = bytearray()
+        self.offset = 0
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buffer) - self.offset < size:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                break
+            del self.buffer[:self.offset]
+            self.offset = 0
+            self.buffer += chunk
+        end = len(self.buffer) if size < 0 else min(self.offset + size, len(self.buffer))
+        data = bytes(self.buffer[self.offset:end])
+        self.offset = end
+        return data
+
+
+def member_path(name):
+    """
+    Get the path, relative to the target directory, at which a
+    member of an archive may be extracted.
+
+    Parameters
+    ----------
+    name: str, of a tar member
+
+    Returns
+    -------
+    str, or None, if the path is absolute, or leads out of
+    the target directory
+
+    """
+    if not name or os.path.isabs(name) or '\x00' in name:
+        return None
+    path = os.path.normpath(name)
+    if path == '.' or path == '..' or path.startswith('../'):
+        return None
+    return path
+
+
+class TarStreamExtractor(StreamWorker):
+
+    """
+    Extract a tar stream into a directory, on a worker thread.
+
+    Members which are not regular files or directories (symlinks,
+    hard links, devices, fifos), and members with unsafe paths,
+    are skipped, and logged. Existing files are overwritten, as
+    tar does, but never through symlinks, and an existing symlink
+    in place of a directory is an error.
+
+    If extraction fails, the files and directories which were
+    created can be removed with discard - files which existed
+    before, and were overwritten, are left in place.
+
+    Metrics: tar_uploads, tar_files, tar_bytes, tar_members_skipped,
+    and tar_errors.
+
+    Parameters
+    ----------
+    target_dir: str
+    compression: str, '' or 'gz'
+    source: file object, optional, see StreamWorker
+    hash_name: str, of the hash in the manifest
+    digests: checksums.ContentDigests, optional, to store the hashes in
+    max_queued: int, see StreamWorker
+    workers: int, threads writing small files
+    small_file_max: int, bytes, files up to this size are read
+        into memory, and written by the pool of threads
+
+    """
+
+    error_class = TarStreamError
+    errors = (TarStreamError, tarfile.TarError, zlib.error, EOFError, OSError, ValueError)
+
+    def __init__(self, target_dir, compression='', source=None, hash_name='sha256',
+                 digests=None, max_queued=16, workers=4, small_file_max=1048576):
+        super().__init__(source, max_queued, name='untar')
+        self.target_dir = os.path.realpath(target_dir)
+        self.compression = compression
+        self.hash_name = hash_name
+        self.digests = digests
+        self.small_file_max = small_file_max
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix='untar-write'
+        )
+        # small files in memory, waiting to be written
+        self.slots = threading.BoundedSemaphore(workers * 2)
+        self.entries = {}
+        self.skipped = []
+        # open directories, by path relative to the target directory
+        self.dir_fds = collections.OrderedDict()
+        self.max_dir_fds = 64
+        self.created_dirs = []
+        self.created_files = []
+        self._lock = threading.Lock()
+        self.start()
+
+    @property
+    def manifest(self):
+        """
+        Returns
+        -------
+        list of dict, with the path, relative to the target directory,
+        the size, and the hash of each extracted file, in archive order
+
+        """
+        return [self.entries[i] for i in sorted(self.entries)]
+
+    def close(self):
+        """
+        Wait for the archive to be extracted, off the event loop.
+
+        Raises
+        ------
+        TarStreamError, if the archive could not be extracted
+
+        """
+        self.join()
+        self.executor.shutdown(wait=True)
+        metrics.incr('tar_uploads')
+        metrics.incr('tar_files', len(self.entries))
+        metrics.incr('tar_bytes', sum(entry['size'] for entry in self.entries.values()))
+        metrics.incr('tar_members_skipped', len(self.skipped))
+        if self.error:
+            metrics.incr('tar_errors')
+        self._check()
+        logging.info(
+            'extracted %d files from %d bytes into %s, skipped: %s',
+            len(self.entries), self.compressed_bytes, self.target_dir, self.skipped
+        )
+
+    def abort(self):
+        super().abort()
+        self.executor.shutdown(wait=False)
+
+    def dir_fd(self, relpath):
+        """
+        Open a directory, relative to the target directory, creating
+        it if needed, one component at a time, without following
+        symlinks. Not thread-safe: only used by one thread at a time.
+
+        Returns
+        -------
+        int, file descriptor, owned by the extractor
+
+        """
+        fd = self.dir_fds.get(relpath)
+        if fd is not None:
+            self.dir_fds.move_to_end(relpath)
+            return fd
+        if not relpath:
+            fd = os.open(self.target_dir, os.O_RDONLY | os.O_DIRECTORY)
+        else:
+            parent, name = os.path.split(relpath)
+            parent_fd = self.dir_fd(parent)
+            try:
+                os.mkdir(name, dir_fd=parent_fd)
+                self.created_dirs.append(relpath)
+            except FileExistsError:
+                pass
+            try:
+                fd = os.open(name, os.O_RDONLY | os.O_DIRECTORY | os.O_NOFOLLOW, dir_fd=parent_fd)
+            except OSError as e:
+                if e.errno in (errno.ELOOP, errno.ENOTDIR):
+                    raise TarStreamError(f'not a directory: {relpath}')
+                raise
+        self.dir_fds[relpath] = fd
+        while len(self.dir_fds) > self.max_dir_fds:
+            os.close(self.dir_fds.popitem(last=False)[1])
+        return fd
+
+    def close_dir_fds(self):
+        while self.dir_fds:
+            os.close(self.dir_fds.popitem()[1])
+
+    def open_target(self, dir_fd, relpath, mode):
+        name = os.path.basename(relpath)
+        flags = os.O_WRONLY | os.O_CREAT | os.O_NOFOLLOW
+        try:
+            # remember which files are new, so only those are discarded
+            fd = os.open(name, flags | os.O_EXCL, mode & 0o777, dir_fd=dir_fd)
+            with self._lock:
+                self.created_files.append(relpath)
+        except FileExistsError:
+            try:
+                fd = os.open(name, flags | os.O_TRUNC, mode & 0o777, dir_fd=dir_fd)
+            except OSError as e:
+                if e.errno != errno.ELOOP:
+                    raise
+                os.unlink(name, dir_fd=dir_fd) # a symlink, replaced, as tar does
+                fd = os.open(name, flags | os.O_EXCL, mode & 0o777, dir_fd=dir_fd)
+                with self._lock:
+                    self.created_files.append(relpath)
+        return os.fdopen(fd, 'wb')
+
+    def finish_file(self, index, member, relpath, f, size, digest):
+        f.flush()
+        os.utime(f.fileno(), (member.mtime, member.mtime))
+        if self.digests:
+            path = os.path.join(self.target_dir, relpath)
+            self.digests.put(path, self.hash_name, digest, os.fstat(f.fileno()))
+        with self._lock:
+            self.entries[index] = {'path': relpath, 'size': size, 'digest': digest}
+
+    def write_small(self, index, member, relpath, dir_fd, data):
+        try:
+            with self.open_target(dir_fd, relpath, member.mode) as f:
+                f.write(data)
+                digest = hashlib.new(self.hash_name, data).hexdigest()
+                self.finish_file(index, member, relpath, f, len(data), digest)
+        finally:
+            os.close(dir_fd)
+            self.slots.release()
+
+    def write_large(self, index, member, relpath, dir_fd, fileobj):
+        _hash = hashlib.new(self.hash_name)
+        size = 0
+        with self.open_target(dir_fd, relpath, member.mode) as f:
+            for block in iter(lambda: fileobj.read(1048576), b''):
+                f.write(block)
+                _hash.update(block)
+                size += len(block)
+            if size != member.size:
+                raise TarStreamError(f'truncated archive, in: {member.name}')
+            self.finish_file(index, member, relpath, f, size, _hash.hexdigest())
+
+    def discard(self):
+        """
+        Remove the files, and the empty directories, which were
+        created, once extraction has failed, and close has returned.
+        Existing files which were overwritten are kept, as they are.
+        Paths are resolved as during extraction, without following
+        symlinks. Blocking.
+
+        """
+        try:
+            for relpath in self.created_files:
+                try:
+                    parent, name = os.path.split(relpath)
+                    os.unlink(name, dir_fd=self.dir_fd(parent))
+                except (OSError, TarStreamError):
+                    pass
+            for relpath in reversed(self.created_dirs):
+                try:
+                    parent, name = os.path.split(relpath)
+                    os.rmdir(name, dir_fd=self.dir_fd(parent))
+                except (OSError, TarStreamError):
+                    pass
+        finally:
+            self.close_dir_fds()
+        logging.info('removed %d files from %s', len(self.created_files), self.target_dir)
+
+    def consume(self, chunks):
+        pending = []
+        # the last write to each path, so that a later member with
+        # the same path is only written after it, and wins, as in tar
+        writes = {}
+        try:
+            with tarfile.open(fileobj=_ChunkReader(chunks), mode='r|' + self.compression) as tar:
+                for index, member in enumerate(tar):
+                    if self.aborted:
+                        return
+                    relpath = member_path(member.name)
+                    if relpath is None or not (member.isfile() or member.isdir()):
+                        logging.warning('not extracting: %s', member.name)
+                        self.skipped.append(member.name)
+                        continue
+                    if member.isdir():
+                        self.dir_fd(relpath)
+                        continue
+                    dir_fd = self.dir_fd(os.path.dirname(relpath))
+                    earlier = writes.pop(relpath, None)
+                    if earlier:
+                        earlier.result()
+                    fileobj = tar.extractfile(member)
+                    if member.size > self.small_file_max:
+                        self.write_large(index, member, relpath, dir_fd, fileobj)
+                        continue
+                    data = fileobj.read()
+                    if len(data) != member.size:
+                        raise TarStreamError(f'truncated archive, in: {member.name}')
+                    self.slots.acquire()
+                    # a descriptor of its own, since this one may be
+                    # closed before the file has been written
+                    dir_fd = os.dup(dir_fd)
+                    try:
+                        future = self.executor.submit(
+                            self.write_small, index, member, relpath, dir_fd, data
+                        )
+                    except RuntimeError: # aborted
+                        os.close(dir_fd)
+                        self.slots.release()
+                        return
+                    pending.append(future)
+                    writes[relpath] = future
+                    if len(pending) > 1000:
+                        pending = self._collect(pending, wait=False)
+                        writes = {p: f for p, f in writes.items() if not f.done()}
+                # tarfile ends at the first header it cannot read, so
+                # make sure that it was the end of archive marker
+                if not self.aborted and tar.fileobj.pos < tar.offset + tarfile.BLOCKSIZE:
+                    raise TarStreamError('truncated archive')
+        finally:
+            try:
+                self._collect(pending)
+            finally:
+                self.close_dir_fds()
+
+    def _collect(self, pending, wait=True):
+        """Raise the first error of finished writes, and return the others."""
+        if wait:
+            concurrent.futures.wait(pending)
+        remaining = []
+        for future in pending:
+            if not future.done():
+                remaining.append(future)
+            elif not future.cancelled() and future.exception():
+                raise future.exception()
+        return remaining
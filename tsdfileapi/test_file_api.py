@@ -65,6 +65,9 @@ https://github.com/kennethreitz/requests/issues/713
 # pylint: disable=invalid-name
 
 import base64
+import gzip
+import hashlib
+import io
 import json
 import logging
 import os
@@ -75,6 +78,9 @@ import unittest
 import pwd
 import uuid
 import shutil
+import tarfile
+import threading
+import zipfile
 from datetime import datetime
 
 from pretty_bad_protocol import gnupg
@@ -82,7 +88,9 @@ import requests
 import yaml
 from sqlalchemy.exc import OperationalError
 from tsdapiclient import fileapi
+from tornado import gen
 from tornado.escape import url_escape
+from tornado.ioloop import IOLoop
 
 import pretty_bad_protocol._parsers
 pretty_bad_protocol._parsers.Verify.TRUST_LEVELS["ENCRYPTION_COMPLIANCE_MODE"] = 23
@@ -93,8 +101,15 @@ from tokens import gen_test_tokens, get_test_token_for_p12, gen_test_token_for_u
 from db import session_scope, sqlite_init, postgres_init, SqliteBackend, \
                sqlite_session, PostgresBackend, postgres_session
 from resumables import SerialResumable
+from naclstream import NaclStreamDecryptor, decrypt_nacl_payload
+from gzstream import GzipStreamWriter, GzipStreamError
+from tarstream import TarStreamExtractor, TarStreamError
+from checksums import ContentDigests
+from hooks import RequestHookExecutor
 from utils import sns_dir, md5sum, IllegalFilenameException
 from pgp import _import_keys
+from privileged import (allowed_roots, check_path, symbolic_mode, apply_chmod,
+                        apply_chown, PrivilegedHelperError)
 from squril import SqliteQueryGenerator, PostgresQueryGenerator
 
 
@@ -247,8 +262,8 @@ class TestFileApi(unittest.TestCase):
         for _file in uploaded_files:
             # TODO: eventually remove - still want to inspect them
             # manually while the data pipelines are in alpha
-            if _file in ['totar', 'totar2', 'decrypted-aes.csv',
-                         'totar3', 'totar4', 'ungz1', 'ungz-aes1',
+            if _file in ['totar', 'totar2', 'totar5', 'decrypted-aes.csv',
+                         'totar3', 'totar4', 'ungz1', 'ungz2', 'ungz-aes1',
                          'uploaded-example-2.csv', 'uploaded-example-3.csv']:
                 continue
             if (_file in test_files) or (today in _file) or (_file in file_list):
@@ -705,6 +720,69 @@ class TestFileApi(unittest.TestCase):
         # real    4m21.898s
         # CPU intensive, memory fine
 
+    def test_XXX_bench_stream_upload(self):
+        # compare the internal hop between ProxyHandler and StreamHandler
+        # by running this against servers configured with proxy_in_process
+        # set to True and False, respectively
+        megabytes = 1024
+        block = os.urandom(1024*1024)
+        def blocks():
+            for i in range(megabytes):
+                yield block
+        headers = {'Authorization': 'Bearer ' + TEST_TOKENS['VALID']}
+        mode = 'in-process' if self.config.get('proxy_in_process') else 'loopback'
+        print(f'uploading {megabytes} MB, with proxy mode: {mode}')
+        start = time.time()
+        resp = requests.put(f'{self.stream}/bench-upload', data=blocks(), headers=headers)
+        duration = time.time() - start
+        self.assertEqual(resp.status_code, 201)
+        print(f'{megabytes/duration:.1f} MB/s')
+        os.remove(os.path.normpath(f'{self.uploads_folder}/{self.test_group}/bench-upload'))
+
+
+    def test_XXX_bench_nacl_stream_upload(self):
+        # compare the throughput of nacl encrypted uploads to that of
+        # plain uploads, the difference being the cost of decryption
+        import libnacl
+        import libnacl.public
+        import libnacl.sealed
+        import libnacl.utils
+        megabytes = 1024
+        chunk_size = 262144
+        nonce = libnacl.utils.rand_nonce()
+        key = libnacl.utils.salsa_key()
+        plain = os.urandom(1024*1024)
+        # every frame is encrypted from the start of the key stream,
+        # so one encrypted block can be repeated
+        encrypted = b''.join(
+            libnacl.crypto_stream_xor(plain[i:i + chunk_size], nonce, key)
+            for i in range(0, len(plain), chunk_size)
+        )
+        resp = requests.get(f'{self.base_url}/survey/crypto/key')
+        public_key = libnacl.public.PublicKey(base64.b64decode(resp.json()['public_key']))
+        sbox = libnacl.sealed.SealedBox(public_key)
+        headers = {'Authorization': 'Bearer ' + TEST_TOKENS['VALID']}
+        nacl_headers = {
+            **headers,
+            'Content-Type': 'application/octet-stream+nacl',
+            'Nacl-Nonce': base64.b64encode(sbox.encrypt(nonce)),
+            'Nacl-Key': base64.b64encode(sbox.encrypt(key)),
+            'Nacl-Chunksize': str(chunk_size),
+        }
+        rates = {}
+        for name, block, _headers in [('plain', plain, headers), ('nacl', encrypted, nacl_headers)]:
+            start = time.time()
+            resp = requests.put(f'{self.stream}/bench-upload',
+                                data=(block for i in range(megabytes)),
+                                headers=_headers)
+            rates[name] = megabytes/(time.time() - start)
+            self.assertEqual(resp.status_code, 201)
+            print(f'uploading {megabytes} MB, {name}: {rates[name]:.1f} MB/s')
+        print(f"nacl/plain: {rates['nacl']/rates['plain']:.2f}")
+        with open(os.path.normpath(f'{self.uploads_folder}/{self.test_group}/bench-upload'), 'rb') as f:
+            self.assertEqual(f.read(len(plain)), plain)
+        os.remove(os.path.normpath(f'{self.uploads_folder}/{self.test_group}/bench-upload'))
+
     # More Authn+z
     # ------------
 
@@ -753,7 +831,51 @@ class TestFileApi(unittest.TestCase):
         resp1 = requests.put(self.stream + '/totar', data=lazy_file_reader(self.example_tar),
                              headers=headers)
         self.assertEqual(resp1.status_code, 201)
-        # check contents
+        manifest = resp1.json()['files']
+        self.assertEqual([entry['path'] for entry in manifest], ['totar/f1', 'totar/f2', 'totar/f3'])
+        for entry in manifest:
+            with open(self.uploads_folder + '/' + self.test_group + '/' + entry['path'], 'rb') as f:
+                content = f.read()
+            self.assertEqual(entry['size'], len(content))
+            self.assertEqual(entry['digest'], hashlib.sha256(content).hexdigest())
+
+    def test_Zb1_stream_tar_skips_unsafe_members(self):
+        headers = {'Authorization': 'Bearer ' + TEST_TOKENS['VALID'],
+                   'Content-Type': 'application/tar'}
+        archive = io.BytesIO()
+        with tarfile.open(fileobj=archive, mode='w') as tar:
+            for name in ['totar5/ok.txt', '../escaped.txt', '/absolute.txt', 'p11-other-group/x.txt']:
+                member = tarfile.TarInfo(name)
+                member.size = 2
+                tar.addfile(member, io.BytesIO(b'ok'))
+            link = tarfile.TarInfo('totar5/link')
+            link.type = tarfile.SYMTYPE
+            link.linkname = '/etc/passwd'
+            tar.addfile(link)
+        resp = requests.put(self.stream + '/totar5', data=archive.getvalue(), headers=headers)
+        self.assertEqual(resp.status_code, 201)
+        self.assertEqual([entry['path'] for entry in resp.json()['files']],
+                         ['totar5/ok.txt', 'p11-other-group/x.txt'])
+        self.assertFalse(os.path.lexists(self.uploads_folder + '/' + self.test_group + '/totar5/link'))
+        self.assertFalse(os.path.lexists(self.uploads_folder + '/escaped.txt'))
+        # extracted into the group folder, never into that of another group
+        self.assertTrue(os.path.lexists(self.uploads_folder + '/' + self.test_group + '/p11-other-group/x.txt'))
+        self.assertFalse(os.path.lexists(self.uploads_folder + '/p11-other-group/x.txt'))
+        # truncated archives are refused
+        resp = requests.put(self.stream + '/totar5', data=archive.getvalue()[:700], headers=headers)
+        self.assertEqual(resp.status_code, 400)
+        # files from earlier uploads, which they overwrote, are kept
+        self.assertTrue(os.path.lexists(self.uploads_folder + '/' + self.test_group + '/totar5/ok.txt'))
+        # and what was extracted from them is removed
+        archive = io.BytesIO()
+        with tarfile.open(fileobj=archive, mode='w') as tar:
+            for name in ['totar6/a', 'totar6/b']:
+                member = tarfile.TarInfo(name)
+                member.size = 2048
+                tar.addfile(member, io.BytesIO(os.urandom(2048)))
+        resp = requests.put(self.stream + '/totar6', data=archive.getvalue()[:4096], headers=headers)
+        self.assertEqual(resp.status_code, 400)
+        self.assertFalse(os.path.lexists(self.uploads_folder + '/' + self.test_group + '/totar6'))
 
     def test_Zc_stream_tar_gz_with_custom_content_type_untar_works(self):
         headers = {'Authorization': 'Bearer ' + TEST_TOKENS['VALID'],
@@ -846,6 +968,27 @@ class TestFileApi(unittest.TestCase):
            self.assertEqual('x,y\n4,5\n2,1\n', uploaded_file.read())
 
 
+    def test_Zg0_stream_gz_multiple_members_and_invalid_data(self):
+        headers = {'Authorization': 'Bearer ' + TEST_TOKENS['VALID'],
+                   'Content-Type': 'application/gz'}
+        first, second = b'x,y\n' * 10000, os.urandom(100000)
+        resp = requests.put(self.stream + '/ungz2',
+                            data=gzip.compress(first) + gzip.compress(second),
+                            headers=headers)
+        self.assertEqual(resp.status_code, 201)
+        with open(self.uploads_folder + '/' + self.test_group + '/ungz2', 'rb') as uploaded_file:
+            self.assertEqual(first + second, uploaded_file.read())
+        resp = requests.put(self.stream + '/ungz3', data=b'not gzip' * 100,
+                            headers=headers)
+        self.assertEqual(resp.status_code, 400)
+        resp = requests.put(self.stream + '/ungz3', data=gzip.compress(first)[:-10],
+                            headers=headers)
+        self.assertEqual(resp.status_code, 400)
+        # partial output is removed, and not moved to the group folder
+        self.assertFalse(os.path.exists(self.uploads_folder + '/' + self.test_group + '/ungz3'))
+        self.assertFalse([f for f in os.listdir(self.uploads_folder) if f.startswith('ungz3')])
+
+
     def test_Zh_stream_gz_aes_with_custom_header_decompress_works(self):
         headers = {'Authorization': 'Bearer ' + TEST_TOKENS['VALID'],
                    'Content-Type': 'application/gz.aes',
@@ -1362,12 +1505,68 @@ class TestFileApi(unittest.TestCase):
         self.assertEqual(resp.status_code, 416)
 
 
-    def test_ZZc_requesting_multiple_ranges_not_supported_error(self):
+    def test_ZZc_get_multiple_ranges_for_export(self):
         url = self.export + '/file1'
         headers = {'Authorization': 'Bearer ' + TEST_TOKENS['EXPORT'],
-                   'Range': 'bytes=1-4, 5-10'}
+                   'Range': 'bytes=0-3, 5-8'}
         resp = requests.get(url, headers=headers)
-        self.assertEqual(resp.status_code, 405)
+        self.assertEqual(resp.status_code, 206)
+        content_type, boundary = resp.headers['Content-Type'].split('; boundary=')
+        self.assertEqual(content_type, 'multipart/byteranges')
+        parts = resp.content.split(f'--{boundary}'.encode())
+        self.assertEqual(len(parts), 4)
+        self.assertTrue(b'Content-Range: bytes 0-3/10' in parts[1])
+        self.assertTrue(parts[1].endswith(b'\r\n\r\nsome\r\n'))
+        self.assertTrue(b'Content-Range: bytes 5-8/10' in parts[2])
+        self.assertTrue(parts[2].endswith(b'\r\n\r\ndata\r\n'))
+        self.assertEqual(parts[3], b'--\r\n')
+        headers = {'Authorization': 'Bearer ' + TEST_TOKENS['EXPORT'],
+                   'Range': 'bytes=0-3, 5-10'}
+        resp = requests.get(url, headers=headers)
+        self.assertEqual(resp.status_code, 416)
+
+
+    def test_ZZd_get_compressed_export(self):
+        url = self.export + '/file1'
+        headers = {'Authorization': 'Bearer ' + TEST_TOKENS['EXPORT'],
+                   'Accept-Encoding': 'gzip'}
+        resp = requests.get(url, headers=headers)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(resp.headers['Vary'], 'Accept-Encoding')
+        self.assertTrue(resp.headers['Etag'].endswith('-gzip"'))
+        self.assertEqual(resp.text, 'some data\n')
+        headers['Range'] = 'bytes=0-3'
+        resp = requests.get(url, headers=headers)
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue('Content-Encoding' not in resp.headers)
+        self.assertEqual(resp.text, 'some')
+
+
+    def test_ZZd1_conditional_get_for_export(self):
+        url = self.export + '/file1'
+        headers = {'Authorization': 'Bearer ' + TEST_TOKENS['EXPORT']}
+        resp = requests.get(url, headers=headers)
+        self.assertEqual(resp.status_code, 200)
+        etag, last_modified = resp.headers['Etag'], resp.headers['Last-Modified']
+        for method in [requests.get, requests.head]:
+            resp = method(url, headers={**headers, 'If-None-Match': etag})
+            self.assertEqual(resp.status_code, 304)
+            self.assertEqual(resp.content, b'')
+        resp = requests.get(url, headers={**headers, 'If-Modified-Since': last_modified})
+        self.assertEqual(resp.status_code, 304)
+        resp = requests.get(url, headers={**headers, 'If-None-Match': '"other"',
+                                          'If-Modified-Since': last_modified})
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.text, 'some data\n')
+        # listings
+        resp = requests.get(self.export, headers=headers)
+        etag = resp.headers['Etag']
+        self.assertTrue(etag.startswith('W/'))
+        resp = requests.get(self.export, headers={**headers, 'If-None-Match': etag})
+        self.assertEqual(resp.status_code, 304)
+        resp = requests.get(self.export + '?per_page=1', headers={**headers, 'If-None-Match': etag})
+        self.assertEqual(resp.status_code, 200)
 
 
     def test_ZZe_filename_rules_with_uploads(self):
@@ -1419,6 +1618,64 @@ class TestFileApi(unittest.TestCase):
         resp = requests.get(self.store_export + '/' + url_escape('så_søt(1).txt'), headers=headers)
         self.assertEqual(resp.status_code, 200)
 
+
+    def test_ZZh_store_content_etags(self):
+        if not self.config.get('content_etags'):
+            self.skipTest('content_etags is not enabled')
+        with open(self.so_sweet, 'rb') as f:
+            digest = hashlib.new(self.config.get('content_etag_hash', 'sha256'), f.read()).hexdigest()
+        headers = {'Authorization': 'Bearer ' + TEST_TOKENS['VALID']}
+        resp = requests.put(self.store_import + '/etag-file.txt',
+                            data=lazy_file_reader(self.so_sweet),
+                            headers=headers)
+        self.assertEqual(resp.status_code, 201)
+        headers = {'Authorization': 'Bearer ' + TEST_TOKENS['EXPORT']}
+        resp = requests.head(self.store_export + '/etag-file.txt', headers=headers)
+        self.assertEqual(resp.headers['Etag'].strip('"'), digest)
+        resp = requests.get(self.store_export, headers=headers)
+        etags = {f['filename']: f['etag'] for f in resp.json()['files']}
+        self.assertEqual(etags['etag-file.txt'], digest)
+        # changes made outside the API invalidate the stored hash,
+        # even if the size and mtime are kept
+        path = f'{self.store_import_folder}/etag-file.txt'
+        info = os.stat(path)
+        with open(path, 'r+b') as f:
+            f.write(b'X')
+        os.utime(path, ns=(info.st_atime_ns, info.st_mtime_ns))
+        resp = requests.head(self.store_export + '/etag-file.txt', headers=headers)
+        self.assertNotEqual(resp.headers['Etag'].strip('"'), digest)
+        with open(path, 'a') as f:
+            f.write('more')
+        resp = requests.head(self.store_export + '/etag-file.txt', headers=headers)
+        self.assertNotEqual(resp.headers['Etag'].strip('"'), digest)
+
+    def test_ZZh1_content_etags_with_request_hook(self):
+        if not self.config.get('content_etags') or not self.config.get('content_etag_db'):
+            self.skipTest('content_etags, with content_etag_db, is not enabled')
+        if not self.config['backends']['disk']['files']['request_hook']['enabled']:
+            self.skipTest('the request hook of the files backend is not enabled')
+        hash_name = self.config.get('content_etag_hash', 'sha256')
+        with open(self.so_sweet, 'rb') as f:
+            digest = hashlib.new(hash_name, f.read()).hexdigest()
+        filename = f'etag-hooked-{uuid.uuid4().hex}.txt'
+        headers = {'Authorization': 'Bearer ' + TEST_TOKENS['VALID']}
+        resp = requests.put(f'{self.stream}/{filename}',
+                            data=lazy_file_reader(self.so_sweet),
+                            headers=headers)
+        self.assertEqual(resp.status_code, 201)
+        # the hook moves the file, and changes its owner and mode,
+        # and the hash is stored for the file as it is afterwards
+        digests = ContentDigests(self.config['content_etag_db'])
+        stored = None
+        for _ in range(50):
+            time.sleep(0.2)
+            for current, dirs, files in os.walk(self.uploads_folder):
+                if filename in files:
+                    stored = digests.get(os.stat(os.path.join(current, filename)), hash_name)
+            if stored:
+                break
+        self.assertEqual(stored, digest)
+
     # directories
 
     def test_ZZZ_put_file_to_dir(self):
@@ -1556,6 +1813,39 @@ class TestFileApi(unittest.TestCase):
         data = json.loads(resp.text)
         self.assertEqual(resp.status_code, 200)
         self.assertEqual(len(data['files']), 101)
+        # follow cursors
+        resp = requests.get(f'{self.store_export}/topdir/bottomdir', headers=headers)
+        data1 = json.loads(resp.text)
+        self.assertEqual(len(data1['files']), 100)
+        self.assertTrue('cursor=' in data1['page'])
+        resp = requests.get(f"http://localhost:{self.config['port']}{data1['page']}", headers=headers)
+        self.assertEqual(resp.status_code, 200)
+        data2 = json.loads(resp.text)
+        self.assertEqual(len(data2['files']), 1)
+        self.assertEqual(data2['page'], None)
+        names = [f['filename'] for f in data1['files'] + data2['files']]
+        self.assertEqual(names, sorted(set(names)))
+        resp = requests.get(f'{self.store_export}/topdir/bottomdir?cursor=blabla', headers=headers)
+        self.assertEqual(resp.status_code, 400)
+        # sort and filter
+        resp = requests.get(f'{self.store_export}/topdir/bottomdir?sort=size&order=desc', headers=headers)
+        self.assertEqual(resp.status_code, 200)
+        sizes = [f['size'] for f in json.loads(resp.text)['files']]
+        self.assertEqual(sizes, sorted(sizes, reverse=True))
+        resp = requests.get(f'{self.store_export}/topdir/bottomdir?name=file1*', headers=headers)
+        data = json.loads(resp.text)
+        self.assertEqual(len(data['files']), 12)
+        self.assertEqual(data['page'], None)
+        resp = requests.get(f'{self.store_export}/topdir/bottomdir?sort=owner', headers=headers)
+        self.assertEqual(resp.status_code, 400)
+        # streamed, one entry per line
+        resp = requests.get(f'{self.store_export}/topdir/bottomdir?format=ndjson&per_page=7', headers=headers)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.headers['Content-Type'], 'application/x-ndjson')
+        streamed = [json.loads(line)['filename'] for line in resp.text.splitlines()]
+        self.assertEqual(sorted(streamed), names)
+        resp = requests.get(f'{self.store_export}/topdir/bottomdir?format=xml', headers=headers)
+        self.assertEqual(resp.status_code, 400)
         # fail gracefully
         resp = requests.get(f'{self.store_export}/topdir/bottomdir?page=-1', headers=headers)
         self.assertEqual(resp.status_code, 400)
@@ -1625,6 +1915,102 @@ class TestFileApi(unittest.TestCase):
             pass
 
 
+    def test_ZZZ_get_dir_as_archive(self):
+        headers = {'Authorization': 'Bearer ' + TEST_TOKENS['EXPORT']}
+        dirs = f'{self.store_import_folder}/topdir/bottomdir'
+        try:
+            os.makedirs(dirs)
+        except OSError:
+            pass
+        with open(f'{dirs}/file1', 'w') as f:
+            f.write('hi there')
+        with open(f'{dirs}/.file2', 'w') as f:
+            f.write('not exportable')
+        resp = requests.get(f'{self.store_export}/topdir?archive=tar.gz', headers=headers)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.headers['Content-Type'], 'application/gzip')
+        with tarfile.open(fileobj=io.BytesIO(resp.content)) as archive:
+            self.assertEqual(archive.getnames(), ['topdir/bottomdir/file1'])
+            self.assertEqual(archive.extractfile('topdir/bottomdir/file1').read(), b'hi there')
+        resp = requests.get(f'{self.store_export}/topdir?archive=zip', headers=headers)
+        self.assertEqual(resp.status_code, 200)
+        with zipfile.ZipFile(io.BytesIO(resp.content)) as archive:
+            self.assertEqual(archive.namelist(), ['topdir/bottomdir/file1'])
+        resp = requests.get(f'{self.store_export}/topdir?archive=rar', headers=headers)
+        self.assertEqual(resp.status_code, 400)
+        try:
+            shutil.rmtree(f'{dirs}')
+        except OSError as e:
+            pass
+
+
+    def test_ZZZ_get_file_info_batch(self):
+        headers = {'Authorization': 'Bearer ' + TEST_TOKENS['EXPORT']}
+        dirs = f'{self.store_import_folder}/topdir/bottomdir'
+        try:
+            os.makedirs(dirs)
+        except OSError:
+            pass
+        with open(f'{dirs}/file1', 'w') as f:
+            f.write('hi there')
+        reserved = 'topdir/bottomdir/file1.' + str(uuid.uuid4())
+        with open(f'{self.store_import_folder}/{reserved}', 'w') as f:
+            f.write('merged resumable')
+        names = ['topdir/bottomdir/file1', 'topdir/bottomdir/nofile', '.file2', reserved]
+        resp = requests.get(f'{self.base_url}/store/info', params={'name': names}, headers=headers)
+        self.assertEqual(resp.status_code, 200)
+        info = resp.json()['files']
+        self.assertEqual([f['filename'] for f in info], names)
+        self.assertEqual(info[0]['size'], 8)
+        self.assertTrue(info[0]['exportable'])
+        self.assertEqual(info[0]['mime-type'], 'text/plain')
+        self.assertTrue('etag' in info[0] and 'mtime' in info[0])
+        self.assertEqual(info[1]['error'], 'File does not exist')
+        self.assertEqual(info[2]['error'], 'Illegal filename')
+        self.assertEqual(info[3]['error'], 'Illegal filename')
+        self.assertFalse('size' in info[3])
+        resp = requests.get(f'{self.base_url}/store/info', headers=headers)
+        self.assertEqual(resp.status_code, 400)
+        resp = requests.delete(f'{self.base_url}/store/info', params={'name': names}, headers=headers)
+        self.assertEqual(resp.status_code, 405)
+        try:
+            shutil.rmtree(f'{dirs}')
+        except OSError as e:
+            pass
+
+
+    def test_ZZZ_sync_manifest(self):
+        headers = {'Authorization': 'Bearer ' + TEST_TOKENS['EXPORT']}
+        dirs = f'{self.store_import_folder}/topdir/bottomdir'
+        try:
+            os.makedirs(dirs)
+        except OSError:
+            pass
+        with open(f'{dirs}/file1', 'w') as f:
+            f.write('hi there')
+        with open(f'{dirs}/.file2', 'w') as f:
+            f.write('not synced')
+        resp = requests.get(f'{self.base_url}/store/sync/topdir?hash=md5', headers=headers)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.headers['Content-Type'], 'application/x-ndjson')
+        manifest = [json.loads(line) for line in resp.text.splitlines()]
+        self.assertEqual(len(manifest), 1)
+        self.assertEqual(manifest[0]['path'], 'bottomdir/file1')
+        self.assertEqual(manifest[0]['size'], 8)
+        self.assertEqual(manifest[0]['md5'], md5sum(f'{dirs}/file1'))
+        self.assertTrue('etag' in manifest[0] and 'mtime' in manifest[0])
+        resp = requests.get(f'{self.base_url}/store/sync/topdir?hash=crc32', headers=headers)
+        self.assertEqual(resp.status_code, 400)
+        resp = requests.get(f'{self.base_url}/store/sync/nodir', headers=headers)
+        self.assertEqual(resp.status_code, 404)
+        resp = requests.put(f'{self.base_url}/store/sync/topdir', data=b'x', headers=headers)
+        self.assertEqual(resp.status_code, 405)
+        try:
+            shutil.rmtree(f'{dirs}')
+        except OSError as e:
+            pass
+
+
     def test_ZZZ_delete(self):
         headers = {'Authorization': 'Bearer ' + TEST_TOKENS['EXPORT']}
         dirs = f'{self.store_import_folder}/topdir/bottomdir'
@@ -2060,8 +2446,8 @@ class TestFileApi(unittest.TestCase):
         # with respect to the chunk size used to create the encrypted stream.
         # Then recipient (server) needs to accumulate incoming chunks
         # in a buffer, and process the correct sized
-        # chunks from that buffer
-        _buffer = b''
+        # chunks from that buffer - as the server's decryptor does
+        decryptor = NaclStreamDecryptor(nonce, key, chunk_size)
         small_chunk = chunk_size - 3
         larger_chunk = chunk_size + 1
         line_no = 0
@@ -2074,19 +2460,16 @@ class TestFileApi(unittest.TestCase):
                     else:
                         size = larger_chunk
                     chunk = fsmaller.read(size)
-                    for byte in chunk:
-                        _buffer += bytes([byte])
-                        if len(_buffer) % chunk_size == 0:
-                            decr = libnacl.crypto_stream_xor(_buffer, nonce, key)
-                            fdecrypted.write(decr)
-                            _buffer = b''
+                    fdecrypted.write(decryptor.update(chunk))
                     if not chunk:
                         break
-                if len(_buffer) > 0:
-                    decr = libnacl.crypto_stream_xor(_buffer, nonce, key)
-                    fdecrypted.write(decr)
+                fdecrypted.write(decryptor.finalize())
 
         assert md5sum(test_file) == md5sum(dec_test_file)
+        with open(enc_test_file, 'rb') as f:
+            encrypted = f.read()
+        with open(test_file, 'rb') as f:
+            assert decrypt_nacl_payload(encrypted, nonce, key, chunk_size) == f.read()
 
         # now with requests to the survey backend
         # client setup steps
@@ -2189,6 +2572,26 @@ class TestFileApi(unittest.TestCase):
             )
             self.assertTrue(resp.status_code, 201)
 
+        # encrypted in many frames, the last one shorter than the rest
+        chunksize = 1000
+        serialised = json.dumps(payload2).encode()
+        encrypted = b''.join(
+            libnacl.crypto_stream_xor(serialised[i:i + chunksize], nonce, key)
+            for i in range(0, len(serialised), chunksize)
+        )
+        resp = requests.put(
+            f'{self.survey}/{target}',
+            headers={
+                'Content-Type': 'application/json+nacl',
+                'Nacl-Nonce': nacl_nonce,
+                'Nacl-Key': nacl_key,
+                'Nacl-Chunksize': str(chunksize),
+                'Authorization': f"Bearer {TEST_TOKENS['VALID']}"
+            },
+            data=encrypted
+        )
+        self.assertEqual(resp.status_code, 201)
+
         # test refuse too large chunk sizes
         resp = requests.put(
             f'{self.survey}/{target}',
@@ -2204,6 +2607,206 @@ class TestFileApi(unittest.TestCase):
         self.assertTrue(resp.status_code, 400)
 
 
+    def test_privileged_helper(self):
+        # only uses the file system, not the API
+        base = f'/tmp/privileged-{uuid.uuid4().hex}'
+        import_dir = f'{base}/p11/import'
+        outside = f'{base}/outside'
+        os.makedirs(f'{import_dir}/d/sub')
+        os.makedirs(outside)
+        secret = f'{outside}/secret'
+        with open(secret, 'w') as f:
+            f.write('secret')
+        os.chmod(secret, 0o600)
+        try:
+            # allowed_roots
+            config = {
+                'valid_tenant_regex': '^[0-9a-z]+$',
+                'tenant_string_pattern': 'pXX',
+                'backends': {'disk': {
+                    'files': {'import_path': f'{base}/pXX/import', 'export_path': 'relative/pXX'},
+                }},
+            }
+            roots = allowed_roots(config)
+            self.assertEqual(len(roots), 1)
+            self.assertTrue(roots[0].match(f'{base}/p11/import'))
+            self.assertTrue(roots[0].match(f'{base}/p11/import/d'))
+            self.assertFalse(roots[0].match(f'{base}/p11/importer'))
+            self.assertFalse(roots[0].match(f'{base}/p-1/import/d'))
+            self.assertFalse(roots[0].match(outside))
+            # check_path
+            self.assertEqual(check_path(f'{import_dir}/d/../d', roots), f'{import_dir}/d')
+            for path in [
+                'p11/import/d',
+                None,
+                secret,
+                f'{import_dir}/d/../../../outside/secret',
+                f'{import_dir}/missing',
+            ]:
+                with self.assertRaises(PrivilegedHelperError):
+                    check_path(path, roots)
+            os.symlink(secret, f'{import_dir}/link')
+            with self.assertRaises(PrivilegedHelperError):
+                check_path(f'{import_dir}/link', roots)
+            # symbolic_mode
+            self.assertEqual(symbolic_mode(0o045, '+'), 'g+r,o+rx')
+            self.assertEqual(symbolic_mode(0o2070, '-'), 'g-rwx,g-s')
+            self.assertEqual(symbolic_mode(0, '+'), '')
+            # recursive changes skip symlinks, also to directories
+            with open(f'{import_dir}/d/sub/f', 'w') as f:
+                f.write('f')
+            os.symlink(secret, f'{import_dir}/d/sub/link')
+            os.symlink(outside, f'{import_dir}/d/dirlink')
+            apply_chmod(check_path(f'{import_dir}/d', roots), add=0o070, recursive=True)
+            self.assertEqual(os.stat(f'{import_dir}/d/sub/f').st_mode & 0o070, 0o070)
+            self.assertEqual(os.stat(secret).st_mode & 0o777, 0o600)
+            self.assertEqual(os.stat(outside).st_mode & 0o070, os.stat(base).st_mode & 0o070)
+            # a file which is replaced with a symlink after it was checked
+            path = check_path(f'{import_dir}/d/sub/f', roots)
+            os.remove(path)
+            os.symlink(secret, path)
+            with self.assertRaises(PrivilegedHelperError):
+                apply_chmod(path, mode=0o666)
+            self.assertEqual(os.stat(secret).st_mode & 0o777, 0o600)
+            # and a directory on the path
+            with open(f'{import_dir}/d/sub/g', 'w') as f:
+                f.write('g')
+            path = check_path(f'{import_dir}/d/sub/g', roots)
+            shutil.move(f'{import_dir}/d', f'{import_dir}/moved')
+            os.symlink(outside, f'{import_dir}/d')
+            os.mkdir(f'{outside}/sub')
+            os.link(secret, f'{outside}/sub/g')
+            with self.assertRaises(PrivilegedHelperError):
+                apply_chmod(path, mode=0o666)
+            self.assertEqual(os.stat(secret).st_mode & 0o777, 0o600)
+            # nothing is given to root, or made setuid
+            with self.assertRaises(PrivilegedHelperError):
+                apply_chown(f'{import_dir}/moved', 'root', 'root')
+            with self.assertRaises(PrivilegedHelperError):
+                apply_chmod(f'{import_dir}/moved', mode=0o4755)
+        finally:
+            shutil.rmtree(base)
+
+
+    def test_stream_worker_abort(self):
+        # only uses threads, not the API
+        release = threading.Event()
+        class BlockingFile(object):
+            def write(self, data):
+                release.wait() # a slow disk
+        data = gzip.compress(os.urandom(1000000))
+        chunks = [data[i:i + 100000] for i in range(0, len(data), 100000)]
+        writer = GzipStreamWriter(BlockingFile(), max_queued=1)
+        results = []
+        def produce():
+            try:
+                for chunk in chunks:
+                    writer.put(chunk)
+                results.append('done')
+            except GzipStreamError:
+                results.append('aborted')
+        producer = threading.Thread(target=produce, daemon=True)
+        producer.start()
+        time.sleep(1)
+        self.assertTrue(producer.is_alive()) # waiting for room in the queue
+        writer.abort()
+        producer.join(timeout=5)
+        self.assertFalse(producer.is_alive())
+        self.assertEqual(results, ['aborted'])
+        release.set()
+        writer.thread.join(timeout=5)
+        self.assertFalse(writer.thread.is_alive())
+        with self.assertRaises(GzipStreamError):
+            writer.put(chunks[0])
+
+
+    def test_request_hook_partial_failure(self):
+        # only uses a hook script, and a temporary directory, not the API
+        target = f'/tmp/hooks-{uuid.uuid4().hex}'
+        os.makedirs(target)
+        hook = os.path.join(target, 'hook.sh')
+        with open(hook, 'w') as f:
+            f.write(f"""#!/bin/bash
+i=0; status=0
+for name in "$@"; do
+  echo "$name" >> {target}/calls
+  if [ "$name" = bad ] && [ ! -e {target}/failed ]; then
+    touch {target}/failed; echo $i; status=1
+  fi
+  i=$((i + 1))
+done
+exit $status
+""")
+        os.chmod(hook, 0o700)
+        hook_config = {'path': hook, 'sudo': False, 'max_batch': 3}
+        executor = RequestHookExecutor(
+            workers=1, retry_delay=0.1, journal=os.path.join(target, 'hooks.db')
+        )
+        @gen.coroutine
+        def run():
+            executor.start()
+            results = yield [
+                executor.submit(hook_config, [name]) for name in ['a', 'bad', 'c']
+            ]
+            return results
+        loop = IOLoop()
+        try:
+            self.assertEqual(loop.run_sync(run, timeout=10), [True, True, True])
+        finally:
+            loop.close()
+        # only the group which failed was run again
+        with open(os.path.join(target, 'calls')) as f:
+            self.assertEqual(f.read().split(), ['a', 'bad', 'c', 'bad'])
+        executor.journal_executor.shutdown(wait=True)
+        self.assertEqual(executor.db.execute('select count(*) from hooks').fetchone()[0], 0)
+        shutil.rmtree(target)
+
+
+    def test_tar_extractor_abort(self):
+        # only uses threads, and a temporary directory, not the API
+        release = threading.Event()
+        class SlowExtractor(TarStreamExtractor):
+            def finish_file(self, *args):
+                release.wait() # a slow disk
+                super().finish_file(*args)
+        target = f'/tmp/untar-{uuid.uuid4().hex}'
+        os.makedirs(target)
+        buffer = io.BytesIO()
+        with tarfile.open(fileobj=buffer, mode='w') as tar:
+            for i in range(10):
+                data = os.urandom(100000)
+                member = tarfile.TarInfo(f'f{i}')
+                member.size = len(data)
+                tar.addfile(member, io.BytesIO(data))
+        data = buffer.getvalue()
+        chunks = [data[i:i + 50000] for i in range(0, len(data), 50000)]
+        # all files written by the extracting thread, which is held up
+        extractor = SlowExtractor(target, max_queued=1, small_file_max=0)
+        results = []
+        def produce():
+            try:
+                for chunk in chunks:
+                    extractor.put(chunk)
+                results.append('done')
+            except TarStreamError:
+                results.append('aborted')
+        try:
+            producer = threading.Thread(target=produce, daemon=True)
+            producer.start()
+            time.sleep(1)
+            self.assertTrue(producer.is_alive()) # waiting for room in the queue
+            extractor.abort()
+            producer.join(timeout=5)
+            self.assertFalse(producer.is_alive())
+            self.assertEqual(results, ['aborted'])
+            release.set()
+            extractor.thread.join(timeout=5)
+            self.assertFalse(extractor.thread.is_alive())
+        finally:
+            release.set()
+            shutil.rmtree(target)
+
+
     def test_maintenance_mode(self):
         maintenance_on = f'{self.maintenance_url}?maintenance=on'
         maintenance_off = f'{self.maintenance_url}?maintenance=off'
@@ -2310,6 +2913,8 @@ def main():
         'test_ZZf_cluster_export_works',
         # store backend
         'test_ZZg_store_import_and_export',
+        'test_ZZh_store_content_etags',
+        'test_ZZh1_content_etags_with_request_hook',
     ]
     form_data = [
         # form-data
@@ -2344,12 +2949,17 @@ def main():
         'test_ZZ_get_range_until_end_for_export',
         'test_ZZa_get_specific_range_conditional_on_etag',
         'test_ZZb_get_range_out_of_bounds_returns_correct_error',
+        'test_ZZc_get_multiple_ranges_for_export',
+        'test_ZZd_get_compressed_export',
+        'test_ZZd1_conditional_get_for_export',
     ]
     pipelines = [
         'test_Za_stream_tar_without_custom_content_type_works',
         'test_Zb_stream_tar_with_custom_content_type_untar_works',
+        'test_Zb1_stream_tar_skips_unsafe_members',
         'test_Zc_stream_tar_gz_with_custom_content_type_untar_works',
         'test_Zg_stream_gz_with_custom_header_decompress_works',
+        'test_Zg0_stream_gz_multiple_members_and_invalid_data',
     ]
     gpg_related = [
         'test_Zd_stream_aes_with_custom_content_type_decrypt_works',
@@ -2366,6 +2976,9 @@ def main():
         'test_ZZZ_put_file_to_dir',
         'test_ZZZ_patch_resumable_file_to_dir',
         'test_ZZZ_get_file_from_dir',
+        'test_ZZZ_get_dir_as_archive',
+        'test_ZZZ_sync_manifest',
+        'test_ZZZ_get_file_info_batch',
         'test_ZM2_resume_upload_with_directory',
     ]
     listing = [
@@ -2387,6 +3000,10 @@ def main():
     load = [
         'test_XXX_load'
     ]
+    bench = [
+        'test_XXX_bench_stream_upload',
+        'test_XXX_bench_nacl_stream_upload',
+    ]
     db = [
         'test_all_db_backends',
     ]
@@ -2396,6 +3013,16 @@ def main():
     crypt = [
         'test_nacl_crypto'
     ]
+    privileged = [
+        'test_privileged_helper',
+    ]
+    streams = [
+        'test_stream_worker_abort',
+        'test_tar_extractor_abort',
+    ]
+    hooks = [
+        'test_request_hook_partial_failure',
+    ]
     maintenance = [
         'test_maintenance_mode',
     ]
@@ -2435,12 +3062,20 @@ def main():
         tests.extend(ns)
     if 'load' in sys.argv:
         tests.extend(load)
+    if 'bench' in sys.argv:
+        tests.extend(bench)
     if 'db' in sys.argv:
         tests.extend(db)
     if 'apps' in sys.argv:
         tests.extend(apps)
     if 'crypt' in sys.argv:
         tests.extend(crypt)
+    if 'privileged' in sys.argv:
+        tests.extend(privileged)
+    if 'streams' in sys.argv:
+        tests.extend(streams)
+    if 'hooks' in sys.argv:
+        tests.extend(hooks)
     if 'maintenance' in sys.argv:
         tests.extend(maintenance)
     if 'mtime' in sys.argv:
@@ -2461,6 +3096,9 @@ def main():
         tests.extend(apps)
         tests.extend(db)
         tests.extend(crypt)
+        tests.extend(privileged)
+        tests.extend(streams)
+        tests.extend(hooks)
         tests.extend(form_data)
         tests.extend(mtime)
     tests.sort()
@@ -5,7 +5,6 @@ import re
 import logging
 import hashlib
 import subprocess
-import shlex
 import re
 import shutil
 
@@ -15,16 +14,6 @@ _IS_REALISTIC_PGP_KEY_FINGERPRINT = re.compile(r'^[0-9A-Z]{16}$')
 _IS_VALID_UUID = re.compile(r'([a-f\d0-9-]{32,36})')
 
 
-def call_request_hook(path, params, as_sudo=True):
-    if as_sudo:
-        cmd = ['sudo']
-    else:
-        cmd = []
-    cmd.append(shlex.quote(path))
-    cmd.extend(params)
-    subprocess.call(cmd)
-
-
 class IllegalFilenameException(Exception):
     message = 'Filename not allowed'
 
@@ -49,6 +38,88 @@ def check_filename(filename, disallowed_start_chars=[]):
     return filename
 
 
+def parse_byte_ranges(header, size):
+    """
+    Parse the value of a Range header, for a resource of
+    a given size, into a list of (start, end) byte indices.
+
+    Clients specify ranges in terms of 0-based byte indices,
+    with inclusive intervals: start-end, start- (until the end),
+    and -length (the last length bytes), separated by commas.
+
+    Parameters
+    ----------
+    header: str, e.g. 'bytes=0-99, 200-'
+    size: int, size of the resource
+
+    Returns
+    -------
+    list of (int, int), inclusive intervals
+
+    Raises
+    ------
+    ValueError, if the header is malformed, or if
+    any range exceeds the byte range of the resource
+
+    """
+    unit, _, specs = header.partition('=')
+    if unit.strip() != 'bytes':
+        raise ValueError(f'Range unit not supported: {unit}')
+    ranges = []
+    for spec in specs.split(','):
+        first, _, last = spec.strip().partition('-')
+        if not _:
+            raise ValueError(f'Malformed range: {spec}')
+        if not first:
+            length = int(last)
+            if not length:
+                raise ValueError(f'Malformed range: {spec}')
+            start, end = max(size - length, 0), size - 1
+        else:
+            start = int(first)
+            end = int(last) if last else size - 1
+        if start > end or end >= size:
+            raise ValueError('Range request exceeds byte range of resource')
+        ranges.append((start, end))
+    return ranges
+
+
+def negotiate_encoding(accept_encoding, supported):
+    """
+    Choose a content encoding, given the Accept-Encoding
+    header of a request.
+
+    Parameters
+    ----------
+    accept_encoding: str, e.g. 'gzip;q=0.8, zstd'
+    supported: list, encodings in order of server preference
+
+    Returns
+    -------
+    str, or None if the client only accepts the identity encoding
+
+    """
+    preferences = {}
+    for item in accept_encoding.split(','):
+        name, _, params = item.partition(';')
+        quality = 1.0
+        for param in params.split(';'):
+            key, _, value = param.strip().partition('=')
+            if key == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if name.strip():
+            preferences[name.strip().lower()] = quality
+    chosen, best = None, 0.0
+    for encoding in supported:
+        quality = preferences.get(encoding, preferences.get('*', 0.0))
+        if quality > best:
+            chosen, best = encoding, quality
+    return chosen
+
+
 def create_cluster_dir_if_not_exists(path, tenant, tenant_string_pattern):
     # TODO: need to move the /file-import to config
     base = path.replace(tenant_string_pattern, tenant).replace('/file-import', '')
@@ -142,3 +213,33 @@ def set_mtime(path, mtime):
     mtime = mtime
     atime = mtime
     os.utime(path, (mtime, atime))
+
+
+def sendfile_nonblocking(out_fd, in_fd, offset, count):
+    """
+    Copy up to count bytes from in_fd, starting at offset, to the
+    non-blocking socket out_fd, in the kernel, until the socket
+    buffer is full. Only blocks to read the file.
+
+    Parameters
+    ----------
+    out_fd: int, socket file descriptor
+    in_fd: int, file descriptor
+    offset: int, position in the file
+    count: int, number of bytes to send
+
+    Returns
+    -------
+    tuple, (bytes sent, whether the end of the file was reached)
+
+    """
+    sent = 0
+    while sent < count:
+        try:
+            num = os.sendfile(out_fd, in_fd, offset + sent, count - sent)
+        except BlockingIOError:
+            return sent, False
+        if num == 0:
+            return sent, True
+        sent += num
+    return sent, False